@@ -0,0 +1,571 @@
+"""
+An ASGI version of the mockprock server, built on Quart.
+
+It serves the same routes and JSON as mockprock.server, but handlers are
+coroutines: storage calls are awaited (see mockprock.async_db) and callbacks
+are timed on the event loop and posted with aiohttp. One process can then hold
+thousands of simulated proctoring clients polling their attempts at once.
+
+Quart requires a newer Flask than the Flask server does, so install it in its
+own environment (pip install -r requirements/asgi.txt). Then run it with
+
+    python -m mockprock.asgi {client_id} {client_secret}
+
+or from any ASGI server, passing the same arguments in MOCKPROCK_ARGS:
+
+    MOCKPROCK_ARGS="{client_id} {client_secret} -l http://lms:18000" hypercorn mockprock.asgi:app
+
+Without MOCKPROCK_ARGS, storage defaults to mockprock.sqlite and callbacks can't be sent.
+"""
+import argparse
+import asyncio
+from functools import wraps
+import json
+import os
+import shlex
+import sys
+
+try:
+    from quart import Blueprint, Quart, abort, jsonify, make_response, render_template, request, url_for
+except ImportError as ex:
+    raise ImportError('quart is required for the ASGI app: pip install quart') from ex
+
+from mockprock.async_db import AsyncDB
+from mockprock.cache import LRUCache
+from mockprock.db import InvalidTransition, init_app
+from mockprock.events import (
+    CALLBACK_STATUSES,
+    FINAL_STATUSES,
+    AsyncWatcher,
+    StatusBroadcaster,
+    format_event,
+    status_event,
+)
+from mockprock.outbox import OutboxWorker
+from mockprock.proctoring import (
+    DESKTOP_HEADERS,
+    RequestError,
+    attempt_details,
+    bulk_items,
+    callback_attempt_id,
+    check_token,
+    dashboard_context,
+    desktop_session_id,
+    load_exam,
+    make_access_token,
+    patch_attempt_status,
+    ping_desktop,
+    proctoring_config,
+    ready_callback_request,
+    review_callback_request,
+    save_bulk_attempts,
+    start_desktop,
+    stop_desktop,
+)
+from mockprock.rest_api_client.async_client import AsyncCallbackClient
+from mockprock.rest_api_client.client import OAuthAPIClient
+from mockprock.scenarios import Scenario, load_scenario
+
+app = Quart(__name__)
+app.secret_key = 'super secret'
+app.config['DUMP_REQUESTS'] = False
+app.config['EXAM_CACHE_SECONDS'] = None
+# with --cluster, other nodes' status changes aren't pushed to this one,
+# so event streams also read the attempt from storage this often
+app.config['EVENT_POLL_SECONDS'] = None
+# callbacks beyond this many waiting for their delay are dropped
+app.config['MAX_PENDING_CALLBACKS'] = 10000
+app.db = None
+app.callback_client = None
+app.outbox = None
+app.jwt_cache = LRUCache(maxsize=1024)
+app.exam_cache = LRUCache(maxsize=4096)
+app.config_cache = LRUCache(maxsize=64)
+app.status_events = StatusBroadcaster()
+app.scenario = Scenario()
+# tasks waiting to send a callback. The event loop only keeps weak references to tasks
+app.pending_callbacks = set()
+
+desktop = Blueprint('desktop', __name__)
+
+# seconds between keep-alive comments on idle event streams
+EVENT_KEEPALIVE_SECONDS = 15
+
+
+@app.before_serving
+async def open_storage():
+    if app.db is None:
+        # served by an ASGI server that imported the app, rather than from the command line
+        if os.environ.get('MOCKPROCK_ARGS'):
+            configure(parse_args(shlex.split(os.environ['MOCKPROCK_ARGS'])))
+        else:
+            app.logger.warning('MOCKPROCK_ARGS is not set, so no callbacks will be sent to the LMS')
+            init_app(app)
+            app.db = AsyncDB(app.db)
+    if app.outbox:
+        app.outbox.start()
+
+
+@app.after_serving
+async def close_storage():
+    if app.outbox:
+        app.outbox.shutdown()
+    for task in list(app.pending_callbacks):
+        task.cancel()
+    if app.callback_client:
+        app.callback_client.shutdown()
+    await asyncio.get_running_loop().run_in_executor(None, app.db.close)
+
+
+def get_download_url():
+    return 'http://%s/download' % request.host
+
+
+async def get_cached_exam(exam_id):
+    """
+    Returns the exam (empty if it doesn't exist), reading through the exam cache.
+    The returned dict is shared, so don't modify it.
+    """
+    exam = app.exam_cache.get(exam_id)
+    if exam is None:
+        exam = await app.db.run(load_exam, app.db.db, app.exam_cache, exam_id, app.config['EXAM_CACHE_SECONDS'])
+    return exam
+
+
+def requires_token(f):
+    @wraps(f)
+    async def _func(*args, **kwargs):
+        if not check_token(request.headers.get('Authorization', ''), app.jwt_cache, app.secret_key):
+            abort(403)
+        return await f(*args, **kwargs)
+    return _func
+
+
+@app.route('/oauth2/access_token', methods=['POST'])
+async def access_token():
+    """
+    Returns a mock JWT token
+    """
+    form = await request.form
+    assert form['token_type'] == 'jwt', 'Only JWT is supported'
+    return jsonify(make_access_token(form['client_id'], form['client_secret'], app.secret_key))
+
+
+@app.route('/api/v1/config/')
+@requires_token
+async def get_config():
+    """
+    Returns the global configuration options
+    """
+    body = app.config_cache.get(request.host)
+    if body is None:
+        body = json.dumps(dict(proctoring_config, download_url=get_download_url()))
+        app.config_cache.set(request.host, body)
+    return app.response_class(body, mimetype='application/json')
+
+
+@app.route('/api/v1/exam/<exam_id>/', methods=['GET'])
+@requires_token
+async def get_exam(exam_id):
+    """
+    Returns the exam
+    """
+    exam = await get_cached_exam(exam_id) or {}
+    return jsonify(exam)
+
+
+@app.route('/api/v1/exam/', methods=['POST'])
+@requires_token
+async def create_exam():
+    """
+    Creates an exam, returning an external id
+    """
+    exam = await request.get_json()
+    exam_id = await app.db.save_exam(exam, request.headers.get('Authorization'))
+    app.exam_cache.delete(exam_id)
+    return jsonify({'id': exam_id})
+
+
+@app.route('/api/v1/exam/<exam_id>/', methods=['POST'])
+@requires_token
+async def update_exam(exam_id):
+    """
+    Updates an exam, returning the exam
+    """
+    exam = await request.get_json()
+    exam['external_id'] = exam_id
+    await app.db.save_exam(exam, request.headers.get('Authorization'))
+    app.exam_cache.delete(exam_id)
+    return jsonify({'id': exam_id})
+
+
+@app.route('/api/v1/exam/<exam_id>/attempt/', methods=['POST'])
+@requires_token
+async def create_attempt(exam_id):
+    attempt = await request.get_json()
+    attempt['exam_id'] = exam_id
+    await app.db.save_attempt(attempt)
+    app.status_events.publish(attempt['id'], attempt.get('status') or 'created')
+    return jsonify({'id': attempt['id']})
+
+
+async def read_bulk_items():
+    """
+    Returns an iterator over the objects in a JSON array request body,
+    or in an NDJSON body (application/x-ndjson) with one object per line
+    """
+    if request.mimetype == 'application/x-ndjson':
+        data = await request.get_data(as_text=True)
+        return bulk_items(data.splitlines(), ndjson=True)
+    return bulk_items(await request.get_json())
+
+
+@app.route('/api/v1/exams/', methods=['POST'])
+@requires_token
+async def create_exams():
+    """
+    Creates or updates many exams in one transaction, returning their external ids in order
+    """
+    try:
+        exam_ids = await app.db.save_exams(await read_bulk_items(), request.headers.get('Authorization'))
+    except RequestError as ex:
+        abort(ex.code, ex.description)
+    except (KeyError, TypeError, ValueError) as ex:
+        abort(400, 'Invalid exam: %r' % ex)
+    for exam_id in exam_ids:
+        app.exam_cache.delete(exam_id)
+    return jsonify({'ids': exam_ids})
+
+
+@app.route('/api/v1/attempts/', methods=['POST'])
+@requires_token
+async def create_attempts():
+    """
+    Creates many attempts in one transaction, returning their ids in order.
+    Each attempt must include its exam_id.
+    """
+    try:
+        saved = await app.db.run(save_bulk_attempts, app.db.db, await read_bulk_items())
+    except RequestError as ex:
+        abort(ex.code, ex.description)
+    except (KeyError, TypeError, ValueError) as ex:
+        abort(400, 'Invalid attempt: %r' % ex)
+    for attempt_id, status in saved:
+        app.status_events.publish(attempt_id, status)
+    return jsonify({'ids': [attempt_id for attempt_id, _ in saved]})
+
+
+@app.route('/api/v1/exam/<exam_id>/attempt/<attempt_id>/', methods=['GET', 'PATCH'])
+@requires_token
+async def exam_attempt_endpoint(exam_id, attempt_id):
+    """
+    Retrieves/updates the exam attempt
+    For convenience, the GET request also returns instructions and software download link
+    for the exam
+    """
+    response = {'id': attempt_id}
+    if request.method == 'PATCH':
+        attempt = await request.get_json()
+        status = attempt.get('status')
+        try:
+            dbattempt, changed = await app.db.run(patch_attempt_status, app.db.db, exam_id, attempt_id, status)
+        except InvalidTransition as ex:
+            abort(409, str(ex))
+        if not dbattempt:
+            abort(404)
+        if changed:
+            app.status_events.publish(attempt_id, status)
+        if changed and status == 'submitted':
+            delay, review_status, comments = app.scenario.review()
+            app.logger.info('Finished attempt %s. Sending a fake %s review in %.1f seconds...',
+                            attempt_id, review_status, delay)
+            await send_callback('review', *review_callback_request(attempt_id, dbattempt, review_status, comments),
+                                delay=delay)
+        elif changed:
+            app.logger.info('Changed attempt %s status to %s', attempt_id, status)
+        response['status'] = status
+    else:
+        response = await app.db.run(attempt_details, app.db.db, app.exam_cache, exam_id, attempt_id,
+                                    get_download_url(), app.config['EXAM_CACHE_SECONDS'])
+    return jsonify(response)
+
+
+@app.route('/api/v1/exam/<exam_id>/attempt/<attempt_id>/events/')
+@requires_token
+async def attempt_events(exam_id, attempt_id):
+    """
+    Streams the attempt's status changes as server-sent events, starting with its current status.
+    The stream ends once the attempt is reviewed, or fails with an error.
+    """
+    # subscribe first, so that no change is missed while reading the current status
+    watcher = app.status_events.subscribe(attempt_id, AsyncWatcher(asyncio.get_running_loop()))
+    attempt = await app.db.get_attempt(exam_id, attempt_id)
+    if not attempt:
+        app.status_events.unsubscribe(attempt_id, watcher)
+        abort(404)
+    poll_seconds = app.config['EVENT_POLL_SECONDS']
+    wait = poll_seconds or EVENT_KEEPALIVE_SECONDS
+
+    async def stream():
+        try:
+            status = attempt['status']
+            idle = 0
+            yield format_event(status_event(attempt_id, status))
+            while status not in FINAL_STATUSES:
+                event = await watcher.get(wait)
+                if event is None and poll_seconds:
+                    current = (await app.db.get_attempt(exam_id, attempt_id)).get('status')
+                    if current and current != status:
+                        event = status_event(attempt_id, current)
+                if event is None:
+                    idle += wait
+                    if idle >= EVENT_KEEPALIVE_SECONDS:
+                        idle = 0
+                        yield ': keep-alive\n\n'
+                    continue
+                if event['status'] == status:
+                    # already read from storage
+                    continue
+                idle = 0
+                status = event['status']
+                yield format_event(event)
+        finally:
+            app.status_events.unsubscribe(attempt_id, watcher)
+
+    response = await make_response(stream(), {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    # streams stay open for as long as the attempt takes
+    response.timeout = None
+    return response
+
+
+@app.route('/api/v1/attempts/stats/')
+@requires_token
+async def get_attempt_stats():
+    """
+    Returns the number of attempts in each status, and how long attempts stay in each status,
+    optionally for one course_id
+    """
+    return jsonify(await app.db.get_attempt_stats(request.args.get('course_id')))
+
+
+@app.route('/api/v1/stats/')
+@requires_token
+async def get_stats():
+    """
+    Returns counters from the server's caches and callback queues
+    """
+    return jsonify({
+        'jwt_cache': app.jwt_cache.stats(),
+        'exam_cache': app.exam_cache.stats(),
+        'status_events': app.status_events.stats(),
+        'pending_callbacks': len(app.pending_callbacks),
+    })
+
+
+@app.route('/api/v1/instructor/<client_id>/')
+async def instructor_dashboard(client_id):
+    token = request.args.get('jwt')
+    if not token:
+        abort(403, 'JWT token required')
+    try:
+        context = await app.db.run(dashboard_context, app.db.db, client_id, token, request.args.get('after'))
+    except RequestError as ex:
+        abort(ex.code, ex.description)
+    if context['next_after']:
+        context['next_url'] = url_for('instructor_dashboard', client_id=client_id, jwt=token,
+                                      after=context['next_after'])
+    return await render_template('dashboard.html', **context)
+
+
+@app.route('/download')
+async def software_download():
+    """
+    Page that pretends to download software, and then calls back to edx
+    to signal that the exam is ready
+    """
+    attempt_id = request.args.get('attempt')
+    exam_id = request.args.get('exam')
+    attempt = await app.db.get_attempt(exam_id, attempt_id)
+    app.logger.info('Requesting download for attempt %s', attempt_id)
+    if not attempt.get('lms_host'):
+        app.logger.warning('Not sending ready callback for unknown attempt %s', attempt_id)
+    else:
+        await send_callback('ready', *ready_callback_request(attempt_id, attempt), delay=app.scenario.ready_delay())
+    return await render_template('download.html', attempt_id=attempt_id, exam_id=exam_id)
+
+
+@desktop.after_request
+async def allow_crossorigin_requests(response):
+    """
+    Since these are ajax requests, we need to allow cross site access
+    """
+    response.headers.update(DESKTOP_HEADERS)
+    return response
+
+
+@desktop.route('/desktop/ping')
+async def ping():
+    return jsonify(await app.db.run(ping_desktop, app.db.db, desktop_session_id(request.args)))
+
+
+@desktop.route('/desktop/start', methods=['POST'])
+async def start():
+    return jsonify(await app.db.run(start_desktop, app.db.db, desktop_session_id(request.args)))
+
+
+@desktop.route('/desktop/stop', methods=['POST'])
+async def stop():
+    """
+    Starts uploading the session and returns immediately.
+    Poll /desktop/ping to see when the upload has finished.
+    """
+    return jsonify(await app.db.run(stop_desktop, app.db.db, desktop_session_id(request.args)))
+
+
+app.register_blueprint(desktop)
+
+
+async def send_callback(name, callback_url, payload, delay):
+    """
+    Sends the callback after delay seconds, through the outbox if it's enabled
+    """
+    if app.outbox:
+        await app.db.enqueue_callback(name, callback_url, payload, delay=delay)
+        return
+    if not app.callback_client:
+        app.logger.warning('Not sending %s callback to %s: no LMS client is configured', name, callback_url)
+        return
+    if len(app.pending_callbacks) >= app.config['MAX_PENDING_CALLBACKS']:
+        app.logger.warning('Not sending %s callback to %s: too many callbacks pending', name, callback_url)
+        return
+    task = asyncio.get_running_loop().create_task(post_callback(name, callback_url, payload, delay))
+    app.pending_callbacks.add(task)
+    task.add_done_callback(app.pending_callbacks.discard)
+
+
+async def post_callback(name, callback_url, payload, delay=0):
+    await asyncio.sleep(delay)
+    app.logger.info('Calling back to %s', callback_url)
+    try:
+        response = await asyncio.wrap_future(app.callback_client.post(callback_url, payload))
+    except Exception:  # pylint: disable=broad-except
+        app.logger.exception('in %s callback', name)
+    else:
+        app.logger.info('LMS response: %r', response)
+        await app.db.run(record_callback_status, name, callback_url)
+
+
+def record_callback_status(name, callback_url):
+    """
+    Moves the attempt to the status that delivering its callback brings it to, and tells its watchers.
+    This blocks on storage, so call it off the event loop.
+    """
+    attempt_id = callback_attempt_id(callback_url)
+    if not attempt_id:
+        return
+    status = CALLBACK_STATUSES[name]
+    try:
+        attempt = app.db.db.transition_attempt(attempt_id, status)
+    except InvalidTransition as ex:
+        app.logger.warning('Not recording the %s callback for attempt %s: %s', status, attempt_id, ex)
+        return
+    if attempt and attempt['previous_status'] != status:
+        app.status_events.publish(attempt_id, status)
+
+
+def outbox_send(name, callback_url, payload):
+    app.logger.info('Calling back to %s', callback_url)
+    future = app.callback_client.post(callback_url, payload)
+
+    def delivered(future):
+        # this runs on the callback client's event loop, so leave the storage to the storage threads
+        if future.exception() is None:
+            app.db.submit(record_callback_status, name, callback_url)
+
+    future.add_done_callback(delivered)
+    return future
+
+
+def configure(args):
+    """
+    Sets up storage, callback delivery and the scenario from the command line arguments
+    """
+    if args.scenario or args.time_scale is not None:
+        try:
+            app.scenario = load_scenario(args.scenario, args.time_scale)
+        except (OSError, ValueError) as ex:
+            sys.exit(str(ex))
+    init_app(app, engine=args.db_engine, dbpath=args.db_path)
+    app.db = AsyncDB(app.db)
+    app.config['EXAM_CACHE_SECONDS'] = args.exam_cache_seconds
+    app.config['EVENT_POLL_SECONDS'] = args.event_poll_seconds
+    app.config['MAX_PENDING_CALLBACKS'] = args.max_pending_callbacks
+    oauth_client = OAuthAPIClient(args.lms_host, args.client_id, args.client_secret,
+                                  token_skew=args.token_skew, token_cache_path=args.token_cache)
+    app.callback_client = AsyncCallbackClient(oauth_client, max_in_flight=args.max_inflight_callbacks,
+                                              timeout=args.callback_timeout)
+    if args.outbox:
+        app.outbox = OutboxWorker(app.db.db, outbox_send, app.logger, lease=args.callback_lease,
+                                  node_id=args.node_id, max_in_flight=args.max_inflight_callbacks)
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments, or the given list of them, exiting with a message if they're invalid
+    """
+    parser = argparse.ArgumentParser(description='run the mockprock server as an ASGI app')
+    parser.add_argument("client_id", type=str, help="oauth client id")
+    parser.add_argument("client_secret", type=str, help="oauth client secret")
+    parser.add_argument('-l', dest='lms_host', type=str, help='LMS host', default='http://host.docker.internal:18000')
+    parser.add_argument('--db', dest='db_engine', choices=('sqlite', 'memory'), default='sqlite',
+                        help='storage engine. memory is not durable, but never touches the filesystem')
+    parser.add_argument('--db-path', dest='db_path', type=str, help='sqlite database path', default='mockprock.sqlite')
+    parser.add_argument('--max-pending-callbacks', dest='max_pending_callbacks', type=int, default=10000,
+                        help='callbacks beyond this many waiting are dropped')
+    parser.add_argument('--max-inflight-callbacks', dest='max_inflight_callbacks', type=int, default=100,
+                        help='limit on concurrent requests to the LMS')
+    parser.add_argument('--callback-timeout', dest='callback_timeout', type=float, default=30,
+                        help='seconds to wait for the LMS to respond to a callback')
+    parser.add_argument('--outbox', dest='outbox', default=False, action='store_true',
+                        help='store callbacks in the database and retry them until the LMS accepts them')
+    parser.add_argument('--callback-lease', dest='callback_lease', type=float, default=60,
+                        help='seconds a process holds a callback from the outbox before another may send it')
+    parser.add_argument('--cluster', dest='cluster', default=False, action='store_true',
+                        help='run as one of several nodes sharing the --db-path database. Implies --outbox')
+    parser.add_argument('--node-id', dest='node_id', type=str, default=None,
+                        help='name of this node in callback leases. Defaults to the hostname')
+    parser.add_argument('--exam-cache-seconds', dest='exam_cache_seconds', type=float, default=None,
+                        help='seconds to cache exams for. Defaults to until the exam is saved, '
+                             'or 5 seconds with --cluster')
+    parser.add_argument('--event-poll-seconds', dest='event_poll_seconds', type=float, default=None,
+                        help='seconds between reads of the attempt on its event stream. Defaults to never, '
+                             'as status changes are pushed, or 2 seconds with --cluster')
+    parser.add_argument('--token-cache', dest='token_cache', type=str, default=None,
+                        help='file to keep the LMS access token in across restarts')
+    parser.add_argument('--token-skew', dest='token_skew', type=int, default=60,
+                        help='seconds before expiration to refresh the LMS access token')
+    parser.add_argument('--scenario', dest='scenario', type=str, default=None,
+                        help='JSON file of callback delays and review outcomes to play, see mockprock.scenarios')
+    parser.add_argument('--time-scale', dest='time_scale', type=float, default=None,
+                        help="divide the scenario's delays by this, overriding the file")
+    parser.add_argument('--bind', dest='bind', type=str, default='0.0.0.0:11136', help='address and port to listen on')
+    args = parser.parse_args(argv)
+
+    if args.cluster:
+        if args.db_engine == 'memory':
+            sys.exit('--cluster requires the sqlite storage engine')
+        args.outbox = True
+        if args.exam_cache_seconds is None:
+            args.exam_cache_seconds = 5
+        if args.event_poll_seconds is None:
+            args.event_poll_seconds = 2
+    if args.outbox and args.callback_lease <= args.callback_timeout:
+        sys.exit('--callback-lease must be longer than --callback-timeout, or callbacks may be sent twice')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    configure(args)
+    host, _, port = args.bind.rpartition(':')
+    app.run(host=host or '0.0.0.0', port=int(port))
@@ -0,0 +1,60 @@
+"""
+Awaitable access to the storage engines in mockprock.db, for the ASGI app.
+
+sqlite3 has no non-blocking interface, so (like aiosqlite) calls run on
+threads. They share a bounded pool sized to the engine's connection pool,
+which keeps the event loop free however many requests are waiting on storage.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import inspect
+
+from mockprock.db import DEFAULT_POOL_SIZE
+
+
+def _call(method, args, kwargs):
+    result = method(*args, **kwargs)
+    if inspect.isgenerator(result):
+        # finish reading on the storage thread, rather than from the event loop
+        result = list(result)
+    return result
+
+
+class AsyncDB:
+    """
+    Wraps a :class:`mockprock.db.BaseDB`, turning each of its methods into a coroutine function
+    """
+    def __init__(self, db, max_workers=DEFAULT_POOL_SIZE):
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='mockprock-db')
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if name.startswith('_') or not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            return await self.run(_call, method, args, kwargs)
+
+        # only look each method up once
+        setattr(self, name, call)
+        return call
+
+    async def run(self, func, *args):
+        """
+        Runs func(*args) on the storage threads, returning its result
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def submit(self, func, *args):
+        """
+        Starts func(*args) on the storage threads without waiting for it, from any thread.
+        Returns a :class:`concurrent.futures.Future` for its result.
+        """
+        return self._executor.submit(func, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.db.close()
@@ -0,0 +1,91 @@
+"""
+Groups review callbacks that come due close together, so the LMS isn't
+flooded with one request per attempt at the end of an exam
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from mockprock.scheduler import SchedulerFull
+
+
+class ReviewBatcher:
+    """
+    Collects review callbacks per LMS host for `window` seconds, then delivers
+    the batch with at most `max_parallel` concurrent requests, and no more than
+    `rate` requests per second to each host.
+
+    A second review for the same attempt within a window replaces the first
+    and is counted as coalesced. Requests that had to wait for the rate limit
+    are counted as delayed; they wait in the scheduler rather than holding a
+    sending thread. `send` returns a :class:`concurrent.futures.Future`, and
+    requests are counted as sent or failed once it resolves.
+    """
+    def __init__(self, scheduler, send, logger, window=1.0, max_parallel=4, rate=20):
+        self.scheduler = scheduler
+        self.send = send
+        self.logger = logger
+        self.window = window
+        self.rate = rate
+        self.stats = {'sent': 0, 'failed': 0, 'coalesced': 0, 'delayed': 0}
+        self._batches = {}
+        self._next_send = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='mockprock-batch')
+
+    def add(self, lms_host, attempt_id, callback_url, payload):
+        with self._lock:
+            batch = self._batches.get(lms_host)
+            if batch is None:
+                self.scheduler.schedule(self.window, self.flush, lms_host)
+                batch = self._batches[lms_host] = {}
+            if attempt_id in batch:
+                self.stats['coalesced'] += 1
+            batch[attempt_id] = (callback_url, payload)
+
+    def flush(self, lms_host):
+        with self._lock:
+            batch = self._batches.pop(lms_host, {})
+            # space the requests out to the host's rate, after any still waiting from earlier batches
+            now = time.monotonic()
+            send_at = max(now, self._next_send.get(lms_host, now))
+            delays = []
+            for _ in batch:
+                delays.append(send_at - now)
+                send_at += 1.0 / self.rate
+            self._next_send[lms_host] = send_at
+            self.stats['delayed'] += sum(1 for delay in delays if delay > 0)
+        self.logger.info('Sending %d batched reviews to %s', len(batch), lms_host)
+        for delay, (callback_url, payload) in zip(delays, batch.values()):
+            if delay > 0:
+                try:
+                    self.scheduler.schedule(delay, self._submit, callback_url, payload)
+                except SchedulerFull as ex:
+                    self.logger.warning('Not sending batched review to %s: %s', callback_url, ex)
+                    self._count('failed')
+            else:
+                self._submit(callback_url, payload)
+
+    def _submit(self, callback_url, payload):
+        self._executor.submit(self._send, callback_url, payload)
+
+    def _send(self, callback_url, payload):
+        try:
+            future = self.send(callback_url, payload)
+        except Exception:  # pylint: disable=broad-except
+            self.logger.exception('Sending batched review to %s', callback_url)
+            self._count('failed')
+        else:
+            future.add_done_callback(lambda future: self._count('failed' if future.exception() else 'sent'))
+
+    def _count(self, result):
+        with self._lock:
+            self.stats[result] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def shutdown(self):
+        self.logger.info('Review batches: %s', self.get_stats())
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,192 @@
+"""
+Load generator for a running mockprock server.
+
+Each flow walks through a proctored exam the way the LMS and a student would:
+token, config, create exam, create attempt, get attempt, download, submit.
+Callbacks go to a stand-in LMS started by the benchmark, so start the server
+pointing at it, e.g.
+
+    python -m mockprock.server bench benchsecret -l http://127.0.0.1:18001 --no-debug
+    mockprock-bench -n 1000 -c 20
+
+To check that a cluster delivers each callback once, start several nodes on
+one database and spread the flows across them:
+
+    python -m mockprock.server bench benchsecret -l http://127.0.0.1:18001 --cluster --bind :11136
+    python -m mockprock.server bench benchsecret -l http://127.0.0.1:18001 --cluster --bind :11137
+    mockprock-bench -n 1000 --url http://127.0.0.1:11136 --url http://127.0.0.1:11137 --wait 60
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import math
+import sys
+import threading
+import time
+
+import requests
+
+from mockprock.fake_lms import FakeLMS
+
+# the server sends reviews 10 seconds after submission by default, more under load or with --scenario
+DEFAULT_WAIT_SECONDS = 30
+
+
+def percentile(values, pct):
+    """
+    Returns the nearest-rank percentile of a sorted list
+    """
+    index = max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+class Timings:
+    """
+    Thread-safe collection of request latencies, by endpoint name
+    """
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def error(self, name):
+        with self._lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self, elapsed):
+        """
+        Returns a dict of endpoint name to count, errors, throughput and p50/p95/p99 latency in ms
+        """
+        summary = {}
+        with self._lock:
+            for name in sorted(set(self.latencies) | set(self.errors)):
+                values = sorted(self.latencies.get(name, []))
+                row = {
+                    'count': len(values),
+                    'errors': self.errors.get(name, 0),
+                    'rps': len(values) / elapsed if elapsed else 0,
+                }
+                for pct in (50, 95, 99):
+                    row['p%d' % pct] = percentile(values, pct) * 1000 if values else None
+                summary[name] = row
+        return summary
+
+    def report(self, elapsed):
+        lines = ['%-16s %8s %7s %9s %9s %9s %9s' % ('endpoint', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')]
+        for name, row in self.summary(elapsed).items():
+            latencies = ['%9.1f' % row[key] if row[key] is not None else '%9s' % '-' for key in ('p50', 'p95', 'p99')]
+            lines.append('%-16s %8d %7d %9.1f %s' % (name, row['count'], row['errors'], row['rps'], ' '.join(latencies)))
+        return '\n'.join(lines)
+
+
+class BenchClient:
+    """
+    Runs proctoring flows against the server, recording the latency of each request
+    """
+    def __init__(self, base_url, client_id, client_secret, lms_url, timings):
+        self.base_url = base_url.rstrip('/')
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.lms_url = lms_url
+        self.timings = timings
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def request(self, name, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=30, **kwargs)
+            response.raise_for_status()
+        except requests.RequestException:
+            self.timings.error(name)
+            raise
+        self.timings.add(name, time.perf_counter() - start)
+        return response
+
+    def run_flow(self, number):
+        data = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'token_type': 'jwt',
+        }
+        token = self.request('token', 'POST', '/oauth2/access_token', data=data).json()['access_token']
+        headers = {'Authorization': 'JWT %s' % token}
+        self.request('config', 'GET', '/api/v1/config/', headers=headers)
+        exam = {
+            'course_id': 'course-v1:mockprock+bench+run',
+            'exam_name': 'Benchmark exam %d' % number,
+            'is_practice_exam': False,
+            'rules': {'allow_notes': True},
+        }
+        exam_id = self.request('create_exam', 'POST', '/api/v1/exam/', json=exam, headers=headers).json()['id']
+        attempt = {
+            'status': 'created',
+            'user_id': number,
+            'full_name': 'Student %d' % number,
+            'email': 'student%d@example.com' % number,
+            'lms_host': self.lms_url,
+        }
+        attempt_path = '/api/v1/exam/%s/attempt/' % exam_id
+        attempt_id = self.request('create_attempt', 'POST', attempt_path, json=attempt, headers=headers).json()['id']
+        attempt_path += '%s/' % attempt_id
+        self.request('get_attempt', 'GET', attempt_path, headers=headers)
+        self.request('download', 'GET', '/download', params={'attempt': attempt_id, 'exam': exam_id})
+        self.request('submit', 'PATCH', attempt_path, json={'status': 'submitted'}, headers=headers)
+
+    def try_flow(self, number):
+        try:
+            self.run_flow(number)
+            return True
+        except requests.RequestException:
+            return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a running mockprock server')
+    parser.add_argument('--url', dest='urls', type=str, action='append',
+                        help='mockprock server url. Repeat to spread flows across several servers')
+    parser.add_argument('--client-id', dest='client_id', type=str, default='bench', help='mockprock oauth client id')
+    parser.add_argument('--client-secret', dest='client_secret', type=str, default='benchsecret',
+                        help='mockprock oauth client secret')
+    parser.add_argument('-n', dest='flows', type=int, default=100, help='number of exam flows to run')
+    parser.add_argument('-c', dest='concurrency', type=int, default=10, help='number of concurrent flows')
+    parser.add_argument('--lms-port', dest='lms_port', type=int, default=18001,
+                        help='port for the stand-in LMS. Start the server with -l http://127.0.0.1:PORT')
+    parser.add_argument('--wait', dest='wait', type=float, default=DEFAULT_WAIT_SECONDS,
+                        help='most seconds to wait for review callbacks after the flows finish. '
+                             '0 stops the LMS straight away, before most reviews arrive')
+    args = parser.parse_args()
+
+    lms = FakeLMS(port=args.lms_port).start()
+    timings = Timings()
+    clients = [
+        BenchClient(url, args.client_id, args.client_secret, lms.url, timings)
+        for url in args.urls or ['http://127.0.0.1:11136']
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        completed = sum(executor.map(lambda number: clients[number % len(clients)].try_flow(number), range(args.flows)))
+    elapsed = time.perf_counter() - start
+    if not args.wait:
+        print('Not waiting for review callbacks, so the LMS will miss those still to come', file=sys.stderr)
+    elif not lms.wait_for('reviewed', completed, args.wait):
+        print('Stopped waiting for review callbacks after %.0fs' % args.wait, file=sys.stderr)
+    lms.stop()
+
+    print('%d of %d flows completed in %.2fs (%.1f flows/s)' % (completed, args.flows, elapsed, completed / elapsed))
+    print(timings.report(elapsed))
+    print('LMS received %d ready and %d reviewed callbacks, %d token requests' % (
+        lms.count('ready'), lms.count('reviewed'), lms.token_requests))
+    duplicates = lms.duplicates('ready') + lms.duplicates('reviewed')
+    if duplicates:
+        print('%d callbacks were delivered more than once' % duplicates)
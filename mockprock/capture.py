@@ -0,0 +1,165 @@
+"""
+Opt-in recording of the traffic a server handles, for replaying with mockprock-replay
+
+Enable it with --capture FILE. Each request the LMS or a student makes is
+written as one line of JSON (NDJSON, gzipped if FILE ends in .gz), along with
+every callback sent back to the LMS:
+
+    {"type": "request", "t": 1.52, "method": "PATCH", "route": "/api/v1/exam/<exam_id>/attempt/<attempt_id>/",
+     "path": "/api/v1/exam/ab12/attempt/cd34/", "query": {}, "body": {"status": "submitted"},
+     "status": 200, "ms": 3.1, "ids": []}
+    {"type": "callback", "t": 11.53, "name": "review", "attempt_id": "cd34", "result": "success", "ms": 12.4}
+
+t is seconds since the capture started, when the request arrived or the
+callback was sent. ids lists the ids the response created, so a replay can map
+them to the ids the replayed server hands out. Credentials are never written:
+token requests are recorded without their form, and requests are recorded
+without their headers. NDJSON bulk uploads are recorded without their body,
+since the handler streams it.
+
+Compressed captures are flushed every FLUSH_SECONDS, so a server that is
+killed without exiting cleanly leaves a capture that reads up to that point.
+"""
+import atexit
+import copy
+import gzip
+import json
+import threading
+import time
+
+from flask import g, request
+
+# endpoints that aren't part of the exam traffic, or that can't be replayed without credentials
+SKIPPED_ENDPOINTS = {
+    'static',
+    'metrics',
+    'dump_profile',
+    'attempt_events',
+    'instructor_dashboard',
+}
+
+# most seconds between flushes of a compressed capture
+FLUSH_SECONDS = 1
+
+
+def open_capture(path, mode='r'):
+    """
+    Opens a capture file for text, compressed if its name ends in .gz
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf8')
+    return open(path, mode, encoding='utf8')
+
+
+def read_capture(path):
+    """
+    Yields the records in a capture file, up to the last complete one if it was cut short
+    """
+    with open_capture(path) as capture_file:
+        try:
+            for line in capture_file:
+                if not line.endswith('\n'):
+                    break
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except EOFError:
+            # a compressed capture that was never closed
+            pass
+
+
+def response_ids(response):
+    """
+    Returns the ids created by a response: the id of a created exam or attempt, or the ids of a bulk create
+    """
+    if request.method != 'POST' or not response.is_json:
+        return []
+    data = response.get_json(silent=True)
+    if not isinstance(data, dict):
+        return []
+    if 'ids' in data:
+        return list(data['ids'])
+    return [data['id']] if 'id' in data else []
+
+
+class Recorder:
+    """
+    Writes capture records to a file, one JSON object per line
+    """
+    def __init__(self, path):
+        self.path = path
+        self.compressed = path.endswith('.gz')
+        self._file = open_capture(path, 'w')
+        self._lock = threading.Lock()
+        self.started = self._flushed = time.perf_counter()
+        self.records = 0
+        self.write({'type': 'start', 'time': time.time()})
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            # gzip compresses better in larger blocks
+            now = time.perf_counter()
+            if not self.compressed or now - self._flushed >= FLUSH_SECONDS:
+                self._file.flush()
+                self._flushed = now
+            self.records += 1
+
+    def record_request(self, start, route, status, body, ids):
+        self.write({
+            'type': 'request',
+            't': round(start - self.started, 6),
+            'method': request.method,
+            'route': route,
+            'path': request.path,
+            'query': request.args.to_dict(),
+            'body': body,
+            'status': status,
+            'ms': round((time.perf_counter() - start) * 1000, 3),
+            'ids': ids,
+        })
+
+    def record_callback(self, start, name, attempt_id, result):
+        self.write({
+            'type': 'callback',
+            't': round(start - self.started, 6),
+            'name': name,
+            'attempt_id': attempt_id,
+            'result': result,
+            'ms': round((time.perf_counter() - start) * 1000, 3),
+        })
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def init_app(app, path):
+    """
+    Records the app's requests to the capture file at path, and sets app.capture.
+    The server records its callbacks with app.capture.record_callback.
+    """
+    recorder = app.capture = Recorder(path)
+    atexit.register(recorder.close)
+
+    @app.before_request
+    def start_capture():
+        g.capture_start = time.perf_counter()
+        # copied before the handler adds ids to it
+        g.capture_body = copy.deepcopy(request.get_json(silent=True)) if request.is_json else None
+
+    @app.after_request
+    def capture_request(response):
+        start = g.pop('capture_start', None)
+        if start is None or request.endpoint in SKIPPED_ENDPOINTS:
+            return response
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        recorder.record_request(start, route, response.status_code, g.pop('capture_body', None), response_ids(response))
+        return response
+
+    return recorder
@@ -1,68 +1,623 @@
-from collections import namedtuple
-from contextlib import closing
+from contextlib import closing, contextmanager
+import datetime
+import itertools
 import json
+import queue
 import sqlite3
+import threading
+import time
 import uuid
 
+from mockprock.metrics import instrument_db
 
-def namedtuple_factory(cursor, row):
-    """Returns sqlite rows as named tuples."""
-    fields = [col[0] for col in cursor.description]
-    Row = namedtuple("Row", fields)
-    return Row(*row)
+# number of idle connections kept open for reuse
+DEFAULT_POOL_SIZE = 8
 
-def init_app(app):
-    app.db = DB('mockprock.sqlite', app.logger)
+
+# The keys of the dicts returned by DB methods, mapped to the columns they come from
+EXAM_KEYS = {'id': 'id', 'name': 'name', 'course_id': 'course_id'}
+EXAM_LIST_KEYS = dict(EXAM_KEYS, is_practice='is_practice', created='created')
+ATTEMPT_KEYS = {
+    'id': 'id',
+    'status': 'status',
+    'exam_id': 'exam_id',
+    'lms_host': 'lms_host',
+    'user_id': 'user_id',
+    'email': 'user_email',
+}
+ATTEMPT_COLUMNS = ', '.join(ATTEMPT_KEYS.values())
+# what claim_callbacks returns of each callback
+CLAIMED_CALLBACK_KEYS = ('id', 'kind', 'url', 'payload', 'attempts')
+
+
+# The statuses an attempt can have, and the statuses each may change to. The LMS
+# creates attempts, and starts, submits them or marks them as errors. mockprock's
+# callbacks make them ready and reviewed. Any attempt that isn't final may also
+# change to 'error', and no attempt leaves a final status. Attempts the LMS
+# created with some other status may change like created ones.
+ATTEMPT_TRANSITIONS = {
+    'created': {'ready', 'started', 'submitted'},
+    'ready': {'started', 'submitted'},
+    'started': {'ready', 'submitted'},
+    'submitted': {'reviewed'},
+    'reviewed': set(),
+    'error': set(),
+}
+FINAL_ATTEMPT_STATUSES = {'reviewed', 'error'}
+
+# percentiles of the time attempts spend in each status
+STATUS_PERCENTILES = (50, 95, 99)
+
+
+class InvalidTransition(ValueError):
+    """
+    Raised when an attempt can't change from its current status to the requested one
+    """
+
+
+def check_transition(current, status):
+    """
+    Raises InvalidTransition unless an attempt in the current status may change to status
+    """
+    if current == status:
+        return
+    if status not in ATTEMPT_TRANSITIONS:
+        raise InvalidTransition('Unknown attempt status %r' % status)
+    allowed = ATTEMPT_TRANSITIONS.get(current, ATTEMPT_TRANSITIONS['created'])
+    if current in FINAL_ATTEMPT_STATUSES or (status not in allowed and status != 'error'):
+        raise InvalidTransition("Can't change attempt status from %r to %r" % (current, status))
+
+
+def text(value):
+    """
+    Returns the value as stored in a TEXT column
+    """
+    return value if value is None else str(value)
+
+
+def project(row, keys, rules=False):
+    """
+    Copies the columns of a row (a sqlite3.Row or a dict) into a new dict with the given keys.
+    The JSON rules column is only decoded if rules is True.
+    """
+    result = {key: row[column] for key, column in keys.items()}
+    if rules:
+        result['rules'] = json.loads(row['rules'])
+    return result
+
+
+# Schema migrations, applied in order. The index of each script (plus one) is
+# the schema version stored in PRAGMA user_version. Only append to this list.
+MIGRATIONS = [
+    # 1: initial tables
+    '''
+    CREATE TABLE IF NOT EXISTS exams (
+        id TEXT PRIMARY KEY,
+        course_id TEXT,
+        name TEXT,
+        is_practice BOOL,
+        rules TEXT,
+        created TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS attempts (
+        id TEXT PRIMARY KEY,
+        exam_id TEXT,
+        status TEXT,
+        user_id TEXT,
+        user_name TEXT,
+        user_email TEXT,
+        created TIMESTAMP,
+        modified TIMESTAMP,
+        lms_host TEXT
+    )''',
+    # 2: secondary indexes for dashboard and attempt lookups
+    '''
+    CREATE INDEX IF NOT EXISTS exams_course_id ON exams (course_id);
+    CREATE INDEX IF NOT EXISTS attempts_exam_id ON attempts (exam_id);
+    CREATE INDEX IF NOT EXISTS attempts_status ON attempts (status);
+    CREATE INDEX IF NOT EXISTS attempts_user_id ON attempts (user_id)''',
+    # 3: outbound callbacks waiting to be delivered to the LMS
+    '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT,
+        url TEXT,
+        payload TEXT,
+        attempts INTEGER DEFAULT 0,
+        next_attempt REAL,
+        claimed_until REAL,
+        last_error TEXT,
+        created TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt)''',
+    # 4: emulated desktop application state, shared by all server processes
+    '''
+    CREATE TABLE IF NOT EXISTS desktop_sessions (
+        id TEXT PRIMARY KEY,
+        status TEXT,
+        modified TIMESTAMP
+    )''',
+    # 5: keyset pagination of exams within a course
+    '''
+    CREATE INDEX IF NOT EXISTS exams_course_id_id ON exams (course_id, id);
+    DROP INDEX IF EXISTS exams_course_id''',
+    # 6: the node holding each callback's lease, so nodes sharing the database
+    # only complete or retry the callbacks they claimed
+    '''
+    ALTER TABLE outbox ADD COLUMN claimed_by TEXT''',
+    # 7: append-only history of attempt statuses, starting from each attempt's current one
+    '''
+    CREATE TABLE IF NOT EXISTS attempt_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        attempt_id TEXT,
+        exam_id TEXT,
+        status TEXT,
+        created REAL
+    );
+    CREATE INDEX IF NOT EXISTS attempt_events_attempt_id ON attempt_events (attempt_id, id);
+    CREATE INDEX IF NOT EXISTS attempt_events_exam_id ON attempt_events (exam_id);
+    INSERT INTO attempt_events (attempt_id, exam_id, status, created)
+        SELECT id, exam_id, status, CAST(strftime('%s', modified) AS REAL) FROM attempts ORDER BY modified''',
+]
+
+
+def init_app(app, engine='sqlite', dbpath='mockprock.sqlite', pool_size=DEFAULT_POOL_SIZE):
+    if engine == 'memory':
+        app.db = MemoryDB(app.logger)
+    elif engine == 'sqlite':
+        app.db = SQLiteDB(dbpath, app.logger, pool_size=pool_size)
+    else:
+        raise ValueError('Unknown storage engine %r' % engine)
     app.db.setup()
+    if hasattr(app, 'db_latency'):
+        instrument_db(app.db, app.db_latency)
 
 
-class DB:
-    def __init__(self, dbpath, logger):
-        self.dbpath = dbpath
+def utcnow():
+    """Returns the current time formatted like sqlite's datetime('now')"""
+    return datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class BaseDB:
+    """
+    Storage interface for exams and attempts.
+    Methods return plain dicts, or an empty dict when nothing is found.
+    """
+    def __init__(self, logger):
         self.logger = logger
 
-    def connect(self):
-        conn = sqlite3.connect(self.dbpath)
-        conn.row_factory = namedtuple_factory
+    def setup(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_exam(self, exam_id, rules=True):
+        raise NotImplementedError
+
+    def save_exam(self, exam, client_id=None):
+        raise NotImplementedError
+
+    def get_attempt(self, exam_id, attempt_id):
+        raise NotImplementedError
+
+    def save_attempt(self, attempt):
+        raise NotImplementedError
+
+    def patch_attempt(self, exam_id, attempt_id, status=None):
+        """
+        Changes the status of the attempt, if a status is given.
+        Returns the updated attempt, or an empty dict if it doesn't exist.
+        Raises InvalidTransition if the attempt can't change to that status.
+        """
+        if status is None:
+            return self.get_attempt(exam_id, attempt_id)
+        return self.transition_attempt(attempt_id, status, exam_id=exam_id)
+
+    def transition_attempt(self, attempt_id, status, exam_id=None):
+        """
+        Changes the status of the attempt, recording the change in its history.
+        Returns the updated attempt, with its status before the change as previous_status,
+        or an empty dict if it doesn't exist (in the exam, if exam_id is given).
+        Raises InvalidTransition if the attempt can't change to that status.
+        """
+        raise NotImplementedError
+
+    def get_attempt_stats(self, course_id=None):
+        """
+        Returns the number of attempts in each status, and the count, mean, max and
+        percentiles of the seconds attempts spent in each status before changing,
+        optionally only for one course.
+        """
+        raise NotImplementedError
+
+    def save_exams(self, exams, client_id=None):
+        """
+        Saves an iterable of exams in one transaction, so an invalid exam saves none of them.
+        Returns the list of exam ids.
+        """
+        raise NotImplementedError
+
+    def save_attempts(self, attempts):
+        """
+        Creates attempts from an iterable in one transaction, so an invalid attempt creates none of them.
+        Returns the list of attempt ids.
+        """
+        raise NotImplementedError
+
+    def get_exams(self, course_id=None, limit=None, after=None, rules=True):
+        """
+        Yields exams ordered by id, optionally only for one course.
+        Pass the id of the last exam seen as `after` to get the next page.
+        """
+        raise NotImplementedError
+
+    def course_exists(self, course_id):
+        """
+        Returns whether there are any exams in the course
+        """
+        raise NotImplementedError
+
+    def enqueue_callback(self, kind, url, payload, delay=0):
+        """
+        Stores a callback to be delivered after delay seconds. Returns its id.
+        """
+        raise NotImplementedError
+
+    def claim_callbacks(self, limit, lease, owner=None):
+        """
+        Claims up to limit due callbacks for lease seconds on behalf of owner. Returns a list of dicts.
+        Callbacks that aren't completed or retried before the lease expires are claimed again.
+        """
+        raise NotImplementedError
+
+    def renew_callback(self, callback_id, lease, owner):
+        """
+        Extends owner's lease on a claimed callback to lease seconds from now.
+        Returns whether owner still held the lease.
+        """
+        raise NotImplementedError
+
+    def complete_callback(self, callback_id, owner=None):
+        """
+        Removes a delivered callback. If owner is given, only while owner holds its lease.
+        Returns whether the callback was removed.
+        """
+        raise NotImplementedError
+
+    def retry_callback(self, callback_id, delay, error, owner=None):
+        """
+        Releases the lease and schedules the callback again after delay seconds.
+        If owner is given, only while owner holds its lease. Returns whether the callback was updated.
+        """
+        raise NotImplementedError
+
+    def get_desktop_session(self, session_id):
+        """
+        Returns a dict with the status of the emulated desktop application and when it was set
+        """
+        raise NotImplementedError
+
+    def set_desktop_status(self, session_id, status):
+        raise NotImplementedError
+
+
+class MemoryDB(BaseDB):
+    """
+    Non-durable storage in lock-protected dicts, for tests and benchmarks
+    """
+    def __init__(self, logger):
+        super().__init__(logger)
+        self.lock = threading.RLock()
+        self.exams = {}
+        self.attempts = {}
+        self.outbox = {}
+        self.outbox_ids = itertools.count(1)
+        self.desktop_sessions = {}
+        self.attempt_events = []
+
+    def get_exam(self, exam_id, rules=True):
+        with self.lock:
+            row = self.exams.get(exam_id)
+        if row:
+            return project(row, EXAM_KEYS, rules)
+        return {}
+
+    def _exam_row(self, exam):
+        rules = json.dumps(exam.get('rules', {}))
+        exam_id = exam.get('external_id', None)
+        if not exam_id:
+            exam_id = exam['external_id'] = uuid.uuid4().hex
+        return {
+            'id': exam_id,
+            'course_id': exam['course_id'],
+            'name': exam['exam_name'],
+            'is_practice': exam['is_practice_exam'],
+            'rules': rules,
+        }
+
+    def _store_exam(self, row, client_id):
+        existing = self.exams.get(row['id'])
+        if existing:
+            existing.update(row)
+            self.logger.info('Updated exam %s from %s', row['id'], client_id)
+        else:
+            row['created'] = utcnow()
+            self.exams[row['id']] = row
+            self.logger.info('Saved exam %s from %s', row['id'], client_id)
+
+    def save_exam(self, exam, client_id=None):
+        row = self._exam_row(exam)
+        with self.lock:
+            self._store_exam(row, client_id)
+        return row['id']
+
+    def save_exams(self, exams, client_id=None):
+        # build every row before storing any, so an invalid exam stores none of them
+        rows = [self._exam_row(exam) for exam in exams]
+        with self.lock:
+            for row in rows:
+                self._store_exam(row, client_id)
+        return [row['id'] for row in rows]
+
+    def get_attempt(self, exam_id, attempt_id):
+        with self.lock:
+            row = self.attempts.get(attempt_id)
+            if row and row['exam_id'] == exam_id:
+                return project(row, ATTEMPT_KEYS)
+        return {}
+
+    def _new_attempt_row(self, attempt, now):
+        row = {
+            'id': uuid.uuid4().hex,
+            'exam_id': attempt['exam_id'],
+            'status': attempt['status'],
+            # like the sqlite column, which is TEXT
+            'user_id': text(attempt['user_id']),
+            'user_name': attempt['full_name'],
+            'user_email': attempt['email'],
+            'lms_host': attempt['lms_host'],
+            'created': now,
+            'modified': now,
+        }
+        attempt['id'] = row['id']
+        return row
+
+    def save_attempt(self, attempt):
+        attempt_id = attempt.get('id', None)
+        if attempt_id:
+            self.transition_attempt(attempt_id, attempt['status'])
+        else:
+            row = self._new_attempt_row(attempt, utcnow())
+            with self.lock:
+                self.attempts[row['id']] = row
+                self._add_event(row)
+        self.logger.info('Created attempt %s from %r', attempt['id'], attempt)
+        return attempt
+
+    def save_attempts(self, attempts):
+        now = utcnow()
+        # build every row before storing any, so an invalid attempt stores none of them
+        rows = [self._new_attempt_row(attempt, now) for attempt in attempts]
+        with self.lock:
+            for row in rows:
+                self.attempts[row['id']] = row
+                self._add_event(row)
+        self.logger.info('Created %d attempts', len(rows))
+        return [row['id'] for row in rows]
+
+    def _add_event(self, row):
+        self.attempt_events.append({
+            'attempt_id': row['id'],
+            'exam_id': row['exam_id'],
+            'status': row['status'],
+            'created': time.time(),
+        })
+
+    def transition_attempt(self, attempt_id, status, exam_id=None):
+        with self.lock:
+            row = self.attempts.get(attempt_id)
+            if not row or (exam_id is not None and row['exam_id'] != exam_id):
+                return {}
+            check_transition(row['status'], status)
+            previous_status = row['status']
+            if previous_status != status:
+                row['status'] = status
+                row['modified'] = utcnow()
+                self._add_event(row)
+            return dict(project(row, ATTEMPT_KEYS), previous_status=previous_status)
+
+    def get_attempt_stats(self, course_id=None):
+        with self.lock:
+            exam_ids = None
+            if course_id:
+                exam_ids = {row['id'] for row in self.exams.values() if row['course_id'] == course_id}
+            counts = {}
+            for row in self.attempts.values():
+                if exam_ids is None or row['exam_id'] in exam_ids:
+                    counts[row['status']] = counts.get(row['status'], 0) + 1
+            last_events = {}
+            durations = {}
+            for event in self.attempt_events:
+                if exam_ids is not None and event['exam_id'] not in exam_ids:
+                    continue
+                previous = last_events.get(event['attempt_id'])
+                if previous:
+                    durations.setdefault(previous['status'], []).append(event['created'] - previous['created'])
+                last_events[event['attempt_id']] = event
+        time_in_status = {}
+        for status, seconds in durations.items():
+            seconds.sort()
+            summary = {'count': len(seconds), 'mean': sum(seconds) / len(seconds), 'max': seconds[-1]}
+            for pct in STATUS_PERCENTILES:
+                summary['p%d' % pct] = seconds[(len(seconds) * pct + 99) // 100 - 1]
+            time_in_status[status] = summary
+        return {'statuses': counts, 'time_in_status': time_in_status}
+
+    def get_exams(self, course_id=None, limit=None, after=None, rules=True):
+        with self.lock:
+            rows = sorted(
+                (row for row in self.exams.values()
+                 if (not course_id or row['course_id'] == course_id) and (after is None or row['id'] > after)),
+                key=lambda row: row['id'])
+        for row in rows[:limit]:
+            yield project(row, EXAM_LIST_KEYS, rules)
+
+    def course_exists(self, course_id):
+        with self.lock:
+            return any(row['course_id'] == course_id for row in self.exams.values())
+
+    def enqueue_callback(self, kind, url, payload, delay=0):
+        with self.lock:
+            callback_id = next(self.outbox_ids)
+            self.outbox[callback_id] = {
+                'id': callback_id,
+                'kind': kind,
+                'url': url,
+                'payload': payload,
+                'attempts': 0,
+                'next_attempt': time.time() + delay,
+                'claimed_until': None,
+                'claimed_by': None,
+                'last_error': None,
+            }
+        return callback_id
+
+    def claim_callbacks(self, limit, lease, owner=None):
+        now = time.time()
+        with self.lock:
+            due = [
+                row for row in self.outbox.values()
+                if row['next_attempt'] <= now and (row['claimed_until'] is None or row['claimed_until'] < now)
+            ]
+            due.sort(key=lambda row: row['next_attempt'])
+            claimed = []
+            for row in due[:limit]:
+                row['claimed_until'] = now + lease
+                row['claimed_by'] = owner
+                claimed.append({key: row[key] for key in CLAIMED_CALLBACK_KEYS})
+        return claimed
+
+    def _holds_lease(self, callback_id, owner):
+        row = self.outbox.get(callback_id)
+        return row is not None and (owner is None or row['claimed_by'] == owner)
+
+    def renew_callback(self, callback_id, lease, owner):
+        with self.lock:
+            if not self._holds_lease(callback_id, owner):
+                return False
+            self.outbox[callback_id]['claimed_until'] = time.time() + lease
+            return True
+
+    def complete_callback(self, callback_id, owner=None):
+        with self.lock:
+            if not self._holds_lease(callback_id, owner):
+                return False
+            del self.outbox[callback_id]
+            return True
+
+    def retry_callback(self, callback_id, delay, error, owner=None):
+        with self.lock:
+            if not self._holds_lease(callback_id, owner):
+                return False
+            row = self.outbox[callback_id]
+            row['attempts'] += 1
+            row['next_attempt'] = time.time() + delay
+            row['claimed_until'] = None
+            row['claimed_by'] = None
+            row['last_error'] = error
+            return True
+
+    def get_desktop_session(self, session_id):
+        with self.lock:
+            session = self.desktop_sessions.get(session_id)
+            return dict(session) if session else {}
+
+    def set_desktop_status(self, session_id, status):
+        with self.lock:
+            self.desktop_sessions[session_id] = {'status': status, 'modified': utcnow()}
+
+
+class SQLiteDB(BaseDB):
+    # applied to every new connection. WAL lets readers keep polling attempts
+    # while another thread is writing, and NORMAL sync is durable enough in WAL mode
+    pragmas = (
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA cache_size = -16000',
+        'PRAGMA temp_store = MEMORY',
+    )
+
+    upsert_exam_sql = """insert into exams (id, course_id, name, is_practice, rules, created)
+    values (?, ?, ?, ?, ?, datetime('now'))
+    on conflict (id) do update set
+        course_id = excluded.course_id, name = excluded.name, is_practice = excluded.is_practice, rules = excluded.rules"""
+
+    def __init__(self, dbpath, logger, pool_size=DEFAULT_POOL_SIZE):
+        super().__init__(logger)
+        self.dbpath = dbpath
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _open(self):
+        conn = sqlite3.connect(self.dbpath, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.pragmas:
+            conn.execute(pragma)
         return conn
 
+    @contextmanager
+    def connect(self):
+        """
+        Checks out a connection from the pool for the calling thread.
+        The transaction is committed (or rolled back) on exit, and the
+        connection is returned to the pool for the next caller.
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        try:
+            with conn:
+                yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        """
+        Closes all idle pooled connections
+        """
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
     def setup(self):
-        create_sql = '''
-        CREATE TABLE IF NOT EXISTS exams (
-            id TEXT PRIMARY KEY,
-            course_id TEXT,
-            name TEXT,
-            is_practice BOOL,
-            rules TEXT,
-            created TIMESTAMP
-        );
-        CREATE TABLE IF NOT EXISTS attempts (
-            id TEXT PRIMARY KEY,
-            exam_id TEXT,
-            status TEXT,
-            user_id TEXT,
-            user_name TEXT,
-            user_email TEXT,
-            created TIMESTAMP,
-            modified TIMESTAMP,
-            lms_host TEXT
-        );'''.split(';')
-        with self.connect() as conn:
-            for stmt in create_sql:
-                conn.execute(stmt)
-
-    def get_exam(self, exam_id):
+        """
+        Creates the schema, or upgrades an existing database in place.
+        Migrations run in one transaction, so a failed upgrade leaves the schema as it was.
+        """
         with self.connect() as conn:
-            with closing(conn.cursor()) as c:
-                c.execute('select * from exams where id = ?', (exam_id,))
-                row = c.fetchone()
-                if row:
-                    return {
-                        'id': row.id,
-                        'name': row.name,
-                        'course_id': row.course_id,
-                        'rules': json.loads(row.rules),
-                    }
+            # several processes or nodes may start on the same file at once:
+            # hold the write lock from reading the schema version until it's updated
+            conn.execute('begin exclusive')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for version, script in enumerate(MIGRATIONS[version:], version + 1):
+                for stmt in script.split(';'):
+                    conn.execute(stmt)
+                conn.execute('PRAGMA user_version = %d' % version)
+                self.logger.info('Migrated %s to schema version %d', self.dbpath, version)
+
+    def get_exam(self, exam_id, rules=True):
+        columns = 'id, name, course_id, rules' if rules else 'id, name, course_id'
+        with self.connect() as conn:
+            row = conn.execute('select %s from exams where id = ?' % columns, (exam_id,)).fetchone()
+        if row:
+            return project(row, EXAM_KEYS, rules)
         return {}
 
     def save_exam(self, exam, client_id=None):
@@ -71,64 +626,207 @@ class DB:
         exam_id = exam.get('external_id', None)
         if not exam_id:
             exam_id = exam['external_id'] = uuid.uuid4().hex
+        pars = (exam_id, exam['course_id'], exam['exam_name'], exam['is_practice_exam'], rules)
         with self.connect() as conn:
-            pars = (exam_id, exam['course_id'], exam['exam_name'], exam['is_practice_exam'], rules)
-            try:
-                conn.execute("insert into exams (id, course_id, name, is_practice, rules, created) values (?, ?, ?, ?, ?, datetime('now'))", pars)
-                self.logger.info('Saved exam %s from %s', exam_id, client_id)
-            except sqlite3.IntegrityError:
-                pars = (exam['course_id'], exam['exam_name'], exam['is_practice_exam'], rules, exam_id)
-                stmt = 'update exams set course_id = ?, name = ?, is_practice = ?, rules = ? where id = ?'
-                conn.execute(stmt, pars)
-                self.logger.info('Updated exam %s from %s', exam_id, client_id)
+            conn.execute(self.upsert_exam_sql, pars)
+        self.logger.info('Saved exam %s from %s', exam_id, client_id)
         return exam_id
 
+    def save_exams(self, exams, client_id=None):
+        exam_ids = []
+
+        def rows():
+            for exam in exams:
+                exam_id = exam.get('external_id', None)
+                if not exam_id:
+                    exam_id = exam['external_id'] = uuid.uuid4().hex
+                exam_ids.append(exam_id)
+                yield (exam_id, exam['course_id'], exam['exam_name'], exam['is_practice_exam'],
+                       json.dumps(exam.get('rules', {})))
+
+        with self.connect() as conn:
+            conn.executemany(self.upsert_exam_sql, rows())
+        self.logger.info('Saved %d exams from %s', len(exam_ids), client_id)
+        return exam_ids
+
+    def save_attempts(self, attempts):
+        stmt = """insert into attempts (id, exam_id, status, user_id, user_name, user_email, lms_host, created, modified)
+        values (?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))"""
+        events = []
+        now = time.time()
+
+        def rows():
+            for attempt in attempts:
+                attempt_id = attempt['id'] = uuid.uuid4().hex
+                events.append((attempt_id, attempt['exam_id'], attempt['status'], now))
+                yield (attempt_id, attempt['exam_id'], attempt['status'], attempt['user_id'],
+                       attempt['full_name'], attempt['email'], attempt['lms_host'])
+
+        with self.connect() as conn:
+            conn.executemany(stmt, rows())
+            conn.executemany(self.insert_event_sql, events)
+        self.logger.info('Created %d attempts', len(events))
+        return [event[0] for event in events]
+
     def get_attempt(self, exam_id, attempt_id):
+        stmt = 'select %s from attempts where id = ? and exam_id = ?' % ATTEMPT_COLUMNS
         with self.connect() as conn:
-            with closing(conn.cursor()) as c:
-                c.execute('select id, status, exam_id, lms_host, user_id, user_email from attempts where id = ? and exam_id = ?', (attempt_id, exam_id))
-                row = c.fetchone()
-                if row:
-                    return {
-                        'id': row.id,
-                        'status': row.status,
-                        'exam_id': row.exam_id,
-                        'lms_host': row.lms_host,
-                        'user_id': row.user_id,
-                        'email': row.user_email,
-                    }
+            row = conn.execute(stmt, (attempt_id, exam_id)).fetchone()
+        if row:
+            return project(row, ATTEMPT_KEYS)
         return {}
 
+    insert_event_sql = 'insert into attempt_events (attempt_id, exam_id, status, created) values (?, ?, ?, ?)'
+
     def save_attempt(self, attempt):
         attempt_id = attempt.get('id', None)
         if attempt_id:
-            stmt = "update attempts set status = ?, modified = datetime('now') where id = ?"
-            pars = (attempt['status'], attempt_id)
-        else:
-            attempt_id = attempt['id'] = uuid.uuid4().hex
-            stmt = """insert into attempts (id, exam_id, status, user_id, user_name, user_email, lms_host, created, modified) 
-            values (?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))"""
-            pars = (attempt_id, attempt['exam_id'], attempt['status'], attempt['user_id'],
-                attempt['full_name'], attempt['email'], attempt['lms_host'])
+            self.transition_attempt(attempt_id, attempt['status'])
+            return attempt
+        attempt_id = attempt['id'] = uuid.uuid4().hex
+        stmt = """insert into attempts (id, exam_id, status, user_id, user_name, user_email, lms_host, created, modified) 
+        values (?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))"""
+        pars = (attempt_id, attempt['exam_id'], attempt['status'], attempt['user_id'],
+            attempt['full_name'], attempt['email'], attempt['lms_host'])
         with self.connect() as conn:
             conn.execute(stmt, pars)
+            conn.execute(self.insert_event_sql, (attempt_id, attempt['exam_id'], attempt['status'], time.time()))
         self.logger.info('Created attempt %s from %r', attempt_id, attempt)
         return attempt
 
-    def get_exams(self, course_id=None):
+    def transition_attempt(self, attempt_id, status, exam_id=None):
+        stmt = 'select %s from attempts where id = ? and (? is null or exam_id = ?)' % ATTEMPT_COLUMNS
+        with self.connect() as conn:
+            # take the write lock before reading, so the status can't change under the check
+            conn.execute('begin immediate')
+            row = conn.execute(stmt, (attempt_id, exam_id, exam_id)).fetchone()
+            if not row:
+                return {}
+            attempt = project(row, ATTEMPT_KEYS)
+            check_transition(attempt['status'], status)
+            attempt['previous_status'] = attempt['status']
+            if attempt['status'] != status:
+                conn.execute("update attempts set status = ?, modified = datetime('now') where id = ?", (status, attempt_id))
+                conn.execute(self.insert_event_sql, (attempt_id, attempt['exam_id'], status, time.time()))
+                attempt['status'] = status
+        return attempt
+
+    def get_attempt_stats(self, course_id=None):
+        # only filter when there's a course, so that sqlite can search the exam_id indexes
+        course_filter, pars = '', ()
         if course_id:
-            stmt, pars = 'select * from exams where course_id = ?', [course_id]
-        else:
-            stmt, pars = 'select * from exams', []
+            course_filter = 'where exam_id in (select id from exams where course_id = ?)'
+            pars = (course_id,)
+        counts_stmt = 'select status, count(*) as count from attempts %s group by status' % course_filter
+        # each event's status lasted until the attempt's next event. The percentiles are nearest-rank,
+        # the smallest duration at or above the ceil(total * pct / 100)th position
+        percentiles = ', '.join(
+            'min(case when position >= (total * {0} + 99) / 100 then seconds end) as p{0}'.format(pct)
+            for pct in STATUS_PERCENTILES
+        )
+        durations_stmt = """
+        with spans as (
+            select status, lead(created) over (partition by attempt_id order by id) - created as seconds
+            from attempt_events %s
+        ), ranked as (
+            select status, seconds,
+                row_number() over (partition by status order by seconds) as position,
+                count(*) over (partition by status) as total
+            from spans where seconds is not null
+        )
+        select status, count(*) as count, avg(seconds) as mean, max(seconds) as max, %s
+        from ranked group by status""" % (course_filter, percentiles)
+        with self.connect() as conn:
+            counts = {row['status']: row['count'] for row in conn.execute(counts_stmt, pars)}
+            time_in_status = {}
+            for row in conn.execute(durations_stmt, pars):
+                summary = dict(row)
+                time_in_status[summary.pop('status')] = summary
+        return {'statuses': counts, 'time_in_status': time_in_status}
+
+    def get_exams(self, course_id=None, limit=None, after=None, rules=True):
+        clauses, pars = [], []
+        if course_id:
+            clauses.append('course_id = ?')
+            pars.append(course_id)
+        if after is not None:
+            clauses.append('id > ?')
+            pars.append(after)
+        columns = ', '.join(EXAM_LIST_KEYS.values())
+        if rules:
+            columns += ', rules'
+        stmt = 'select %s from exams' % columns
+        if clauses:
+            stmt += ' where ' + ' and '.join(clauses)
+        stmt += ' order by id'
+        if limit is not None:
+            stmt += ' limit ?'
+            pars.append(limit)
         with self.connect() as conn:
             with closing(conn.cursor()) as c:
                 c.execute(stmt, pars)
                 for row in c:
-                    yield {
-                        'id': row.id,
-                        'name': row.name,
-                        'course_id': row.course_id,
-                        'is_practice': row.is_practice,
-                        'rules': json.loads(row.rules),
-                        'created': row.created
-                    }
+                    yield project(row, EXAM_LIST_KEYS, rules)
+
+    def course_exists(self, course_id):
+        with self.connect() as conn:
+            row = conn.execute('select 1 as found from exams where course_id = ? limit 1', (course_id,)).fetchone()
+        return row is not None
+
+    def enqueue_callback(self, kind, url, payload, delay=0):
+        stmt = """insert into outbox (kind, url, payload, next_attempt, created)
+        values (?, ?, ?, ?, datetime('now'))"""
+        with self.connect() as conn:
+            cursor = conn.execute(stmt, (kind, url, json.dumps(payload), time.time() + delay))
+            return cursor.lastrowid
+
+    def claim_callbacks(self, limit, lease, owner=None):
+        now = time.time()
+        stmt = """update outbox set claimed_until = ?, claimed_by = ?
+        where id in (
+            select id from outbox
+            where next_attempt <= ? and (claimed_until is null or claimed_until < ?)
+            order by next_attempt limit ?
+        )
+        returning %s""" % ', '.join(CLAIMED_CALLBACK_KEYS)
+        with self.connect() as conn:
+            with closing(conn.cursor()) as c:
+                c.execute(stmt, (now + lease, owner, now, now, limit))
+                return [
+                    dict(row, payload=json.loads(row['payload']))
+                    for row in c.fetchall()
+                ]
+
+    def renew_callback(self, callback_id, lease, owner):
+        stmt = 'update outbox set claimed_until = ? where id = ? and claimed_by is ?'
+        with self.connect() as conn:
+            return conn.execute(stmt, (time.time() + lease, callback_id, owner)).rowcount > 0
+
+    def complete_callback(self, callback_id, owner=None):
+        stmt = 'delete from outbox where id = ? and (? is null or claimed_by = ?)'
+        with self.connect() as conn:
+            return conn.execute(stmt, (callback_id, owner, owner)).rowcount > 0
+
+    def retry_callback(self, callback_id, delay, error, owner=None):
+        stmt = """update outbox set attempts = attempts + 1, next_attempt = ?,
+            claimed_until = null, claimed_by = null, last_error = ?
+        where id = ? and (? is null or claimed_by = ?)"""
+        with self.connect() as conn:
+            return conn.execute(stmt, (time.time() + delay, error, callback_id, owner, owner)).rowcount > 0
+
+    def get_desktop_session(self, session_id):
+        with self.connect() as conn:
+            row = conn.execute('select status, modified from desktop_sessions where id = ?', (session_id,)).fetchone()
+        if row:
+            return dict(row)
+        return {}
+
+    def set_desktop_status(self, session_id, status):
+        stmt = """insert into desktop_sessions (id, status, modified) values (?, ?, datetime('now'))
+        on conflict (id) do update set status = excluded.status, modified = excluded.modified"""
+        with self.connect() as conn:
+            conn.execute(stmt, (session_id, status))
+
+
+# the sqlite engine was the only storage before engines were pluggable
+DB = SQLiteDB
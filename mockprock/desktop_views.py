@@ -1,14 +1,15 @@
 """
 These endpoints emulate a desktop proctoring application
 They support starting a session, stopping a session, and pinging for availability
+
+Each attempt gets its own session, identified by the `attempt` query parameter.
+Requests without one share a single default session.
 """
-from flask import Blueprint, jsonify
-import time
+from flask import Blueprint, current_app, jsonify, request
 
-fake_application = Blueprint(__name__, 'mockprock')
+from mockprock.proctoring import DESKTOP_HEADERS, desktop_session_id, ping_desktop, start_desktop, stop_desktop
 
-# this assumes there's only one application "running". haha
-fake_application.desktop_status = None
+fake_application = Blueprint(__name__, 'mockprock')
 
 
 @fake_application.after_request
@@ -16,25 +17,24 @@ def allow_crossorigin_requests(response):
     """
     Since these are ajax requests, we need to allow cross site access
     """
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Cache-Control'] = 'no-cache'
+    response.headers.update(DESKTOP_HEADERS)
     return response
 
 
 @fake_application.route('/desktop/ping')
 def ping():
-    return jsonify({'status': fake_application.desktop_status})
+    return jsonify(ping_desktop(current_app.db, desktop_session_id(request.args)))
 
 
 @fake_application.route('/desktop/start', methods=['POST'])
 def start():
-    fake_application.desktop_status = 'running'
-    return jsonify({'status': fake_application.desktop_status})
+    return jsonify(start_desktop(current_app.db, desktop_session_id(request.args)))
 
 
 @fake_application.route('/desktop/stop', methods=['POST'])
 def stop():
-    fake_application.desktop_status = 'uploading'
-    time.sleep(60)
-    return jsonify({'status': fake_application.desktop_status})
-
+    """
+    Starts uploading the session and returns immediately.
+    Poll /desktop/ping to see when the upload has finished.
+    """
+    return jsonify(stop_desktop(current_app.db, desktop_session_id(request.args)))
@@ -0,0 +1,128 @@
+"""
+In-process fan-out of attempt status changes, for the attempt event streams
+
+Every status change made by this process (attempt created or patched, ready
+and review callbacks delivered) is pushed straight to the watchers of that
+attempt, so watching doesn't poll storage. With --workers or --cluster,
+a watcher only hears about changes made by the process it's connected to,
+so the streams also poll storage for changes made by the others.
+"""
+import asyncio
+import json
+import queue
+import threading
+import time
+
+from mockprock.db import FINAL_ATTEMPT_STATUSES
+
+# statuses after which nothing more happens to an attempt, ending its stream
+FINAL_STATUSES = FINAL_ATTEMPT_STATUSES
+
+# the status an attempt reaches when each kind of callback is delivered
+CALLBACK_STATUSES = {'ready': 'ready', 'review': 'reviewed'}
+
+
+def status_event(attempt_id, status):
+    """
+    Returns the event for the attempt changing to the status
+    """
+    return {'attempt_id': attempt_id, 'status': status, 'time': time.time()}
+
+
+def format_event(event):
+    """
+    Returns the event as a server-sent events message
+    """
+    return 'event: status\ndata: %s\n\n' % json.dumps(event)
+
+
+class StatusBroadcaster:
+    """
+    Calls every watcher of an attempt with each of its status changes.
+    Watchers are called on the publishing thread, so they mustn't block.
+    """
+    def __init__(self):
+        self._watchers = {}
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, attempt_id, notify):
+        with self._lock:
+            self._watchers.setdefault(attempt_id, set()).add(notify)
+        return notify
+
+    def unsubscribe(self, attempt_id, notify):
+        with self._lock:
+            watchers = self._watchers.get(attempt_id)
+            if watchers is not None:
+                watchers.discard(notify)
+                if not watchers:
+                    del self._watchers[attempt_id]
+
+    def publish(self, attempt_id, status):
+        event = status_event(attempt_id, status)
+        with self._lock:
+            self.published += 1
+            watchers = list(self._watchers.get(attempt_id, ()))
+        for notify in watchers:
+            notify(event)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'attempts': len(self._watchers),
+                'watchers': sum(len(watchers) for watchers in self._watchers.values()),
+                'published': self.published,
+            }
+
+
+class Watcher:
+    """
+    Buffers the events for one stream, for a thread to read.
+    A watcher that falls more than maxsize events behind misses the newer ones,
+    rather than holding up the publisher.
+    """
+    def __init__(self, maxsize=100):
+        self.events = queue.Queue(maxsize)
+
+    def __call__(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            pass
+
+    def get(self, timeout):
+        """
+        Returns the next event, or None if there wasn't one within timeout seconds
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncWatcher:
+    """
+    Buffers the events for one stream, for a coroutine on the given event loop to read
+    """
+    def __init__(self, loop, maxsize=100):
+        self.loop = loop
+        self.events = asyncio.Queue(maxsize)
+
+    def __call__(self, event):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self, timeout):
+        """
+        Returns the next event, or None if there wasn't one within timeout seconds
+        """
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
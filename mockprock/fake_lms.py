@@ -0,0 +1,103 @@
+"""
+A stand-in LMS that accepts the callbacks mockprock sends, for benchmarks and replays.
+
+It hands out access tokens on /oauth2/access_token, and records every
+ready and reviewed callback it receives.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+
+CALLBACK_RE = re.compile(r'^/api/edx_proctoring/v1/proctored_exam/attempt/(?P<attempt_id>[^/]+)/(?P<kind>ready|reviewed)$')
+
+
+class FakeLMSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        match = CALLBACK_RE.match(self.path)
+        if self.path.startswith('/oauth2/access_token'):
+            self.server.lms.token_requests += 1
+            response = {'access_token': 'fake-lms-token', 'expires_in': 3600}
+        elif match:
+            self.server.lms.record(match.group('kind'), match.group('attempt_id'), body)
+            response = {'status': 'ok'}
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(response).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class FakeLMS:
+    """
+    Runs the stand-in LMS in a background thread.
+    `callbacks` is a list of (time received, kind, attempt id, payload) tuples.
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), FakeLMSHandler)
+        self.server.daemon_threads = True
+        self.server.lms = self
+        self.callbacks = []
+        self.token_requests = 0
+        self._lock = threading.Lock()
+        self._received = threading.Condition(self._lock)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-lms', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, kind, attempt_id, body):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+        with self._received:
+            self.callbacks.append((time.time(), kind, attempt_id, payload))
+            self._received.notify_all()
+
+    def count(self, kind):
+        with self._lock:
+            return sum(1 for callback in self.callbacks if callback[1] == kind)
+
+    def duplicates(self, kind):
+        """
+        Returns the number of callbacks of the given kind received more than once for the same attempt
+        """
+        with self._lock:
+            attempt_ids = [callback[2] for callback in self.callbacks if callback[1] == kind]
+        return len(attempt_ids) - len(set(attempt_ids))
+
+    def wait_for(self, kind, count, timeout):
+        """
+        Waits until `count` callbacks of the given kind have arrived. Returns whether they did.
+        """
+        deadline = time.time() + timeout
+        with self._received:
+            while sum(1 for callback in self.callbacks if callback[1] == kind) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._received.wait(remaining)
+        return True
@@ -0,0 +1,210 @@
+"""
+Prometheus-style metrics, served in the text exposition format on /metrics
+
+Metrics are kept per process. With --workers, each worker reports its own.
+"""
+from bisect import bisect_left
+import functools
+import inspect
+import threading
+import time
+
+from flask import Response, g, request
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ('%s="%s"' % (key, escape_label_value(value)) for key, value in labels)
+    return '{%s}' % ','.join(pairs)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """
+        Yields (suffix, labels, value) tuples
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, format_labels(labels), repr(float(value))))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield '', labels, value
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. If func is given, it's called at collection time
+    and may return a number, or a dict of label tuples to numbers.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help_text, func=None, metric_type=None):
+        super().__init__(name, help_text)
+        self.func = func
+        self.type = metric_type or self.type
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.func:
+            value = self.func()
+            if isinstance(value, dict):
+                for labels, label_value in value.items():
+                    yield '', labels, label_value
+            elif value is not None:
+                yield '', (), value
+            return
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield '', labels, value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield '_bucket', labels + (('le', '+Inf' if bound == float('inf') else repr(bound)),), total
+            yield '_count', labels, total
+            yield '_sum', labels, counts[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def instrument_db(db, histogram):
+    """
+    Records the duration of every public method of the storage object in the histogram.
+    Generators are timed until they're exhausted.
+    """
+    def wrap(name, method):
+        def timed_generator(start, generator):
+            try:
+                yield from generator
+            finally:
+                histogram.observe(time.perf_counter() - start, method=name)
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            if inspect.isgenerator(result):
+                return timed_generator(start, result)
+            histogram.observe(time.perf_counter() - start, method=name)
+            return result
+        return timed
+
+    for name in dir(db):
+        method = getattr(db, name)
+        if not name.startswith('_') and name not in ('setup', 'close', 'connect') and inspect.ismethod(method):
+            setattr(db, name, wrap(name, method))
+
+
+def init_app(app):
+    """
+    Adds request instrumentation and the /metrics endpoint to the app
+    """
+    registry = app.metrics = Registry()
+    app.request_count = registry.register(Counter(
+        'mockprock_requests_total', 'HTTP requests by route, method and status'))
+    app.request_latency = registry.register(Histogram(
+        'mockprock_request_seconds', 'HTTP request latency by route'))
+    app.db_latency = registry.register(Histogram(
+        'mockprock_db_seconds', 'Storage call latency by method'))
+    app.callback_count = registry.register(Counter(
+        'mockprock_callbacks_total', 'Callbacks sent to the LMS by kind, host and result'))
+    app.callback_latency = registry.register(Histogram(
+        'mockprock_callback_seconds', 'Callback round trip latency by LMS host'))
+    app.callbacks_in_flight = registry.register(Gauge(
+        'mockprock_callbacks_in_flight', 'Callbacks waiting for the LMS to respond'))
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = getattr(g, 'request_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            app.request_latency.observe(time.perf_counter() - start, route=route)
+            app.request_count.inc(route=route, method=request.method, status=response.status_code)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,141 @@
+"""
+Delivers callbacks stored in the database outbox, retrying failures with
+exponential backoff. Pending callbacks survive a restart and are picked
+up again when the worker starts.
+
+Several processes, or several nodes sharing one database, can run workers
+against the same outbox. Each claims callbacks under a lease recording its
+owner id, and only the lease holder may complete or retry them. A batch is
+claimed at once, but sent one callback at a time, so the lease on each
+callback is renewed just before it's sent, and a callback whose lease was
+lost to another worker meanwhile is skipped. With a send that returns before
+the LMS responds (async callbacks), max_in_flight keeps the worker from
+claiming more than can be sent straight away, and its responses are
+recorded on the worker's own thread rather than the client's. So each callback is delivered
+by exactly one worker as long as the lease outlasts the callback timeout,
+and the nodes' clocks agree. A callback whose worker dies mid-delivery is
+sent again once its lease expires.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import socket
+import threading
+
+
+class OutboxWorker:
+    """
+    Claims due callbacks from the database in batches and hands them to `send`,
+    which must return a :class:`concurrent.futures.Future` for the LMS response.
+
+    Failed callbacks are retried after base_delay * 2 ** attempts seconds
+    (capped at max_delay), with jitter so that retries after an LMS outage
+    are spread out. Callbacks are dropped after max_attempts failures.
+    """
+    def __init__(self, db, send, logger, batch_size=50, interval=1.0, lease=60,
+                 max_attempts=8, base_delay=2, max_delay=300, node_id=None, max_in_flight=None):
+        self.db = db
+        self.send = send
+        self.logger = logger
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.node_id = node_id or socket.gethostname()
+        self.max_in_flight = max_in_flight
+        self.owner = None
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        # sends may finish on the callback client's event loop, which mustn't wait for the database
+        self._finisher = ThreadPoolExecutor(1, thread_name_prefix='mockprock-outbox-finish')
+
+    def start(self):
+        # set here rather than in __init__, since workers are started after forking
+        self.owner = '%s:%d' % (self.node_id, os.getpid())
+        self._thread = threading.Thread(target=self._run, name='mockprock-outbox', daemon=True)
+        self._thread.start()
+
+    def enqueue(self, kind, url, payload, delay=0):
+        return self.db.enqueue_callback(kind, url, payload, delay=delay)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                claimed = self.drain()
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception('in outbox worker')
+                claimed = 0
+            # keep going while there's a backlog, otherwise poll
+            if claimed < self.batch_size:
+                self._stopped.wait(self.interval)
+
+    def drain(self):
+        """
+        Sends one batch of due callbacks. Returns the number claimed.
+        """
+        limit = self.batch_size
+        if self.max_in_flight is not None:
+            with self._lock:
+                limit = min(limit, self.max_in_flight - self.in_flight)
+            if limit <= 0:
+                return 0
+        rows = self.db.claim_callbacks(limit, self.lease, owner=self.owner)
+        for row in rows:
+            # the batch's lease started when it was claimed, and earlier sends may have used it up
+            if not self.db.renew_callback(row['id'], self.lease, self.owner):
+                self.logger.info('Lost the lease on %s callback %s before sending it', row['kind'], row['id'])
+                continue
+            with self._lock:
+                self.in_flight += 1
+            future = self.send(row['kind'], row['url'], row['payload'])
+            future.add_done_callback(lambda future, row=row: self._sent(row, future))
+        return len(rows)
+
+    def _sent(self, row, future):
+        with self._lock:
+            self.in_flight -= 1
+        try:
+            self._finisher.submit(self._record, row, future)
+        except RuntimeError:
+            self.logger.info('Outbox stopped before %s callback %s finished. It will be sent again once its '
+                             'lease expires', row['kind'], row['id'])
+
+    def _record(self, row, future):
+        try:
+            self._finish(row, future)
+        except Exception:  # pylint: disable=broad-except
+            self.logger.exception('recording %s callback %s', row['kind'], row['id'])
+
+    def _finish(self, row, future):
+        error = future.exception()
+        if error is None:
+            self._complete(row)
+            return
+        attempts = row['attempts'] + 1
+        if attempts >= self.max_attempts:
+            self.logger.error('Giving up on %s callback to %s after %d attempts: %r',
+                              row['kind'], row['url'], attempts, error)
+            self._complete(row)
+            return
+        delay = self.backoff(attempts)
+        self.logger.info('Retrying %s callback to %s in %.1f seconds', row['kind'], row['url'], delay)
+        if not self.db.retry_callback(row['id'], delay, repr(error), owner=self.owner):
+            self.logger.warning('Lost the lease on %s callback %s before it could be retried', row['kind'], row['id'])
+
+    def _complete(self, row):
+        if not self.db.complete_callback(row['id'], owner=self.owner):
+            self.logger.warning('Lost the lease on %s callback %s before it completed', row['kind'], row['id'])
+
+    def backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(self.interval + 1)
+        self._finisher.shutdown(wait=True)
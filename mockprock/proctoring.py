@@ -0,0 +1,291 @@
+"""
+The parts of the fake proctoring service that don't depend on the web framework,
+shared by the Flask server and the ASGI app
+
+Functions that take a `db` call the blocking storage engines in mockprock.db,
+so the ASGI app runs them on its storage threads.
+"""
+import datetime
+import json
+import re
+import time
+
+import jwt
+
+proctoring_config = {
+    'download_url': 'http://host.docker.internal:11136/download',
+    'name': 'MockProck',
+    'rules': {
+        'allow_cheating': 'Allow the student to cheat',
+        'allow_notes': 'Allow the student to take notes',
+    },
+    'instructions': [
+        'First of all, have a nice day.',
+        'A new window will open. You will run a system check before downloading the proctoring application.',
+        'You will be asked to verify your identity as part of the proctoring exam set up. Make sure you are on a computer with a webcam, and that you have valid photo identification such as a driver\'s license or passport, before you continue.',
+        'When you are finished, you will be redirected to the exam.',
+        'Finally, have a nice day!'
+    ]
+}
+
+CALLBACK_URL_RE = re.compile(r'/api/edx_proctoring/v1/proctored_exam/attempt/(?P<attempt_id>[^/]+)/(?:ready|reviewed)$')
+
+# the comments on every review, unless a scenario says otherwise
+DEFAULT_REVIEW_COMMENTS = [
+    {'comment': 'Looks suspicious', 'status': 'ok'}
+]
+
+# after stopping, the desktop application spends this many seconds "uploading" the session
+UPLOAD_SECONDS = 60
+
+# desktop requests without an attempt share this session
+DEFAULT_DESKTOP_SESSION_ID = 'default'
+
+# the desktop endpoints are called with ajax from the LMS, so allow cross site access
+DESKTOP_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Cache-Control': 'no-cache',
+}
+
+# number of exams shown on each page of the instructor dashboard
+DASHBOARD_PAGE_SIZE = 100
+
+
+class RequestError(Exception):
+    """
+    Raised for requests the service refuses, with the HTTP status code to respond with
+    """
+    def __init__(self, code, description):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+
+
+def make_access_token(client_id, client_secret, secret_key):
+    """
+    Returns the access token response for the client credentials.
+    The response is empty if the secret is wrong.
+    """
+    resp = {}
+    if client_secret == client_id + 'secret':
+        exp = 3600
+        payload = {'aud': client_id, 'exp': time.time() + exp}
+        token = jwt.encode(payload, secret_key, algorithm="HS256")
+        resp['access_token'] = token
+        resp['expires_in'] = exp
+    return resp
+
+
+def check_token(authorization, cache, secret_key):
+    """
+    Returns whether the Authorization header carries a valid bearer token.
+    Valid tokens are remembered in the cache until they expire.
+    """
+    parts = authorization.split()
+    if len(parts) != 2:
+        return False
+    token = parts[1]
+    if cache.get(token) is None:
+        try:
+            payload = jwt.decode(token, secret_key, options={'verify_signature': False}, algorithms=["HS256"])
+        except jwt.InvalidTokenError:
+            return False
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)):
+            exp = None
+        if exp is None or exp > time.time():
+            cache.set(token, True, expires=exp)
+    return True
+
+
+def get_cached_exam(db, cache, exam_id, ttl=None):
+    """
+    Returns the exam (empty if it doesn't exist), reading through the exam cache.
+    Cached exams expire after ttl seconds, if given.
+    The returned dict is shared, so don't modify it.
+    """
+    exam = cache.get(exam_id)
+    if exam is None:
+        exam = load_exam(db, cache, exam_id, ttl)
+    return exam
+
+
+def load_exam(db, cache, exam_id, ttl=None):
+    """
+    Reads the exam from storage into the exam cache, returning it (empty if it doesn't exist)
+    """
+    exam = db.get_exam(exam_id)
+    if exam:
+        cache.set(exam_id, exam, expires=time.time() + ttl if ttl else None)
+    return exam
+
+
+def bulk_items(body, ndjson=False):
+    """
+    Yields the objects in the body of a bulk request: a decoded JSON array,
+    or the lines of an NDJSON body with one object per line.
+    Raises RequestError once it reaches anything else.
+    """
+    if ndjson:
+        items = (json.loads(line) for line in body if line.strip())
+    elif isinstance(body, list):
+        items = body
+    else:
+        raise RequestError(400, 'Expected a JSON array')
+    for item in items:
+        if not isinstance(item, dict):
+            raise RequestError(400, 'Expected a JSON object, got %s' % type(item).__name__)
+        yield item
+
+
+def save_bulk_attempts(db, attempts):
+    """
+    Creates the attempts in one transaction.
+    Returns a list of the (id, status) of each new attempt, in order.
+    """
+    statuses = []
+
+    def new_attempts():
+        for attempt in attempts:
+            attempt.pop('id', None)
+            statuses.append(attempt.get('status') or 'created')
+            yield attempt
+
+    return list(zip(db.save_attempts(new_attempts()), statuses))
+
+
+def patch_attempt_status(db, exam_id, attempt_id, status):
+    """
+    Moves the attempt to the status, if one is given.
+    Returns the attempt (empty if it doesn't exist), and whether its status changed:
+    repeating the current status is allowed, but doesn't publish or review the attempt again.
+    Raises InvalidTransition if the attempt can't move to the status.
+    """
+    attempt = db.patch_attempt(exam_id, attempt_id, status)
+    changed = bool(attempt) and status is not None and attempt.get('previous_status') != status
+    return attempt, changed
+
+
+def attempt_details(db, exam_cache, exam_id, attempt_id, download_url, ttl=None):
+    """
+    Returns the attempt, with the instructions, rules and software download link for its exam
+    """
+    attempt = db.get_attempt(exam_id, attempt_id)
+    attempt['download_url'] = f'{download_url}?attempt={attempt_id}&exam={exam_id}'
+    attempt['instructions'] = proctoring_config['instructions']
+    attempt['rules'] = (get_cached_exam(db, exam_cache, exam_id, ttl) or {}).get('rules', {})
+    return attempt
+
+
+def dashboard_context(db, client_id, token, after=None):
+    """
+    Returns the template context of a page of the instructor dashboard, for the token the LMS signed.
+    Exams listed in the token, with their rules, and the course's attempt stats come on the first page.
+    If there are more exams, `next_after` is the value of the `after` parameter for the next page.
+    Raises RequestError if the course has no exams.
+    """
+    secret = client_id + 'secret'
+    decoded = jwt.decode(token, secret, issuer=client_id, algorithms=["HS256"])
+    course_id = decoded['course_id']
+    if not db.course_exists(course_id):
+        raise RequestError(403, 'Unknown course')
+    exams = []
+    if after is None:
+        for exam_id in decoded.get('exam', []):
+            exams.append(db.get_exam(exam_id))
+
+    # only the exams listed in the token are shown with their rules
+    page = list(db.get_exams(course_id, limit=DASHBOARD_PAGE_SIZE + 1, after=after, rules=False))
+    next_after = None
+    if len(page) > DASHBOARD_PAGE_SIZE:
+        page = page[:DASHBOARD_PAGE_SIZE]
+        next_after = page[-1]['id']
+    exams.extend(page)
+
+    return {
+        'client_id': client_id,
+        'token': decoded,
+        'course_id': course_id,
+        'exams': exams,
+        'next_after': next_after,
+        'next_url': None,
+        'attempt_ids': decoded.get('attempt', []),
+        # stats cover every attempt in the course, so only the first page pays for them
+        'attempt_stats': db.get_attempt_stats(course_id) if after is None else None,
+    }
+
+
+def desktop_session_id(args):
+    """
+    Returns the id of the desktop session the request's query args are for
+    """
+    return args.get('attempt') or DEFAULT_DESKTOP_SESSION_ID
+
+
+def desktop_status(session):
+    """
+    Returns the status of a desktop session, finishing the upload once it has taken long enough
+    """
+    status = session.get('status')
+    if status == 'uploading':
+        modified = datetime.datetime.strptime(session['modified'], '%Y-%m-%d %H:%M:%S')
+        if (datetime.datetime.utcnow() - modified).total_seconds() >= UPLOAD_SECONDS:
+            status = 'stopped'
+    return status
+
+
+def ping_desktop(db, session_id):
+    """
+    Returns the response to a ping of the desktop application
+    """
+    return {'status': desktop_status(db.get_desktop_session(session_id))}
+
+
+def start_desktop(db, session_id):
+    """
+    Starts the desktop session, returning the response
+    """
+    db.set_desktop_status(session_id, 'running')
+    return {'status': 'running'}
+
+
+def stop_desktop(db, session_id):
+    """
+    Starts uploading the desktop session and returns immediately.
+    Pinging the session shows when the upload has finished.
+    """
+    db.set_desktop_status(session_id, 'uploading')
+    return {'status': 'uploading'}
+
+
+def ready_callback_request(attempt_id, attempt):
+    """
+    Returns the url and payload telling the LMS that the attempt is ready
+    """
+    callback_url = '%s/api/edx_proctoring/v1/proctored_exam/attempt/%s/ready' % (attempt['lms_host'], attempt_id)
+    payload = {
+        'status': 'ready'
+    }
+    return callback_url, payload
+
+
+def review_callback_request(attempt_id, attempt, status='passed', comments=None):
+    """
+    Returns the url and payload of the fake review for the attempt
+    """
+    callback_url = '%s/api/edx_proctoring/v1/proctored_exam/attempt/%s/reviewed' % (attempt['lms_host'], attempt_id)
+    if comments is None:
+        comments = DEFAULT_REVIEW_COMMENTS
+    payload = {
+        'status': status,
+        'comments': comments
+    }
+    return callback_url, payload
+
+
+def callback_attempt_id(callback_url):
+    """
+    Returns the id of the attempt a callback url is about, or None
+    """
+    match = CALLBACK_URL_RE.search(callback_url)
+    return match.group('attempt_id') if match else None
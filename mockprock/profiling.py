@@ -0,0 +1,154 @@
+"""
+Opt-in cProfile sampling of request handlers and LMS callbacks
+
+Enable it with --profile DIR, or the MOCKPROCK_PROFILE_DIR environment variable
+(MOCKPROCK_PROFILE_RATE sets the fraction of calls sampled, like --profile-rate).
+Profiles are aggregated per route or callback, and written to DIR at exit or
+when POST /api/v1/profile/dump/ is called. Each profile is saved as pstats data
+(<name>.<pid>.prof) and as collapsed stacks for flamegraph.pl or speedscope
+(<name>.<pid>.collapsed).
+"""
+import copy
+import cProfile
+import os
+import pstats
+import random
+import re
+import threading
+
+from flask import g, request
+
+
+# stacks in the collapsed output are cut off at this many frames
+MAX_STACK_DEPTH = 64
+
+
+def collapse_stacks(stats):
+    """
+    Returns flamegraph "collapsed" lines (frame;frame;frame microseconds) built from pstats data.
+
+    cProfile records only caller/callee pairs, not whole stacks, and walking every
+    path through that graph takes exponential time. So the self time a function
+    spent on behalf of each caller is drawn under that caller's heaviest stack:
+    the chain of callers that spent the most cumulative time calling each frame.
+    """
+    def label(func):
+        filename, line, name = func
+        return '%s (%s:%d)' % (name, os.path.basename(filename), line)
+
+    # each function's callers, heaviest first
+    heaviest_callers = {
+        func: sorted(callers, key=lambda caller, callers=callers: (callers[caller][3], caller), reverse=True)
+        for func, (_, _, _, _, callers) in stats.stats.items()
+    }
+    labels = {func: label(func) for func in stats.stats}
+    stacks = {}
+
+    def heaviest_stack(func):
+        if func not in stacks:
+            frames = [func]
+            seen = {func}
+            while len(frames) < MAX_STACK_DEPTH:
+                caller = next((caller for caller in heaviest_callers.get(frames[-1], ()) if caller not in seen), None)
+                if caller is None:
+                    break
+                frames.append(caller)
+                seen.add(caller)
+            stacks[func] = ';'.join(labels.get(frame) or label(frame) for frame in reversed(frames))
+        return stacks[func]
+
+    totals = {}
+    for func, (_, _, tt, _, callers) in stats.stats.items():
+        if callers:
+            parts = [(heaviest_stack(caller) + ';' + labels[func], edge[2]) for caller, edge in callers.items()]
+        else:
+            parts = [(labels[func], tt)]
+        for key, self_time in parts:
+            weight = int(self_time * 1e6)
+            if weight > 0:
+                totals[key] = totals.get(key, 0) + weight
+    return ['%s %d' % item for item in sorted(totals.items())]
+
+
+class Profiler:
+    """
+    Profiles a sample of calls, keeping aggregated stats for each name
+    """
+    def __init__(self, directory, sample_rate=1.0):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Returns an enabled profiler for this call, or None if it isn't sampled
+        """
+        if random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # only one profiler can be active at a time on some Python versions
+            return None
+        return profile
+
+    def stop(self, name, profile):
+        profile.disable()
+        with self._lock:
+            if name in self.stats:
+                self.stats[name].add(profile)
+            else:
+                self.stats[name] = pstats.Stats(profile)
+
+    def run(self, name, func, *args, **kwargs):
+        profile = self.start()
+        if profile is None:
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stop(name, profile)
+
+    def dump(self):
+        """
+        Writes every aggregated profile to the directory. Returns the paths written.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        paths = []
+        # snapshot the stats, so sampled calls aren't held up while they're written.
+        # Adding a profile replaces entries rather than changing them, so a shallow copy is enough
+        with self._lock:
+            snapshots = []
+            for name, stats in self.stats.items():
+                snapshot = copy.copy(stats)
+                snapshot.stats = dict(stats.stats)
+                snapshots.append((name, snapshot))
+        for name, stats in snapshots:
+            base = os.path.join(self.directory, '%s.%d' % (re.sub(r'[^\w.-]+', '_', name).strip('_'), os.getpid()))
+            stats.dump_stats(base + '.prof')
+            with open(base + '.collapsed', 'w') as collapsed:
+                collapsed.write('\n'.join(collapse_stacks(stats)) + '\n')
+            paths.extend([base + '.prof', base + '.collapsed'])
+        return paths
+
+
+def init_app(app, directory, sample_rate=1.0):
+    """
+    Profiles a sample of the app's requests, aggregated by route
+    """
+    profiler = app.profiler = Profiler(directory, sample_rate)
+
+    @app.before_request
+    def start_profile():
+        g.profile = profiler.start()
+
+    @app.teardown_request
+    def stop_profile(exc):  # pylint: disable=unused-argument
+        profile = g.pop('profile', None)
+        if profile is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            profiler.stop('%s %s' % (request.method, route), profile)
+
+    return profiler
@@ -0,0 +1,268 @@
+"""
+Replays a capture of exam traffic against a running mockprock server, and reports latency drift.
+
+Record a capture with --capture, then start a server pointing at the stand-in
+LMS the replay runs, and replay the requests at the same pace, or faster:
+
+    python -m mockprock.server bench benchsecret --capture examday.ndjson.gz
+    python -m mockprock.server bench benchsecret -l http://127.0.0.1:18001 --no-debug
+    mockprock-replay examday.ndjson.gz --speedup 10 --save run1.json
+
+Ids of exams and attempts created during the replay are mapped to the ids in
+the capture, and attempts are pointed at the stand-in LMS. A request waits for
+the requests that created the ids it uses, so a fast replay keeps the order
+each attempt went through. Callback delays are up to the server: start it
+with --time-scale to compress them by the same factor.
+
+Latencies are compared with an earlier replay saved with --save, given as
+--baseline. Latencies in the capture aren't compared: they time the server's
+handling of each request, while the replay times the whole round trip. With
+--max-drift, the replay exits with an error if any endpoint's p50 or p95
+latency grew by more than that percentage since the baseline.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys
+import threading
+import time
+
+import requests
+
+from mockprock.bench import Timings
+from mockprock.capture import read_capture
+from mockprock.fake_lms import FakeLMS
+
+TOKEN_PATH = '/oauth2/access_token'
+
+# seconds a request waits for the request that creates an id it uses
+DEPENDENCY_TIMEOUT = 30
+
+# callback names in captures, and the kind of callback the stand-in LMS receives
+CALLBACK_KINDS = {'ready': 'ready', 'review': 'reviewed'}
+
+
+def request_name(record):
+    return '%s %s' % (record['method'], record['route'])
+
+
+class Replayer:
+    """
+    Sends the requests in a capture to the server, recording the latency of each
+    """
+    def __init__(self, base_url, client_id, client_secret, lms_url, timings):
+        self.base_url = base_url.rstrip('/')
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.lms_url = lms_url
+        self.timings = timings
+        self.mismatches = 0
+        # recorded id: replayed id
+        self.ids = {}
+        # recorded id: set once the request creating it has finished
+        self.created = {}
+        self._token = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def expect(self, records):
+        """
+        Notes the ids the records create, so that requests using them can wait for them
+        """
+        for record in records:
+            for recorded_id in record['ids']:
+                self.created[recorded_id] = threading.Event()
+
+    def fetch_token(self):
+        data = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'token_type': 'jwt',
+        }
+        response = self.session.post(self.base_url + TOKEN_PATH, data=data, timeout=30)
+        response.raise_for_status()
+        token = response.json()['access_token']
+        with self._lock:
+            self._token = token
+        return response
+
+    @property
+    def token(self):
+        if self._token is None:
+            self.fetch_token()
+        return self._token
+
+    def map_id(self, value):
+        """
+        Returns the replayed id for a recorded one, waiting for it to be created
+        """
+        created = self.created.get(value)
+        if created is None:
+            return value
+        created.wait(DEPENDENCY_TIMEOUT)
+        return self.ids.get(value, value)
+
+    def map_body(self, body):
+        if isinstance(body, dict):
+            return {
+                key: self.lms_url if key == 'lms_host' else self.map_body(value)
+                for key, value in body.items()
+            }
+        if isinstance(body, list):
+            return [self.map_body(value) for value in body]
+        if isinstance(body, str):
+            return self.map_id(body)
+        return body
+
+    def prepare(self, record):
+        """
+        Returns the url and keyword arguments to replay the request with, once the ids it uses exist
+        """
+        path = '/'.join(self.map_id(part) for part in record['path'].split('/'))
+        params = {key: self.map_id(value) for key, value in record['query'].items()}
+        kwargs = {'params': params, 'headers': {'Authorization': 'JWT %s' % self.token}, 'timeout': 30}
+        if record['body'] is not None:
+            kwargs['json'] = self.map_body(record['body'])
+        return self.base_url + path, kwargs
+
+    def replay(self, record):
+        name = request_name(record)
+        try:
+            try:
+                if record['route'] == TOKEN_PATH:
+                    start = time.perf_counter()
+                    response = self.fetch_token()
+                else:
+                    url, kwargs = self.prepare(record)
+                    start = time.perf_counter()
+                    response = self.session.request(record['method'], url, **kwargs)
+            except requests.RequestException:
+                self.timings.error(name)
+                return
+            self.timings.add(name, time.perf_counter() - start)
+            if response.status_code != record['status']:
+                with self._lock:
+                    self.mismatches += 1
+                self.timings.error(name)
+            elif record['ids']:
+                data = response.json()
+                replayed_ids = data['ids'] if 'ids' in data else [data['id']]
+                with self._lock:
+                    self.ids.update(zip(record['ids'], replayed_ids))
+        finally:
+            for recorded_id in record['ids']:
+                self.created[recorded_id].set()
+
+    def run(self, records, speedup, concurrency):
+        """
+        Sends the records at their recorded times divided by speedup. Returns the seconds taken.
+        """
+        self.expect(records)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for record in records:
+                delay = record['t'] / speedup - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.replay, record)
+        return time.perf_counter() - start
+
+
+def drift(baseline, value):
+    if baseline is None or value is None or not baseline:
+        return None
+    return (value - baseline) / baseline * 100
+
+
+def drift_report(baseline, summary):
+    """
+    Returns the report lines comparing two :meth:`mockprock.bench.Timings.summary` dicts,
+    and the largest p50 or p95 drift in percent. With an empty baseline, there's no drift to report.
+    """
+    lines = ['%-60s %7s %7s %9s %9s %8s %9s %9s %8s' % (
+        'request', 'count', 'errors', 'base p50', 'p50 ms', 'drift', 'base p95', 'p95 ms', 'drift')]
+    worst = None
+
+    def cell(value, fmt):
+        return fmt % value if value is not None else '%*s' % (len(fmt % 0), '-')
+
+    for name in sorted(set(baseline) | set(summary)):
+        base = baseline.get(name, {})
+        row = summary.get(name, {})
+        cells = []
+        for key in ('p50', 'p95'):
+            change = drift(base.get(key), row.get(key))
+            if change is not None:
+                worst = change if worst is None else max(worst, change)
+            cells.extend([cell(base.get(key), '%9.1f'), cell(row.get(key), '%9.1f'), cell(change, '%+7.0f%%')])
+        lines.append('%-60s %7d %7d %s' % (name, row.get('count', 0), row.get('errors', 0), ' '.join(cells)))
+    return lines, worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a capture against a running mockprock server')
+    parser.add_argument('capture', type=str, help='capture file recorded with --capture')
+    parser.add_argument('--url', dest='url', type=str, default='http://127.0.0.1:11136', help='mockprock server url')
+    parser.add_argument('--client-id', dest='client_id', type=str, default='bench', help='mockprock oauth client id')
+    parser.add_argument('--client-secret', dest='client_secret', type=str, default='benchsecret',
+                        help='mockprock oauth client secret')
+    parser.add_argument('--speedup', dest='speedup', type=float, default=1,
+                        help='send requests this many times faster than they were recorded')
+    parser.add_argument('-c', dest='concurrency', type=int, default=50, help='limit on concurrent requests')
+    parser.add_argument('--lms-port', dest='lms_port', type=int, default=18001,
+                        help='port for the stand-in LMS. Start the server with -l http://127.0.0.1:PORT')
+    parser.add_argument('--wait', dest='wait', type=float, default=0,
+                        help='seconds to wait for the recorded number of review callbacks after the replay')
+    parser.add_argument('--baseline', dest='baseline', type=str, default=None,
+                        help='summary saved by an earlier replay with --save, to compare latencies with')
+    parser.add_argument('--save', dest='save', type=str, default=None, help='file to save the summary of this replay in')
+    parser.add_argument('--max-drift', dest='max_drift', type=float, default=None,
+                        help='exit with an error if a p50 or p95 latency grew by more than this percentage '
+                             'since --baseline')
+    args = parser.parse_args()
+    if args.speedup <= 0:
+        parser.error('--speedup must be positive')
+    if args.max_drift is not None and not args.baseline:
+        parser.error('--max-drift needs a --baseline replay to compare with')
+
+    records = list(read_capture(args.capture))
+    request_records = [record for record in records if record['type'] == 'request']
+    callbacks = [record for record in records if record['type'] == 'callback']
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    lms = FakeLMS(port=args.lms_port).start()
+    timings = Timings()
+    replayer = Replayer(args.url, args.client_id, args.client_secret, lms.url, timings)
+    elapsed = replayer.run(request_records, args.speedup, args.concurrency)
+    expected = {
+        kind: sum(1 for callback in callbacks if callback['name'] == name and callback['result'] == 'success')
+        for name, kind in CALLBACK_KINDS.items()
+    }
+    if args.wait:
+        lms.wait_for('reviewed', expected['reviewed'], args.wait)
+    lms.stop()
+
+    summary = timings.summary(elapsed)
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(summary, save_file, indent=2)
+    print('Replayed %d requests in %.2fs at %gx, %d got a different status than recorded' % (
+        len(request_records), elapsed, args.speedup, replayer.mismatches))
+    lines, worst = drift_report(baseline, summary)
+    print('\n'.join(lines))
+    for kind, count in expected.items():
+        print('LMS received %d %s callbacks, %d in the capture' % (lms.count(kind), kind, count))
+    if args.max_drift is not None and worst is not None and worst > args.max_drift:
+        print('Latency drifted by %.0f%%, more than %g%%' % (worst, args.max_drift))
+        sys.exit(1)
@@ -0,0 +1,97 @@
+"""
+Asyncio-based client for posting callbacks to the LMS.
+
+Requests are sent from an event loop running in a background thread, so
+callers don't hold a thread for each round trip. Requires aiohttp.
+"""
+import asyncio
+import threading
+
+from mockprock.rest_api_client.client import USER_AGENT
+
+
+class AsyncCallbackClient:
+    """
+    Posts JSON to the LMS over a pooled keep-alive connection, limiting
+    the number of requests in flight. Authenticates using the tokens
+    of the given :class:`OAuthAPIClient`, fetching a new token if the
+    LMS rejects one.
+    """
+    def __init__(self, oauth_client, max_in_flight=100, timeout=30, keepalive_timeout=60):
+        try:
+            import aiohttp  # pylint: disable=import-outside-toplevel
+        except ImportError as ex:
+            raise RuntimeError('aiohttp is required for async callbacks: pip install aiohttp') from ex
+        self._aiohttp = aiohttp
+        self.oauth_client = oauth_client
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.loop = None
+        self._session = None
+        self._semaphore = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self._open())
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self._session.close())
+            self.loop.close()
+
+        self._thread = threading.Thread(target=run, name='mockprock-async-callbacks', daemon=True)
+        self._thread.start()
+        started.wait()
+
+    async def _open(self):
+        aiohttp = self._aiohttp
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=self.keepalive_timeout)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={'User-Agent': USER_AGENT},
+        )
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+    def post(self, url, payload):
+        """
+        Schedules a POST of the JSON payload to url.
+        Returns a :class:`concurrent.futures.Future` resolving to the decoded response.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._start()
+        return asyncio.run_coroutine_threadsafe(self._post(url, payload), self.loop)
+
+    async def _post(self, url, payload):
+        async with self._semaphore:
+            token = await self.loop.run_in_executor(None, self.oauth_client.get_access_token)
+            headers = {'Authorization': 'JWT {jwt}'.format(jwt=token)}
+            async with self._session.post(url, json=payload, headers=headers) as response:
+                if response.status != 401:
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+            # the LMS rejected the token, so fetch a new one and retry once
+            self.oauth_client.token_cache.invalidate(token)
+            token = await self.loop.run_in_executor(None, self.oauth_client.get_access_token)
+            headers = {'Authorization': 'JWT {jwt}'.format(jwt=token)}
+            async with self._session.post(url, json=payload, headers=headers) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    def shutdown(self):
+        """
+        Stops the event loop and closes pooled connections
+        """
+        with self._lock:
+            if self._thread is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(self.timeout)
+            self._thread = None
@@ -2,12 +2,19 @@
 Module pulled out of edx-rest-api-client for use interacting with the edX api from a non-django context
 """
 import datetime
+import json
+import logging
+import os
+import tempfile
+import threading
 
 import requests
 import requests.utils
 
 from mockprock.rest_api_client.auth import SuppliedJwtAuth
 
+log = logging.getLogger(__name__)
+
 def user_agent():
     """
     Return a User-Agent that identifies this client.
@@ -68,6 +75,99 @@ def get_oauth_access_token(url, client_id, client_secret, token_type='jwt', gran
 
     return access_token, expires_at
 
+class TokenCache:
+    """
+    Thread-safe cache of an OAuth access token.
+
+    The token is refreshed `skew` seconds before it expires. Only one thread
+    fetches a new token at a time; other threads wait for it and reuse it.
+    If a path is given, the token is saved there, readable only by its owner,
+    and reused after a restart. Tokens in the file are keyed by LMS and client,
+    so servers talking to different LMSes can share it.
+    """
+
+    def __init__(self, fetch, key, skew=60, path=None):
+        """
+        Args:
+            fetch (callable): returns a tuple of access token and expiration datetime
+            key (str): identifies the LMS and client the token belongs to
+        Kwargs:
+            skew (int): seconds before expiration to refresh the token
+            path (str): file to persist the token in
+        """
+        self._fetch = fetch
+        self._key = key
+        self._skew = datetime.timedelta(seconds=skew)
+        self._path = path
+        self._lock = threading.Lock()
+        self._token = None
+        self._expiration = datetime.datetime(1983, 4, 6, 7, 30, 0)
+        self.refreshes = 0
+        if path:
+            self._load()
+
+    def _is_fresh(self):
+        return self._token and datetime.datetime.utcnow() < self._expiration - self._skew
+
+    def get(self):
+        """
+        Returns a valid access token, fetching a new one if needed
+        """
+        if self._is_fresh():
+            return self._token
+        with self._lock:
+            if not self._is_fresh():
+                self._token, self._expiration = self._fetch()
+                self.refreshes += 1
+                if self._path:
+                    try:
+                        self._save()
+                    except OSError:
+                        # the token still works, it just won't outlive this process
+                        log.warning('Could not save the access token to %s', self._path, exc_info=True)
+            return self._token
+
+    def invalidate(self, token):
+        """
+        Forgets the token after the LMS rejected it, so the next call to get fetches a new one.
+        Does nothing if another thread has already replaced it.
+        """
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+    def _read(self):
+        try:
+            with open(self._path) as cache_file:
+                data = json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _load(self):
+        cached = self._read().get(self._key)
+        if cached:
+            self._token = cached['access_token']
+            self._expiration = datetime.datetime.fromisoformat(cached['expires_at'])
+
+    def _save(self):
+        data = self._read()
+        data[self._key] = {
+            'access_token': self._token,
+            'expires_at': self._expiration.isoformat(),
+        }
+        # each save gets its own temporary file (created with mode 0600), as several
+        # processes sharing the cache refresh the token at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(data, cache_file)
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
 class OAuthAPIClient(requests.Session):
     """
     A :class:`requests.Session` that automatically authenticates against edX's preferred
@@ -76,34 +176,48 @@ class OAuthAPIClient(requests.Session):
     """
     oauth_uri = '/oauth2/access_token'
 
-    def __init__(self, base_url, client_id, client_secret, **kwargs):
+    def __init__(self, base_url, client_id, client_secret, token_skew=60, token_cache_path=None, **kwargs):
         """
         Args:
             base_url (str): base url of LMS instance
             client_id (str): Client ID
             client_secret (str): Client secret
+        Kwargs:
+            token_skew (int): seconds before expiration to refresh the access token
+            token_cache_path (str): file to persist the access token in across restarts
         """
         super(OAuthAPIClient, self).__init__(**kwargs)
         self.headers['user-agent'] = USER_AGENT
         self._base_url = base_url
         self._client_id = client_id
         self._client_secret = client_secret
-        self._expiration = datetime.datetime(1983, 4, 6, 7, 30, 0)
-        self.auth = SuppliedJwtAuth(None)
-
-    def _check_auth(self):
-        if datetime.datetime.utcnow() > self._expiration:
-            url = self._base_url + self.oauth_uri
-            grant_type = 'client_credentials'
-            self.auth.token, self._expiration = get_oauth_access_token(
-                url,
-                self._client_id,
-                self._client_secret,
-                grant_type=grant_type)
+        self.token_cache = TokenCache(self._fetch_token, '%s %s' % (base_url, client_id),
+                                      skew=token_skew, path=token_cache_path)
+
+    def _fetch_token(self):
+        url = self._base_url + self.oauth_uri
+        grant_type = 'client_credentials'
+        return get_oauth_access_token(
+            url,
+            self._client_id,
+            self._client_secret,
+            grant_type=grant_type)
+
+    def get_access_token(self):
+        """
+        Returns a current access token, fetching a new one if it has expired
+        """
+        return self.token_cache.get()
 
     def request(self, method, url, **kwargs):  # pylint: disable=arguments-differ
         """
-        Overrides Session.request to ensure that the session is authenticated
+        Overrides Session.request to ensure that the session is authenticated.
+        If the LMS rejects the access token, fetches a new one and retries once.
         """
-        self._check_auth()
-        return super(OAuthAPIClient, self).request(method, url, **kwargs)
+        token = self.token_cache.get()
+        response = super(OAuthAPIClient, self).request(method, url, auth=SuppliedJwtAuth(token), **kwargs)
+        if response.status_code == 401:
+            self.token_cache.invalidate(token)
+            response = super(OAuthAPIClient, self).request(
+                method, url, auth=SuppliedJwtAuth(self.token_cache.get()), **kwargs)
+        return response
@@ -0,0 +1,173 @@
+"""
+Scenarios describe the callback traffic mockprock sends to the LMS, for capacity tests.
+
+A scenario file is JSON, e.g.
+
+    {
+        "seed": 42,
+        "time_scale": 10,
+        "ready_delay": {"distribution": "uniform", "min": 1, "max": 5},
+        "review_delay": {"distribution": "lognormal", "median": 600, "sigma": 0.75},
+        "outcomes": {"passed": 0.8, "suspicious": 0.15, "error": 0.05},
+        "comments": {
+            "count": {"distribution": "uniform", "min": 0, "max": 10},
+            "length": {"distribution": "normal", "mean": 500, "stddev": 200}
+        }
+    }
+
+Delays are in seconds, and divided by time_scale, so a scale of 100 plays a day's
+traffic pattern in under 15 minutes. Every value that is sampled can be a
+number, or a distribution: constant (value), uniform (min, max), normal (mean,
+stddev), lognormal (median, sigma) or exponential (mean). Negative samples are
+treated as zero.
+
+With a seed, the sequence of delays and reviews is the same on every run: the
+nth review scheduled always gets the same outcome, comments and delay, and
+the nth ready callback the same delay, however the two are interleaved.
+Print the first draws with python -m mockprock.scenarios {file}
+"""
+import json
+import math
+import random
+import threading
+
+from mockprock.proctoring import DEFAULT_REVIEW_COMMENTS
+
+# repeated to make comments of any length
+COMMENT_TEXT = 'Looks suspicious. The student glanced away from the screen. '
+
+
+class Distribution:
+    """
+    Samples numbers from a scenario value: a number, or a dict naming a distribution and its parameters
+    """
+    def __init__(self, spec):
+        if isinstance(spec, (int, float)):
+            spec = {'distribution': 'constant', 'value': spec}
+        self.spec = dict(spec)
+        self.kind = self.spec.pop('distribution', 'constant')
+        try:
+            self._sample = getattr(self, '_%s' % self.kind)
+        except AttributeError:
+            raise ValueError('Unknown distribution %r' % self.kind) from None
+        # fail on missing parameters when the scenario is loaded, not when it's played
+        self._sample(random.Random(0))
+
+    def sample(self, rng):
+        return max(0.0, float(self._sample(rng)))
+
+    def _constant(self, rng):  # pylint: disable=unused-argument
+        return self.spec['value']
+
+    def _uniform(self, rng):
+        return rng.uniform(self.spec['min'], self.spec['max'])
+
+    def _normal(self, rng):
+        return rng.gauss(self.spec['mean'], self.spec['stddev'])
+
+    def _lognormal(self, rng):
+        return rng.lognormvariate(math.log(self.spec['median']), self.spec['sigma'])
+
+    def _exponential(self, rng):
+        return rng.expovariate(1.0 / self.spec['mean'])
+
+
+class Scenario:
+    """
+    Draws callback delays and review outcomes. The defaults reproduce mockprock's
+    fixed behavior: ready after 2 seconds, and a passing review with one comment
+    after 10 seconds.
+    """
+    def __init__(self, seed=None, time_scale=1, ready_delay=2, review_delay=10, outcomes=None, comments=None):
+        if time_scale <= 0:
+            raise ValueError('time_scale must be positive')
+        self.seed = seed
+        self.time_scale = time_scale
+        self.ready_delays = Distribution(ready_delay)
+        self.review_delays = Distribution(review_delay)
+        outcomes = outcomes or {'passed': 1}
+        self.outcomes = list(outcomes)
+        self.weights = [outcomes[outcome] for outcome in self.outcomes]
+        if min(self.weights) < 0 or sum(self.weights) <= 0:
+            raise ValueError('outcome weights must not be negative, and must not all be zero')
+        if comments is None:
+            self.comment_counts = self.comment_lengths = None
+        else:
+            self.comment_counts = Distribution(comments.get('count', 1))
+            self.comment_lengths = Distribution(comments.get('length', len(COMMENT_TEXT)))
+        # separate streams, so that the reviews don't depend on how many downloads came first
+        self._ready_rng = random.Random(None if seed is None else '%s:ready' % seed)
+        self._review_rng = random.Random(None if seed is None else '%s:review' % seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the scenario in a JSON file
+        """
+        with open(path) as scenario_file:
+            spec = json.load(scenario_file)
+        try:
+            return cls(**spec)
+        except (KeyError, TypeError, ValueError) as ex:
+            raise ValueError('Invalid scenario %s: %r' % (path, ex)) from ex
+
+    def ready_delay(self):
+        """
+        Returns the seconds to wait before telling the LMS the attempt is ready
+        """
+        with self._lock:
+            return self.ready_delays.sample(self._ready_rng) / self.time_scale
+
+    def review(self):
+        """
+        Returns the seconds to wait before sending the next review, its status and its list of comments
+        """
+        with self._lock:
+            delay = self.review_delays.sample(self._review_rng) / self.time_scale
+            status = self._review_rng.choices(self.outcomes, self.weights)[0]
+            if self.comment_counts is None:
+                return delay, status, DEFAULT_REVIEW_COMMENTS
+            comments = []
+            for _ in range(int(self.comment_counts.sample(self._review_rng))):
+                length = int(self.comment_lengths.sample(self._review_rng))
+                text = COMMENT_TEXT * (length // len(COMMENT_TEXT) + 1)
+                comments.append({'comment': text[:length], 'status': 'ok'})
+        return delay, status, comments
+
+
+def load_scenario(path=None, time_scale=None):
+    """
+    Returns the scenario in the file, or the default one, with time_scale overriding the file's
+    """
+    scenario = Scenario.load(path) if path else Scenario()
+    if time_scale is not None:
+        if time_scale <= 0:
+            raise ValueError('time_scale must be positive')
+        scenario.time_scale = time_scale
+    return scenario
+
+
+def main():
+    import argparse  # pylint: disable=import-outside-toplevel
+    parser = argparse.ArgumentParser(description='Print the first callbacks a scenario would send')
+    parser.add_argument('path', type=str, help='scenario file')
+    parser.add_argument('-n', dest='count', type=int, default=10, help='number of attempts')
+    parser.add_argument('--time-scale', dest='time_scale', type=float, default=None,
+                        help="divide the delays by this, overriding the file")
+    args = parser.parse_args()
+
+    try:
+        scenario = load_scenario(args.path, args.time_scale)
+    except (OSError, ValueError) as ex:
+        parser.exit(1, '%s\n' % ex)
+    print('%8s %10s %-12s %10s %14s' % ('attempt', 'ready s', 'review', 'review s', 'comment bytes'))
+    for number in range(args.count):
+        ready_delay = scenario.ready_delay()
+        review_delay, status, comments = scenario.review()
+        size = sum(len(comment['comment']) for comment in comments)
+        print('%8d %10.2f %-12s %10.2f %14d' % (number, ready_delay, status, review_delay, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Runs delayed callbacks from one timer thread and a bounded pool of workers,
+rather than starting a thread per callback
+"""
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+
+class SchedulerFull(Exception):
+    """Raised when too many callbacks are already waiting to run"""
+
+
+class CallbackScheduler:
+    """
+    Keeps scheduled callbacks in a heap ordered by due time. A single timer thread
+    moves due callbacks onto a queue, which is drained by a fixed number of workers.
+    Threads are started on first use.
+    """
+    def __init__(self, logger, workers=4, max_pending=10000):
+        self.logger = logger
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._ready = queue.Queue()
+        self._threads = []
+        self._stopped = False
+
+    def _start(self):
+        self._threads.append(threading.Thread(target=self._run_timer, name='mockprock-timer', daemon=True))
+        for i in range(self.workers):
+            self._threads.append(threading.Thread(target=self._run_worker, name='mockprock-worker-%d' % i, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def schedule(self, delay, func, *args):
+        """
+        Calls func(*args) on a worker thread after delay seconds
+        """
+        with self._cond:
+            if self._stopped:
+                raise SchedulerFull('scheduler is shut down')
+            if self.pending >= self.max_pending:
+                raise SchedulerFull('%d callbacks pending' % self.pending)
+            if not self._threads:
+                self._start()
+            self.pending += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), func, args))
+            self._cond.notify()
+
+    def _run_timer(self):
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                timeout = self._heap[0][0] - time.monotonic()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+                _, _, func, args = heapq.heappop(self._heap)
+                self._ready.put((func, args))
+
+    def _run_worker(self):
+        while True:
+            item = self._ready.get()
+            if item is None:
+                break
+            func, args = item
+            try:
+                func(*args)
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception('in scheduled callback %s', func.__name__)
+            finally:
+                with self._cond:
+                    self.pending -= 1
+
+    def shutdown(self, timeout=5):
+        """
+        Stops the timer and workers. Callbacks that are not yet due are dropped.
+        """
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            dropped = len(self._heap)
+            self._heap.clear()
+            self.pending -= dropped
+            self._cond.notify_all()
+        if dropped:
+            self.logger.warning('Dropping %d scheduled callbacks at shutdown', dropped)
+        for _ in range(self.workers):
+            self._ready.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
@@ -2,62 +2,152 @@
 Run this server with python -m mockprock.server {client_id} {client_secret}
 """
 import atexit
+import json
+import os
 import sys
 import threading
 import time
-from collections import Iterable
+from concurrent.futures import Future
 from functools import wraps
 from pprint import pprint
+from urllib.parse import urlparse
 
-import jwt
-from flask import Flask, abort, jsonify, render_template, request
+from flask import Flask, Response, abort, jsonify, render_template, request, url_for
 
+from mockprock.batching import ReviewBatcher
+from mockprock.cache import LRUCache
+from mockprock.rest_api_client.async_client import AsyncCallbackClient
 from mockprock.rest_api_client.client import OAuthAPIClient
-from mockprock.db import init_app
+from mockprock.capture import init_app as init_capture
+from mockprock.db import InvalidTransition, init_app
+from mockprock.events import (
+    CALLBACK_STATUSES,
+    FINAL_STATUSES,
+    StatusBroadcaster,
+    Watcher,
+    format_event,
+    status_event,
+)
+from mockprock.metrics import Gauge, init_app as init_metrics
+from mockprock.outbox import OutboxWorker
+from mockprock.profiling import init_app as init_profiling
+from mockprock import proctoring
+from mockprock.proctoring import (
+    RequestError,
+    attempt_details,
+    bulk_items,
+    callback_attempt_id,
+    check_token,
+    dashboard_context,
+    make_access_token,
+    patch_attempt_status,
+    proctoring_config,
+    ready_callback_request,
+    review_callback_request,
+    save_bulk_attempts,
+)
+from mockprock.scenarios import Scenario, load_scenario
+from mockprock.scheduler import CallbackScheduler, SchedulerFull
 from mockprock.desktop_views import fake_application
 
 
 app = Flask(__name__)
 app.debug = True
 app.secret_key = 'super secret'
-init_app(app)
+# print exam payloads as they arrive
+app.config['DUMP_REQUESTS'] = True
+init_metrics(app)
+app.profiler = None
+if os.environ.get('MOCKPROCK_PROFILE_DIR'):
+    init_profiling(app, os.environ['MOCKPROCK_PROFILE_DIR'], float(os.environ.get('MOCKPROCK_PROFILE_RATE', 1)))
+    atexit.register(app.profiler.dump)
+if __name__ != '__main__':
+    # when run as a script, storage is configured from the command line below
+    init_app(app)
 
 app.register_blueprint(fake_application)
 
-proctoring_config = {
-    'download_url': 'http://host.docker.internal:11136/download',
-    'name': 'MockProck',
-    'rules': {
-        'allow_cheating': 'Allow the student to cheat',
-        'allow_notes': 'Allow the student to take notes',
-    },
-    'instructions': [
-        'First of all, have a nice day.',
-        'A new window will open. You will run a system check before downloading the proctoring application.',
-        'You will be asked to verify your identity as part of the proctoring exam set up. Make sure you are on a computer with a webcam, and that you have valid photo identification such as a driver\'s license or passport, before you continue.',
-        'When you are finished, you will be redirected to the exam.',
-        'Finally, have a nice day!'
-    ]
-}
-
+app.scheduler = CallbackScheduler(app.logger)
+atexit.register(lambda: app.scheduler.shutdown())
+# set from the command line to send callbacks from an event loop
+app.async_client = None
+# set from the command line to group review callbacks per LMS host
+app.review_batcher = None
+# set from the command line to store callbacks in the database until delivered
+app.outbox = None
+# bearer tokens that have already been decoded
+app.jwt_cache = LRUCache(maxsize=1024)
+# exams by id, dropped when the exam is saved. With several processes or nodes,
+# another one may save the exam, so entries also expire after this many seconds
+app.exam_cache = LRUCache(maxsize=4096)
+app.config['EXAM_CACHE_SECONDS'] = None
+# serialized config responses, by request host
+app.config_cache = LRUCache(maxsize=64)
+# attempt status changes, pushed to the attempt event streams
+app.status_events = StatusBroadcaster()
+# with several processes or nodes, the others' status changes aren't pushed to this
+# process, so event streams also read the attempt from storage this often
+app.config['EVENT_POLL_SECONDS'] = None
+# with --workers, an open event stream holds one of its worker's threads,
+# so streams beyond this many per process are refused
+app.config['MAX_EVENT_STREAMS'] = None
+app.event_streams = 0
+app.event_streams_lock = threading.Lock()
+# callback delays and review outcomes, set from the command line to load a scenario file
+app.scenario = Scenario()
+# set from the command line to record requests and callbacks for replaying
+app.capture = None
+
+app.metrics.register(Gauge(
+    'mockprock_callbacks_pending', 'Scheduled callbacks waiting for their timer or a worker',
+    func=lambda: app.scheduler.pending))
+app.metrics.register(Gauge(
+    'mockprock_oauth_token_refreshes_total', 'Access tokens fetched from the LMS',
+    func=lambda: app.client.token_cache.refreshes if hasattr(app, 'client') else None, metric_type='counter'))
+app.metrics.register(Gauge(
+    'mockprock_jwt_cache_lookups_total', 'Bearer token cache lookups by result',
+    func=lambda: {(('result', 'hit'),): app.jwt_cache.hits, (('result', 'miss'),): app.jwt_cache.misses},
+    metric_type='counter'))
+app.metrics.register(Gauge(
+    'mockprock_exam_cache_lookups_total', 'Exam cache lookups by result',
+    func=lambda: {(('result', 'hit'),): app.exam_cache.hits, (('result', 'miss'),): app.exam_cache.misses},
+    metric_type='counter'))
 
 def get_download_url():
     return 'http://%s/download' % request.host
 
 
+def get_cached_exam(exam_id):
+    """
+    Returns the exam (empty if it doesn't exist), reading through the exam cache.
+    The returned dict is shared, so don't modify it.
+    """
+    return proctoring.get_cached_exam(app.db, app.exam_cache, exam_id, app.config['EXAM_CACHE_SECONDS'])
+
+
 def requires_token(f):
     @wraps(f)
     def _func(*args, **kwargs):
-        token = request.headers.get('Authorization', ' ').split(' ')[1]
-        try:
-            jwt.decode(token, app.secret_key, options={'verify_signature': False}, algorithms=["HS256"])
-        except jwt.DecodeError:
+        if not check_token(request.headers.get('Authorization', ''), app.jwt_cache, app.secret_key):
             abort(403)
-        else:
-            return f(*args, **kwargs)
+        return f(*args, **kwargs)
     return _func
 
 
+def profiled(name):
+    """
+    Profiles calls of the decorated function under the given name, when profiling is enabled
+    """
+    def decorator(f):
+        @wraps(f)
+        def _func(*args, **kwargs):
+            if app.profiler:
+                return app.profiler.run(name, f, *args, **kwargs)
+            return f(*args, **kwargs)
+        return _func
+    return decorator
+
+
 @app.route('/oauth2/access_token', methods=['POST'])
 def access_token():
     """
@@ -68,14 +158,7 @@ def access_token():
     client_secret = request.form['client_secret']
     token_type = request.form['token_type']
     assert token_type == 'jwt', 'Only JWT is supported'
-    resp = {}
-    if client_secret == client_id + 'secret':
-        exp = 3600
-        payload = {'aud': client_id, 'exp': time.time() + exp}
-        token = jwt.encode(payload, app.secret_key, algorithm="HS256")
-        resp['access_token'] = token
-        resp['expires_in'] = exp
-    return jsonify(resp)
+    return jsonify(make_access_token(client_id, client_secret, app.secret_key))
 
 
 @app.route('/api/v1/config/')
@@ -84,8 +167,11 @@ def get_config():
     """
     Returns the global configuration options
     """
-    proctoring_config['download_url'] = get_download_url()
-    return jsonify(proctoring_config)
+    body = app.config_cache.get(request.host)
+    if body is None:
+        body = json.dumps(dict(proctoring_config, download_url=get_download_url()))
+        app.config_cache.set(request.host, body)
+    return app.response_class(body, mimetype='application/json')
 
 
 @app.route('/api/v1/exam/<exam_id>/', methods=['GET'])
@@ -94,7 +180,7 @@ def get_exam(exam_id):
     """
     Returns the exam
     """
-    exam = app.db.get_exam(exam_id) or {}
+    exam = get_cached_exam(exam_id) or {}
     return jsonify(exam)
 
 
@@ -106,7 +192,9 @@ def create_exam():
     """
     exam = request.json
     exam_id = app.db.save_exam(exam, request.headers.get('Authorization'))
-    pprint(exam)
+    app.exam_cache.delete(exam_id)
+    if app.config['DUMP_REQUESTS']:
+        pprint(exam)
     return jsonify({'id': exam_id})
 
 
@@ -119,7 +207,9 @@ def update_exam(exam_id):
     exam = request.json
     exam['external_id'] = exam_id
     app.db.save_exam(exam, request.headers.get('Authorization'))
-    pprint(exam)
+    app.exam_cache.delete(exam_id)
+    if app.config['DUMP_REQUESTS']:
+        pprint(exam)
     return jsonify({'id': exam_id})
 
 
@@ -130,9 +220,55 @@ def create_attempt(exam_id):
     attempt['exam_id'] = exam_id
     app.db.save_attempt(attempt)
     attempt_id = attempt['id']
+    app.status_events.publish(attempt_id, attempt.get('status') or 'created')
     return jsonify({'id': attempt_id})
 
 
+def read_bulk_items():
+    """
+    Yields objects from a JSON array request body,
+    or from an NDJSON body (application/x-ndjson) with one object per line
+    """
+    if request.mimetype == 'application/x-ndjson':
+        return bulk_items(request.stream, ndjson=True)
+    return bulk_items(request.get_json())
+
+
+@app.route('/api/v1/exams/', methods=['POST'])
+@requires_token
+def create_exams():
+    """
+    Creates or updates many exams in one transaction, returning their external ids in order
+    """
+    try:
+        exam_ids = app.db.save_exams(read_bulk_items(), request.headers.get('Authorization'))
+    except RequestError as ex:
+        abort(ex.code, ex.description)
+    except (KeyError, TypeError, ValueError) as ex:
+        abort(400, 'Invalid exam: %r' % ex)
+    for exam_id in exam_ids:
+        app.exam_cache.delete(exam_id)
+    return jsonify({'ids': exam_ids})
+
+
+@app.route('/api/v1/attempts/', methods=['POST'])
+@requires_token
+def create_attempts():
+    """
+    Creates many attempts in one transaction, returning their ids in order.
+    Each attempt must include its exam_id.
+    """
+    try:
+        saved = save_bulk_attempts(app.db, read_bulk_items())
+    except RequestError as ex:
+        abort(ex.code, ex.description)
+    except (KeyError, TypeError, ValueError) as ex:
+        abort(400, 'Invalid attempt: %r' % ex)
+    for attempt_id, status in saved:
+        app.status_events.publish(attempt_id, status)
+    return jsonify({'ids': [attempt_id for attempt_id, _ in saved]})
+
+
 @app.route('/api/v1/exam/<exam_id>/attempt/<attempt_id>/', methods=['GET', 'PATCH'])
 @requires_token
 def exam_attempt_endpoint(exam_id, attempt_id):
@@ -143,59 +279,147 @@ def exam_attempt_endpoint(exam_id, attempt_id):
     """
     attempt = request.json
     response = {'id': attempt_id}
-    dbattempt = app.db.get_attempt(exam_id, attempt_id)
     if request.method == 'PATCH':
-        dbattempt.update(attempt)
-        app.db.save_attempt(dbattempt)
         status = attempt.get('status')
-        if status == 'submitted':
-            app.logger.info('Finished attempt %s. Sending a fake review in 10 seconds...', attempt_id)
-            threading.Timer(10, make_review_callback, args=[exam_id, attempt_id]).start()
-        else:
+        try:
+            dbattempt, changed = patch_attempt_status(app.db, exam_id, attempt_id, status)
+        except InvalidTransition as ex:
+            abort(409, str(ex))
+        if not dbattempt:
+            abort(404)
+        if changed:
+            app.status_events.publish(attempt_id, status)
+        if changed and status == 'submitted':
+            send_review_callback(exam_id, attempt_id, dbattempt)
+        elif changed:
             app.logger.info('Changed attempt %s status to %s', attempt_id, status)
         response['status'] = status
     elif request.method == 'GET':
-        download_url = f'{get_download_url()}?attempt={attempt_id}&exam={exam_id}'
-        response = dbattempt
-        response['download_url'] = download_url
-        response['instructions'] = proctoring_config['instructions']
-        response['rules'] = app.db.get_exam(exam_id).get('rules', {})
+        response = attempt_details(app.db, app.exam_cache, exam_id, attempt_id, get_download_url(),
+                                   app.config['EXAM_CACHE_SECONDS'])
     return jsonify(response)
 
 
-class CourseIdIterator(Iterable):
-    def __init__(self, client_id):
-        self.client_id = client_id
+# seconds between keep-alive comments on idle event streams
+EVENT_KEEPALIVE_SECONDS = 15
+
+
+@app.route('/api/v1/exam/<exam_id>/attempt/<attempt_id>/events/')
+@requires_token
+def attempt_events(exam_id, attempt_id):
+    """
+    Streams the attempt's status changes as server-sent events, starting with its current status.
+    The stream ends once the attempt is reviewed, or fails with an error.
+    """
+    if not reserve_event_stream():
+        abort(503, 'Too many event streams are open, poll the attempt instead')
+    # subscribe first, so that no change is missed while reading the current status
+    watcher = app.status_events.subscribe(attempt_id, Watcher())
+    attempt = app.db.get_attempt(exam_id, attempt_id)
+    if not attempt:
+        app.status_events.unsubscribe(attempt_id, watcher)
+        release_event_stream()
+        abort(404)
+    poll_seconds = app.config['EVENT_POLL_SECONDS']
+    wait = poll_seconds or EVENT_KEEPALIVE_SECONDS
+
+    def stream():
+        status = attempt['status']
+        idle = 0
+        yield format_event(status_event(attempt_id, status))
+        while status not in FINAL_STATUSES:
+            event = watcher.get(wait)
+            if event is None and poll_seconds:
+                current = app.db.get_attempt(exam_id, attempt_id).get('status')
+                if current and current != status:
+                    event = status_event(attempt_id, current)
+            if event is None:
+                idle += wait
+                if idle >= EVENT_KEEPALIVE_SECONDS:
+                    idle = 0
+                    yield ': keep-alive\n\n'
+                continue
+            if event['status'] == status:
+                # already read from storage
+                continue
+            idle = 0
+            status = event['status']
+            yield format_event(event)
+
+    response = Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    # called even if the stream is never read, as for HEAD requests or clients that disconnect early
+    response.call_on_close(lambda: app.status_events.unsubscribe(attempt_id, watcher))
+    response.call_on_close(release_event_stream)
+    return response
+
+
+def reserve_event_stream():
+    """
+    Counts a new event stream, returning False if MAX_EVENT_STREAMS are already open
+    """
+    with app.event_streams_lock:
+        limit = app.config['MAX_EVENT_STREAMS']
+        if limit is not None and app.event_streams >= limit:
+            return False
+        app.event_streams += 1
+        return True
+
+
+def release_event_stream():
+    with app.event_streams_lock:
+        app.event_streams -= 1
+
+
+@app.route('/api/v1/attempts/stats/')
+@requires_token
+def get_attempt_stats():
+    """
+    Returns the number of attempts in each status, and how long attempts stay in each status,
+    optionally for one course_id
+    """
+    return jsonify(app.db.get_attempt_stats(request.args.get('course_id')))
+
 
-    def __iter__(self):
-        for exam in app.db.get_exams():
-            yield exam['course_id']
+@app.route('/api/v1/stats/')
+@requires_token
+def get_stats():
+    """
+    Returns counters from the server's caches and callback queues
+    """
+    stats = {
+        'jwt_cache': app.jwt_cache.stats(),
+        'exam_cache': app.exam_cache.stats(),
+        'status_events': app.status_events.stats(),
+        'pending_callbacks': app.scheduler.pending,
+    }
+    if app.review_batcher:
+        stats['review_batches'] = app.review_batcher.get_stats()
+    return jsonify(stats)
+
+
+@app.route('/api/v1/profile/dump/', methods=['POST'])
+@requires_token
+def dump_profile():
+    """
+    Writes the profiles collected so far, returning the files written
+    """
+    if not app.profiler:
+        abort(404, 'Profiling is not enabled')
+    return jsonify({'paths': app.profiler.dump()})
 
 
 @app.route('/api/v1/instructor/<client_id>/')
 def instructor_dashboard(client_id):
-    secret = client_id + 'secret'
     token = request.args.get('jwt')
     if not token:
         abort(403, 'JWT token required')
-    decoded = jwt.decode(token, secret, issuer=client_id, course_id=CourseIdIterator(client_id), algorithms=["HS256"])
-    course_id = decoded['course_id']
-    exams = []
-    for exam_id in decoded.get('exam', []):
-        exam = app.db.get_exam(exam_id)
-        exams.append(exam)
-
-    for exam in app.db.get_exams():
-        if exam['course_id'] == course_id:
-            exams.append(exam)
-
-    context = {
-        'client_id': client_id,
-        'token': decoded,
-        'course_id': course_id,
-        'exams': exams,
-        'attempt_ids': decoded.get('attempt', []),
-    }
+    try:
+        context = dashboard_context(app.db, client_id, token, request.args.get('after'))
+    except RequestError as ex:
+        abort(ex.code, ex.description)
+    if context['next_after']:
+        context['next_url'] = url_for('instructor_dashboard', client_id=client_id, jwt=token,
+                                      after=context['next_after'])
     return render_template('dashboard.html', **context)
 
 
@@ -209,45 +433,196 @@ def software_download():
     exam_id = request.args.get('exam')
     attempt = app.db.get_attempt(exam_id, attempt_id)
     app.logger.info('Requesting download for attempt %s', attempt_id)
-    threading.Timer(2, make_ready_callback, args=[attempt_id, attempt]).start()
+    send_ready_callback(attempt_id, attempt)
     return render_template('download.html', attempt_id=attempt_id, exam_id=exam_id)
 
 
-def make_ready_callback(attempt_id, attempt):
+def send_ready_callback(attempt_id, attempt):
+    """
+    Sends the ready callback after the scenario's delay, through the outbox if it's enabled
+    """
+    if not attempt.get('lms_host'):
+        app.logger.warning('Not sending ready callback for unknown attempt %s', attempt_id)
+        return
+    delay = app.scenario.ready_delay()
+    if app.outbox:
+        app.outbox.enqueue('ready', *ready_callback_request(attempt_id, attempt), delay=delay)
+        return
     try:
-        callback_url = '%s/api/edx_proctoring/v1/proctored_exam/attempt/%s/ready' % (attempt['lms_host'], attempt_id)
-        payload = {
-            'status': 'ready'
-        }
-        app.logger.info('Calling back to %s', callback_url)
-        response = app.client.post(callback_url, json=payload).json()
-        app.logger.info('Got ready response from LMS: %s', response)
-    except Exception as ex:
-        app.logger.exception('in ready callback')
-        if hasattr(ex, 'response'):
-            app.logger.info('LMS error response: %r', ex.response.content)
+        app.scheduler.schedule(delay, make_ready_callback, attempt_id, attempt)
+    except SchedulerFull as ex:
+        app.logger.warning('Not sending ready callback for attempt %s: %s', attempt_id, ex)
+
 
+def send_review_callback(exam_id, attempt_id, attempt):
+    """
+    Sends the review the scenario draws for the attempt after its delay, through the outbox if it's enabled
+    """
+    delay, status, comments = app.scenario.review()
+    app.logger.info('Finished attempt %s. Sending a fake %s review in %.1f seconds...', attempt_id, status, delay)
+    if app.outbox:
+        app.outbox.enqueue('review', *review_callback_request(attempt_id, attempt, status, comments), delay=delay)
+        return
+    try:
+        app.scheduler.schedule(delay, make_review_callback, exam_id, attempt_id, status, comments)
+    except SchedulerFull as ex:
+        app.logger.warning('Not sending review for attempt %s: %s', attempt_id, ex)
+
+
+@profiled('ready_callback')
+def make_ready_callback(attempt_id, attempt):
+    post_callback('ready', *ready_callback_request(attempt_id, attempt))
 
-def make_review_callback(exam_id, attempt_id):
+
+@profiled('review_callback')
+def make_review_callback(exam_id, attempt_id, status, comments):
+    attempt = app.db.get_attempt(exam_id, attempt_id)
+    callback_url, payload = review_callback_request(attempt_id, attempt, status, comments)
+    if app.review_batcher:
+        app.review_batcher.add(attempt['lms_host'], attempt_id, callback_url, payload)
+    else:
+        post_callback('review', callback_url, payload)
+
+
+def post_callback(name, callback_url, payload):
+    """
+    Posts the callback payload to the LMS and logs the response.
+    Returns a :class:`concurrent.futures.Future` for the response.
+    With async callbacks enabled, this returns without waiting for the LMS.
+    """
+    app.logger.info('Calling back to %s', callback_url)
+    lms_host = urlparse(callback_url).netloc
+    start = time.perf_counter()
+    app.callbacks_in_flight.inc()
+    if app.async_client:
+        future = app.async_client.post(callback_url, payload)
+    else:
+        future = Future()
+        try:
+            response = app.client.post(callback_url, json=payload, timeout=app.config.get('CALLBACK_TIMEOUT'))
+            response.raise_for_status()
+            future.set_result(response.json())
+        except Exception as ex:
+            future.set_exception(ex)
+    future.add_done_callback(lambda future: log_callback_result(name, callback_url, future, lms_host, start))
+    return future
+
+
+def log_callback_result(name, callback_url, future, lms_host, start):
+    app.callbacks_in_flight.dec()
+    app.callback_latency.observe(time.perf_counter() - start, lms_host=lms_host)
+    result = 'failure' if future.exception() else 'success'
+    app.callback_count.inc(kind=name, lms_host=lms_host, result=result)
+    if app.capture:
+        app.capture.record_callback(start, name, callback_attempt_id(callback_url), result)
     try:
-        attempt = app.db.get_attempt(exam_id, attempt_id)
-        callback_url = '%s/api/edx_proctoring/v1/proctored_exam/attempt/%s/reviewed' % (attempt['lms_host'], attempt_id)
-        status = 'passed'
-        comments = [
-            {'comment': 'Looks suspicious', 'status': 'ok'}
-        ]
-        payload = {
-            'status': status,
-            'comments': comments
-        }
-        app.logger.info('Calling back to %s', callback_url)
-        response = app.client.post(callback_url, json=payload).json()
+        response = future.result()
     except Exception as ex:
-        app.logger.exception('in review callback')
-        if hasattr(ex, 'response'):
-            app.logger.info('LMS error response: %r', ex.response.content)
+        log_callback_error(name, ex)
     else:
-        app.logger.info('Got review response from LMS: %s', response)
+        app.logger.info('Got %s response from LMS: %s', name, response)
+        attempt_id = callback_attempt_id(callback_url)
+        if not attempt_id:
+            return
+        if not app.async_client:
+            record_callback_status(attempt_id, CALLBACK_STATUSES[name])
+            return
+        # async callbacks finish on the client's event loop, which mustn't wait for storage
+        try:
+            app.scheduler.schedule(0, record_callback_status, attempt_id, CALLBACK_STATUSES[name])
+        except SchedulerFull as ex:
+            app.logger.warning('Not recording the %s callback for attempt %s: %s', name, attempt_id, ex)
+
+
+def record_callback_status(attempt_id, status):
+    """
+    Moves the attempt to the status that delivering its callback brings it to, and tells its watchers
+    """
+    try:
+        attempt = app.db.transition_attempt(attempt_id, status)
+    except InvalidTransition as ex:
+        app.logger.warning('Not recording the %s callback for attempt %s: %s', status, attempt_id, ex)
+        return
+    if attempt and attempt['previous_status'] != status:
+        app.status_events.publish(attempt_id, status)
+
+
+def log_callback_error(name, ex):
+    app.logger.error('in %s callback', name, exc_info=ex)
+    if hasattr(ex, 'response'):
+        app.logger.info('LMS error response: %r', ex.response.content)
+
+
+def configure(args):
+    """
+    Sets up storage and callback delivery from the command line arguments.
+    No background threads are started here.
+    """
+    init_app(app, engine=args.db_engine, dbpath=args.db_path)
+    app.config['CALLBACK_TIMEOUT'] = args.callback_timeout
+    app.config['EXAM_CACHE_SECONDS'] = args.exam_cache_seconds
+    app.config['EVENT_POLL_SECONDS'] = args.event_poll_seconds
+    if args.capture:
+        init_capture(app, args.capture)
+    if args.profile_dir and not app.profiler:
+        init_profiling(app, args.profile_dir, args.profile_rate)
+        atexit.register(app.profiler.dump)
+    app.scheduler = CallbackScheduler(app.logger, workers=args.callback_workers, max_pending=args.max_pending_callbacks)
+    app.client = OAuthAPIClient(args.lms_host, args.client_id, args.client_secret,
+                                token_skew=args.token_skew, token_cache_path=args.token_cache)
+    if args.async_callbacks:
+        app.async_client = AsyncCallbackClient(app.client, max_in_flight=args.max_inflight_callbacks,
+                                               timeout=args.callback_timeout)
+        atexit.register(app.async_client.shutdown)
+    if args.batch_window:
+        app.review_batcher = ReviewBatcher(
+            app.scheduler,
+            lambda callback_url, payload: post_callback('review', callback_url, payload),
+            app.logger,
+            window=args.batch_window,
+            max_parallel=args.batch_parallel,
+            rate=args.batch_rate,
+        )
+        atexit.register(app.review_batcher.shutdown)
+    if args.outbox:
+        # with async callbacks, only claim what the client will send straight away, so leases aren't spent queueing
+        max_in_flight = args.max_inflight_callbacks if args.async_callbacks else None
+        app.outbox = OutboxWorker(app.db, post_callback, app.logger, lease=args.callback_lease, node_id=args.node_id,
+                                  max_in_flight=max_in_flight)
+        atexit.register(app.outbox.shutdown)
+
+
+def run_workers(args):
+    """
+    Serves the app with gunicorn, using args.workers processes of args.threads threads each.
+    Callbacks go through the database outbox, so any process can deliver them.
+    """
+    # an event stream holds its thread until it ends, so always leave one for the API
+    app.config['MAX_EVENT_STREAMS'] = args.threads - 1
+    try:
+        from gunicorn.app.base import BaseApplication  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        sys.exit('gunicorn is required for --workers: pip install gunicorn')
+
+    def post_fork(server, worker):  # pylint: disable=unused-argument
+        # database connections and threads don't survive a fork
+        app.db.close()
+        if app.outbox:
+            app.outbox.start()
+
+    class MockProckApplication(BaseApplication):  # pylint: disable=abstract-method
+        def load_config(self):
+            self.cfg.set('bind', args.bind)
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('post_fork', post_fork)
+
+        def load(self):
+            return app
+
+    app.db.close()
+    MockProckApplication().run()
 
 
 if __name__ == '__main__':
@@ -258,6 +633,63 @@ if __name__ == '__main__':
     parser.add_argument("client_id", type=str, help="oauth client id", nargs="?")
     parser.add_argument("client_secret", type=str, help="oauth client secret", nargs="?")
     parser.add_argument('-l', dest='lms_host', type=str, help='LMS host', default='http://host.docker.internal:18000')
+    parser.add_argument('--db', dest='db_engine', choices=('sqlite', 'memory'), default='sqlite',
+                        help='storage engine. memory is not durable, but never touches the filesystem')
+    parser.add_argument('--db-path', dest='db_path', type=str, help='sqlite database path', default='mockprock.sqlite')
+    parser.add_argument('--callback-workers', dest='callback_workers', type=int, default=4,
+                        help='number of threads sending callbacks to the LMS')
+    parser.add_argument('--max-pending-callbacks', dest='max_pending_callbacks', type=int, default=10000,
+                        help='callbacks beyond this many waiting are dropped')
+    parser.add_argument('--async-callbacks', dest='async_callbacks', default=False, action='store_true',
+                        help='send callbacks from an asyncio event loop (requires aiohttp)')
+    parser.add_argument('--max-inflight-callbacks', dest='max_inflight_callbacks', type=int, default=100,
+                        help='limit on concurrent requests to the LMS with --async-callbacks')
+    parser.add_argument('--callback-timeout', dest='callback_timeout', type=float, default=30,
+                        help='seconds to wait for the LMS to respond to a callback')
+    parser.add_argument('--batch-reviews', dest='batch_window', type=float, default=0,
+                        help='group review callbacks due within this many seconds per LMS host. '
+                             'Not available with the outbox')
+    parser.add_argument('--batch-parallel', dest='batch_parallel', type=int, default=4,
+                        help='concurrent requests when sending a batch of reviews')
+    parser.add_argument('--batch-rate', dest='batch_rate', type=float, default=20,
+                        help='max review callbacks per second to each LMS host when batching')
+    parser.add_argument('--outbox', dest='outbox', default=False, action='store_true',
+                        help='store callbacks in the database and retry them until the LMS accepts them')
+    parser.add_argument('--callback-lease', dest='callback_lease', type=float, default=60,
+                        help='seconds a process holds a callback from the outbox before another may send it')
+    parser.add_argument('--cluster', dest='cluster', default=False, action='store_true',
+                        help='run as one of several nodes sharing the --db-path database. Implies --outbox')
+    parser.add_argument('--node-id', dest='node_id', type=str, default=None,
+                        help='name of this node in callback leases. Defaults to the hostname')
+    parser.add_argument('--token-cache', dest='token_cache', type=str, default=None,
+                        help='file to keep the LMS access token in across restarts')
+    parser.add_argument('--token-skew', dest='token_skew', type=int, default=60,
+                        help='seconds before expiration to refresh the LMS access token')
+    parser.add_argument('--exam-cache-seconds', dest='exam_cache_seconds', type=float, default=None,
+                        help='seconds to cache exams for. Defaults to until the exam is saved, '
+                             'or 5 seconds with --workers or --cluster')
+    parser.add_argument('--event-poll-seconds', dest='event_poll_seconds', type=float, default=None,
+                        help='seconds between reads of the attempt on its event stream. Defaults to never, '
+                             'as status changes are pushed, or 2 seconds with --workers or --cluster')
+    parser.add_argument('--scenario', dest='scenario', type=str, default=None,
+                        help='JSON file of callback delays and review outcomes to play, see mockprock.scenarios. '
+                             'With --workers, each worker plays the scenario separately')
+    parser.add_argument('--time-scale', dest='time_scale', type=float, default=None,
+                        help="divide the scenario's delays by this, overriding the file")
+    parser.add_argument('--bind', dest='bind', type=str, default='0.0.0.0:11136', help='address and port to listen on')
+    parser.add_argument('--workers', dest='workers', type=int, default=0,
+                        help='serve with this many gunicorn worker processes instead of the development server')
+    parser.add_argument('--threads', dest='threads', type=int, default=4,
+                        help='threads per worker process. Each open attempt event stream holds one, '
+                             'so a worker serves at most threads - 1 streams')
+    parser.add_argument('--profile', dest='profile_dir', type=str, default=None,
+                        help='profile requests and callbacks, writing the stats to this directory')
+    parser.add_argument('--profile-rate', dest='profile_rate', type=float, default=1.0,
+                        help='fraction of requests and callbacks to profile')
+    parser.add_argument('--capture', dest='capture', type=str, default=None,
+                        help='record requests and callbacks to this file for mockprock-replay, gzipped if it ends in .gz')
+    parser.add_argument('--no-debug', dest='debug', default=True, action='store_false',
+                        help='turn off the debugger and printing of request payloads')
     args = parser.parse_args()
 
     if not (args.client_id and args.client_secret):
@@ -266,5 +698,37 @@ if __name__ == '__main__':
         import webbrowser
         webbrowser.open('%s/admin/oauth2_provider/application/' % args.lms_host)
         sys.exit(1)
-    app.client = OAuthAPIClient(args.lms_host, args.client_id, args.client_secret)
-    app.run(host='0.0.0.0', port=11136)
+    if args.workers or args.cluster:
+        if args.db_engine == 'memory':
+            sys.exit('--workers and --cluster require the sqlite storage engine')
+        args.outbox = True
+        if args.exam_cache_seconds is None:
+            args.exam_cache_seconds = 5
+        if args.event_poll_seconds is None:
+            args.event_poll_seconds = 2
+    if args.outbox and args.batch_window:
+        sys.exit('--batch-reviews can\'t be used with --outbox, --workers or --cluster, '
+                 'which send reviews from the outbox')
+    if args.outbox and args.callback_lease <= args.callback_timeout:
+        sys.exit('--callback-lease must be longer than --callback-timeout, or callbacks may be sent twice')
+    if args.capture and args.workers:
+        sys.exit('--capture records a single process, and can\'t be used with --workers')
+    if args.scenario or args.time_scale is not None:
+        try:
+            app.scenario = load_scenario(args.scenario, args.time_scale)
+        except (OSError, ValueError) as ex:
+            sys.exit(str(ex))
+    app.debug = app.config['DUMP_REQUESTS'] = args.debug
+    if args.workers:
+        configure(args)
+        run_workers(args)
+    else:
+        # with debug on, the reloader runs this script twice: in a parent that only watches
+        # for code changes, and in the child that serves. Only the child opens storage,
+        # the capture file and the outbox
+        if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            configure(args)
+            if app.outbox:
+                app.outbox.start()
+        host, _, port = args.bind.rpartition(':')
+        app.run(host=host or '0.0.0.0', port=int(port))
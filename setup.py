@@ -126,11 +126,17 @@ setup(
     install_requires=load_requirements("requirements/base.txt"),
     extras_require={
         'server': load_requirements("requirements/server.txt"),
+        # conflicts with the server extra, so install it in its own environment
+        'asgi': load_requirements("requirements/asgi.txt"),
     },
     entry_points={
         'openedx.proctoring': [
             'mockprock = mockprock.backend:MockProckBackend',
         ],
-        'console_scripts': ['get-dashboard=mockprock.commands:get_url'],
+        'console_scripts': [
+            'get-dashboard=mockprock.commands:get_url',
+            'mockprock-bench=mockprock.bench:main',
+            'mockprock-replay=mockprock.replay:main',
+        ],
     },
 )
@@ -22,25 +22,46 @@ const makeRequest = ({url, method}) => {
   });
 };
 
+const UPLOAD_POLL_MILLISECONDS = 2000;
+
+const delay = milliseconds => new Promise(resolve => setTimeout(resolve, milliseconds));
+
 console.log('hello from MockProck!');
 
 class MockProctoringEventHandler {
   constructor({baseUrl = 'http://localhost:11136'}) {
     this.baseUrl = baseUrl;
+    this.attemptId = null;
+  }
+  desktopUrl(action) {
+    const query = this.attemptId ? `?attempt=${encodeURIComponent(this.attemptId)}` : '';
+    return `${this.baseUrl}/desktop/${action}${query}`;
   }
   onStartExamAttempt(timeout, attemptId) {
     console.log(`MockProctoringEventHandler - onStartExamAttempt(${timeout} ${attemptId}) called`);
-    return makeRequest({url: `${this.baseUrl}/desktop/start`, method: 'POST'})
+    this.attemptId = attemptId;
+    return makeRequest({url: this.desktopUrl('start'), method: 'POST'})
       .then(response => response.status === "running" ? Promise.resolve() : Promise.reject());
   }
   onEndExamAttempt() {
     console.log("MockProctoringEventHandler - onEndExamAttempt() called");
-    return makeRequest({url: `${this.baseUrl}/desktop/stop`, method: 'POST'})
-      .then(response => response.status === "uploading" ? Promise.resolve() : Promise.reject());
+    return makeRequest({url: this.desktopUrl('stop'), method: 'POST'})
+      .then(response => response.status === "uploading" ? this.waitForUpload() : Promise.reject());
+  }
+  waitForUpload() {
+    // the desktop app uploads the session in the background, so ending the exam waits for it here
+    return delay(UPLOAD_POLL_MILLISECONDS)
+      .then(() => makeRequest({url: this.desktopUrl('ping'), method: 'GET'}))
+      .then(response => {
+        if (response.status === "uploading") {
+          return this.waitForUpload();
+        }
+        return response.status === "stopped" ? Promise.resolve() : Promise.reject();
+      });
   }
   onPing(timeout) {
     console.log(`MockProctoringEventHandler - onPing(${timeout}) called`);
-    return makeRequest({url: `${this.baseUrl}/desktop/ping`, method: 'GET'})
+    return makeRequest({url: this.desktopUrl('ping'), method: 'GET'})
       .then(response => response.status === "running" ? Promise.resolve() : Promise.reject());
   }
 }
@@ -0,0 +1,108 @@
+"""
+Tests for the ASGI app. Quart needs a newer Flask than the Flask server,
+so these only run in an environment with requirements/asgi.txt installed.
+"""
+import asyncio
+from concurrent.futures import Future
+import threading
+
+import pytest
+
+pytest.importorskip('quart')
+
+from mockprock import asgi  # pylint: disable=wrong-import-position
+from mockprock.proctoring import ready_callback_request  # pylint: disable=wrong-import-position
+
+EXAM = {'course_id': 'course-v1:a+b+c', 'exam_name': 'exam', 'is_practice_exam': False, 'rules': {}}
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # as served by an ASGI server that imports the app
+    monkeypatch.setenv('MOCKPROCK_ARGS', 'c csecret -l http://lms --outbox --db-path %s' % (tmp_path / 'db.sqlite'))
+    for name in ('db', 'callback_client', 'outbox'):
+        monkeypatch.setattr(asgi.app, name, None)
+    return asgi.app
+
+
+def serve(app, test):  # pylint: disable=redefined-outer-name
+    async def run():
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            data = {'grant_type': 'client_credentials', 'client_id': 'c', 'client_secret': 'csecret',
+                    'token_type': 'jwt'}
+            token = (await (await client.post('/oauth2/access_token', form=data)).get_json())['access_token']
+            await test(client, {'Authorization': 'JWT %s' % token})
+    asyncio.run(run())
+
+
+def test_configured_from_environment(app):  # pylint: disable=redefined-outer-name
+    async def test(client, headers):  # pylint: disable=unused-argument
+        assert app.callback_client.oauth_client._base_url == 'http://lms'  # pylint: disable=protected-access
+        assert app.outbox is not None
+
+    serve(app, test)
+
+
+def test_bulk_items_must_be_objects(app):  # pylint: disable=redefined-outer-name
+    async def test(client, headers):
+        assert (await client.post('/api/v1/exams/', json=[5], headers=headers)).status_code == 400
+        response = await client.post('/api/v1/exams/', json=[EXAM], headers=headers)
+        exam_id = (await response.get_json())['ids'][0]
+        attempt = {'exam_id': exam_id, 'status': 'created', 'user_id': 1, 'full_name': 'Student',
+                   'email': 'student@example.com', 'lms_host': 'http://lms'}
+        assert (await client.post('/api/v1/attempts/', json=[attempt, 5], headers=headers)).status_code == 400
+        assert (await client.post('/api/v1/attempts/', json=[attempt], headers=headers)).status_code == 200
+        assert (await app.db.get_attempt_stats())['statuses'] == {'created': 1}
+
+    serve(app, test)
+
+
+def test_download_of_unknown_attempt(app):  # pylint: disable=redefined-outer-name
+    async def test(client, headers):  # pylint: disable=unused-argument
+        assert (await client.get('/download?exam=1&attempt=2')).status_code == 200
+        assert (await client.get('/download')).status_code == 200
+        assert not await app.db.run(app.db.db.claim_callbacks, 10, 60)
+
+    serve(app, test)
+
+
+def test_outbox_records_delivery_off_the_loop(app, monkeypatch):  # pylint: disable=redefined-outer-name
+    async def test(client, headers):
+        response = await client.post('/api/v1/exams/', json=[EXAM], headers=headers)
+        exam_id = (await response.get_json())['ids'][0]
+        attempt = {'exam_id': exam_id, 'status': 'created', 'user_id': 1, 'full_name': 'Student',
+                   'email': 'student@example.com', 'lms_host': 'http://lms'}
+        response = await client.post('/api/v1/attempts/', json=[attempt], headers=headers)
+        attempt_id = (await response.get_json())['ids'][0]
+        threads = []
+        transition_attempt = app.db.db.transition_attempt
+
+        def recording_transition(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return transition_attempt(*args, **kwargs)
+        monkeypatch.setattr(app.db.db, 'transition_attempt', recording_transition)
+        delivery = Future()
+        monkeypatch.setattr(app.callback_client, 'post', lambda url, payload: delivery)
+
+        asgi.outbox_send('ready', *ready_callback_request(attempt_id, attempt))
+        delivery.set_result({'status': 'ok'})
+        for _ in range(100):
+            if threads:
+                break
+            await asyncio.sleep(0.01)
+        assert threads and threads[0].startswith('mockprock-db')
+
+    serve(app, test)
+
+
+def test_patch_of_unknown_attempt(app):  # pylint: disable=redefined-outer-name
+    async def test(client, headers):
+        response = await client.post('/api/v1/exams/', json=[EXAM], headers=headers)
+        exam_id = (await response.get_json())['ids'][0]
+        path = '/api/v1/exam/%s/attempt/unknown/' % exam_id
+        assert (await client.patch(path, json={'status': 'submitted'}, headers=headers)).status_code == 404
+        assert (await client.patch(path, json={}, headers=headers)).status_code == 404
+        assert not await app.db.run(app.db.db.claim_callbacks, 10, 60)
+
+    serve(app, test)
@@ -0,0 +1,75 @@
+"""
+Tests for batching review callbacks
+"""
+from concurrent.futures import Future
+import logging
+import threading
+import time
+
+from mockprock.batching import ReviewBatcher
+from mockprock.scheduler import CallbackScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingLMS:
+    """
+    Records when each callback was sent, failing those whose payload asks for it
+    """
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, callback_url, payload):
+        with self._lock:
+            self.sent.append((time.monotonic(), callback_url))
+        future = Future()
+        if payload.get('fail'):
+            future.set_exception(RuntimeError('LMS error'))
+        else:
+            future.set_result({'status': 'ok'})
+        return future
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_rate_limited_sends_are_scheduled():
+    scheduler = CallbackScheduler(logger)
+    lms = RecordingLMS()
+    batcher = ReviewBatcher(scheduler, lms.send, logger, window=0.05, max_parallel=1, rate=10)
+    try:
+        for attempt_id in range(4):
+            batcher.add('lms', attempt_id, 'http://lms/%d' % attempt_id, {'fail': attempt_id == 3})
+        batcher.add('lms', 0, 'http://lms/0', {})
+        assert wait_for(lambda: len(lms.sent) == 4, timeout=5)
+        assert wait_for(lambda: batcher.get_stats()['sent'] == 3, timeout=1)
+        assert batcher.get_stats() == {'sent': 3, 'failed': 1, 'coalesced': 1, 'delayed': 3}
+        times = [sent_at for sent_at, _ in lms.sent]
+        assert all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:]))
+    finally:
+        batcher.shutdown()
+        scheduler.shutdown()
+
+
+def test_rate_limited_host_doesnt_hold_up_others():
+    scheduler = CallbackScheduler(logger)
+    lms = RecordingLMS()
+    batcher = ReviewBatcher(scheduler, lms.send, logger, window=0.05, max_parallel=1, rate=1)
+    try:
+        for attempt_id in range(3):
+            batcher.add('slow-lms', attempt_id, 'http://slow-lms/%d' % attempt_id, {})
+        time.sleep(0.1)
+        start = time.monotonic()
+        batcher.add('lms', 0, 'http://lms/0', {})
+        assert wait_for(lambda: 'http://lms/0' in [url for _, url in lms.sent], timeout=5)
+        assert time.monotonic() - start < 0.5
+    finally:
+        batcher.shutdown()
+        scheduler.shutdown()
@@ -0,0 +1,64 @@
+"""
+Tests for recording captures of the server's traffic
+"""
+import gzip
+import importlib
+
+import jwt
+import pytest
+
+from mockprock.capture import read_capture
+from mockprock.db import MemoryDB
+
+EXAM = {'course_id': 'course-v1:a+b+c', 'exam_name': 'exam', 'is_practice_exam': False, 'rules': {}}
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    module = importlib.import_module('mockprock.server')
+    app = module.app
+    monkeypatch.setattr(app, 'db', MemoryDB(app.logger))
+    monkeypatch.setattr(app, 'capture', None)
+    monkeypatch.setattr(app, 'debug', False)
+    monkeypatch.setitem(app.config, 'DUMP_REQUESTS', False)
+    # the capture's hooks are only added for this test
+    for name in ('before_request_funcs', 'after_request_funcs'):
+        monkeypatch.setattr(app, name, {key: list(funcs) for key, funcs in getattr(app, name).items()})
+    return module
+
+
+@pytest.mark.parametrize('name', ['capture.ndjson', 'capture.ndjson.gz'])
+def test_credentials_are_left_out(server, tmp_path, name):  # pylint: disable=redefined-outer-name
+    path = str(tmp_path / name)
+    recorder = server.init_capture(server.app, path)
+    client = server.app.test_client()
+    data = {'grant_type': 'client_credentials', 'client_id': 'c', 'client_secret': 'csecret', 'token_type': 'jwt'}
+    token = client.post('/oauth2/access_token', data=data).json['access_token']
+    headers = {'Authorization': 'JWT %s' % token}
+    exam_id = client.post('/api/v1/exam/', json=EXAM, headers=headers).json['id']
+    attempt = {'status': 'created', 'user_id': 1, 'full_name': 'Student', 'email': 'student@example.com',
+               'lms_host': 'http://lms'}
+    response = client.post('/api/v1/exam/%s/attempt/' % exam_id, json=attempt, headers=headers)
+    attempt_id = response.json['id']
+    dashboard_token = jwt.encode({'course_id': EXAM['course_id'], 'iss': 'c'}, 'csecret', algorithm='HS256')
+    assert client.get('/api/v1/instructor/c/', query_string={'jwt': dashboard_token}).status_code == 200
+    assert client.get('/api/v1/exam/%s/' % exam_id, headers={'Authorization': 'JWT wrong'}).status_code == 403
+    recorder.close()
+
+    opener = gzip.open if name.endswith('.gz') else open
+    with opener(path, 'rt') as capture_file:
+        text = capture_file.read()
+    for secret in ('csecret', token, dashboard_token, 'JWT wrong'):
+        assert secret not in text
+    records = [record for record in read_capture(path) if record['type'] == 'request']
+    assert [(record['method'], record['route'], record['status']) for record in records] == [
+        ('POST', '/oauth2/access_token', 200),
+        ('POST', '/api/v1/exam/', 200),
+        ('POST', '/api/v1/exam/<exam_id>/attempt/', 200),
+        ('GET', '/api/v1/exam/<exam_id>/', 403),
+    ]
+    assert records[0]['body'] is None
+    assert [record['ids'] for record in records] == [[], [exam_id], [attempt_id], []]
+    # the body as the LMS sent it, before the server added ids
+    assert records[2]['body'] == attempt
@@ -0,0 +1,132 @@
+"""
+Tests for the LMS clients' access token handling
+"""
+import datetime
+import json
+import multiprocessing
+import os
+import stat
+
+from mockprock.fake_lms import FakeLMS, FakeLMSHandler
+from mockprock.rest_api_client.async_client import AsyncCallbackClient
+from mockprock.rest_api_client.client import OAuthAPIClient, TokenCache
+
+CALLBACK_PATH = '/api/edx_proctoring/v1/proctored_exam/attempt/1/ready'
+
+
+class RevokingLMSHandler(FakeLMSHandler):
+    """
+    Hands out a new token on each request, and accepts callbacks only with the current one
+    """
+    def do_POST(self):  # pylint: disable=invalid-name
+        lms = self.server.lms
+        if self.path.startswith('/oauth2/access_token'):
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            lms.token_requests += 1
+            self.send_json({'access_token': lms.current_token(), 'expires_in': 3600})
+        elif self.headers.get('Authorization') != 'JWT %s' % lms.current_token():
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            self.send_error(401)
+        else:
+            super().do_POST()
+
+    def send_json(self, response):
+        data = json.dumps(response).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class RevokingLMS(FakeLMS):
+    def __init__(self):
+        super().__init__()
+        self.server.RequestHandlerClass = RevokingLMSHandler
+        self.generation = 0
+
+    def current_token(self):
+        return 'token-%d-%d' % (self.generation, self.token_requests)
+
+    def revoke_tokens(self):
+        self.generation += 1
+
+
+def tokens(prefix):
+    issued = []
+
+    def fetch():
+        issued.append('%s-%d' % (prefix, len(issued)))
+        return issued[-1], datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    return fetch
+
+
+def test_cached_token_is_private_and_keyed_by_lms(tmp_path):
+    path = str(tmp_path / 'token.json')
+    TokenCache(tokens('a'), 'http://lms-a client', path=path).get()
+    TokenCache(tokens('b'), 'http://lms-b client', path=path).get()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    with open(path) as cache_file:
+        assert sorted(json.load(cache_file)) == ['http://lms-a client', 'http://lms-b client']
+
+    # each LMS reuses its own token after a restart
+    assert TokenCache(tokens('x'), 'http://lms-a client', path=path).get() == 'a-0'
+    assert TokenCache(tokens('x'), 'http://lms-b client', path=path).get() == 'b-0'
+    assert TokenCache(tokens('x'), 'http://lms-c client', path=path).get() == 'x-0'
+
+
+def expired_tokens():
+    return 'token', datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+
+
+def refresh_repeatedly(path, start, times):
+    cache = TokenCache(expired_tokens, 'http://lms client', path=path)
+    start.wait()
+    for _ in range(times):
+        cache.get()
+
+
+def test_processes_save_at_once(tmp_path):
+    # gunicorn workers share the token cache, and refresh together since they forked with the same token
+    path = str(tmp_path / 'token.json')
+    context = multiprocessing.get_context('spawn')
+    start = context.Event()
+    processes = [context.Process(target=refresh_repeatedly, args=(path, start, 500)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    start.set()
+    for process in processes:
+        process.join(60)
+    assert [process.exitcode for process in processes] == [0] * len(processes)
+    assert os.listdir(str(tmp_path)) == ['token.json']
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    with open(path) as cache_file:
+        assert json.load(cache_file)['http://lms client']['access_token'] == 'token'
+
+
+def test_failing_to_save_keeps_the_token(tmp_path):
+    cache = TokenCache(tokens('a'), 'http://lms client', path=str(tmp_path / 'missing' / 'token.json'))
+    assert cache.get() == 'a-0'
+
+
+def test_rejected_token_is_replaced(tmp_path):
+    lms = RevokingLMS().start()
+    try:
+        path = str(tmp_path / 'token.json')
+        client = OAuthAPIClient(lms.url, 'client', 'secret', token_cache_path=path)
+        assert client.post(lms.url + CALLBACK_PATH, json={}).status_code == 200
+        # a restarted LMS no longer accepts the token saved in the file
+        lms.revoke_tokens()
+        client = OAuthAPIClient(lms.url, 'client', 'secret', token_cache_path=path)
+        assert client.post(lms.url + CALLBACK_PATH, json={}).status_code == 200
+        assert client.token_cache.refreshes == 1
+
+        lms.revoke_tokens()
+        async_client = AsyncCallbackClient(client)
+        try:
+            assert async_client.post(lms.url + CALLBACK_PATH, {}).result(10) == {'status': 'ok'}
+        finally:
+            async_client.shutdown()
+        assert client.token_cache.refreshes == 2
+    finally:
+        lms.stop()
@@ -0,0 +1,269 @@
+"""
+Tests for the storage engines
+"""
+import logging
+import multiprocessing
+import sqlite3
+
+import pytest
+
+from mockprock import db as db_module
+from mockprock.db import MIGRATIONS, InvalidTransition, MemoryDB, SQLiteDB
+
+logger = logging.getLogger(__name__)
+
+
+def new_exam(db, course_id='course-v1:a+b+c'):
+    return db.save_exam({'course_id': course_id, 'exam_name': 'exam', 'is_practice_exam': False})
+
+
+def new_attempt(db, exam_id, status='created'):
+    attempt = {
+        'exam_id': exam_id,
+        'status': status,
+        'user_id': 1,
+        'full_name': 'Student',
+        'email': 'student@example.com',
+        'lms_host': 'http://lms',
+    }
+    db.save_attempt(attempt)
+    return attempt['id']
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def db(request, tmp_path):
+    if request.param == 'memory':
+        storage = MemoryDB(logger)
+    else:
+        storage = SQLiteDB(str(tmp_path / 'mockprock.sqlite'), logger)
+    storage.setup()
+    yield storage
+    storage.close()
+
+
+def user_version(dbpath):
+    conn = sqlite3.connect(dbpath)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def set_up(dbpath, start):
+    start.wait()
+    SQLiteDB(dbpath, logger).setup()
+
+
+def test_concurrent_setup(tmp_path):
+    # nodes of a cluster start on the same new database at once
+    dbpath = str(tmp_path / 'mockprock.sqlite')
+    context = multiprocessing.get_context('spawn')
+    start = context.Event()
+    processes = [context.Process(target=set_up, args=(dbpath, start)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    start.set()
+    for process in processes:
+        process.join(30)
+    assert [process.exitcode for process in processes] == [0] * len(processes)
+    assert user_version(dbpath) == len(MIGRATIONS)
+
+
+def test_setup_is_idempotent(tmp_path):
+    dbpath = str(tmp_path / 'mockprock.sqlite')
+    SQLiteDB(dbpath, logger).setup()
+    db = SQLiteDB(dbpath, logger)
+    db.setup()
+    new_attempt(db, new_exam(db))
+    SQLiteDB(dbpath, logger).setup()
+    with db.connect() as conn:
+        assert conn.execute('select count(*) from attempt_events').fetchone()[0] == 1
+
+
+def test_failed_migration_is_rolled_back(tmp_path, monkeypatch):
+    dbpath = str(tmp_path / 'mockprock.sqlite')
+    SQLiteDB(dbpath, logger).setup()
+    broken = '''
+    CREATE TABLE extra (id TEXT);
+    ALTER TABLE outbox ADD COLUMN claimed_by TEXT'''
+    monkeypatch.setattr(db_module, 'MIGRATIONS', MIGRATIONS + ['ALTER TABLE exams ADD COLUMN extra TEXT', broken])
+    with pytest.raises(sqlite3.OperationalError):
+        SQLiteDB(dbpath, logger).setup()
+    assert user_version(dbpath) == len(MIGRATIONS)
+    conn = sqlite3.connect(dbpath)
+    try:
+        assert 'extra' not in [row[1] for row in conn.execute('PRAGMA table_info(exams)')]
+        assert conn.execute("select name from sqlite_master where name = 'extra'").fetchone() is None
+    finally:
+        conn.close()
+
+
+def test_attempt_stats_by_course(db):  # pylint: disable=redefined-outer-name
+    exam_id = new_exam(db)
+    other_exam_id = new_exam(db, course_id='course-v1:x+y+z')
+    attempt_id = new_attempt(db, exam_id)
+    db.transition_attempt(attempt_id, 'ready')
+    new_attempt(db, exam_id)
+    new_attempt(db, other_exam_id)
+
+    stats = db.get_attempt_stats('course-v1:a+b+c')
+    assert stats['statuses'] == {'created': 1, 'ready': 1}
+    assert stats['time_in_status']['created']['count'] == 1
+    assert db.get_attempt_stats()['statuses'] == {'created': 2, 'ready': 1}
+    assert db.get_attempt_stats('course-v1:unknown') == {'statuses': {}, 'time_in_status': {}}
+
+
+def test_attempt_transitions(db):  # pylint: disable=redefined-outer-name
+    attempt_id = new_attempt(db, new_exam(db))
+    assert db.transition_attempt(attempt_id, 'started')['previous_status'] == 'created'
+    attempt = db.transition_attempt(attempt_id, 'submitted')
+    assert (attempt['status'], attempt['previous_status']) == ('submitted', 'started')
+    # repeating a status changes nothing
+    assert db.transition_attempt(attempt_id, 'submitted')['previous_status'] == 'submitted'
+    for status in ('verified', 'started', 'created'):
+        with pytest.raises(InvalidTransition):
+            db.transition_attempt(attempt_id, status)
+    db.transition_attempt(attempt_id, 'reviewed')
+    with pytest.raises(InvalidTransition):
+        db.transition_attempt(attempt_id, 'error')
+    stats = db.get_attempt_stats()
+    assert stats['statuses'] == {'reviewed': 1}
+    assert sorted(stats['time_in_status']) == ['created', 'started', 'submitted']
+
+
+def test_invalid_item_rejects_the_whole_batch(db):  # pylint: disable=redefined-outer-name
+    exams = [{'course_id': 'course-v1:a+b+c', 'exam_name': 'exam', 'is_practice_exam': False} for _ in range(3)]
+    del exams[2]['course_id']
+    with pytest.raises(KeyError):
+        db.save_exams(exams)
+    assert not list(db.get_exams())
+
+    exam_id = new_exam(db)
+    attempts = [{
+        'exam_id': exam_id,
+        'status': 'created',
+        'user_id': user_id,
+        'full_name': 'Student',
+        'email': 'student@example.com',
+        'lms_host': 'http://lms',
+    } for user_id in range(3)]
+    del attempts[2]['user_id']
+    with pytest.raises(KeyError):
+        db.save_attempts(attempts)
+    assert db.get_attempt_stats()['statuses'] == {}
+
+    del attempts[2]
+    assert len(db.save_attempts(iter(attempts))) == 2
+    assert db.get_attempt_stats()['statuses'] == {'created': 2}
+
+
+def test_rules_are_only_read_when_asked_for(db):  # pylint: disable=redefined-outer-name
+    exam_id = db.save_exam({'course_id': 'course-v1:a+b+c', 'exam_name': 'exam', 'is_practice_exam': False,
+                            'rules': {'allow_notes': True}})
+    assert db.get_exam(exam_id)['rules'] == {'allow_notes': True}
+    assert 'rules' not in db.get_exam(exam_id, rules=False)
+    assert [exam['rules'] for exam in db.get_exams()] == [{'allow_notes': True}]
+    assert ['rules' in exam for exam in db.get_exams(rules=False)] == [False]
+
+
+def test_pool_reuses_latest_connection(tmp_path):
+    storage = SQLiteDB(str(tmp_path / 'mockprock.sqlite'), logger, pool_size=2)
+    with storage.connect() as first:
+        with storage.connect() as second:
+            with storage.connect() as third:
+                assert len({id(first), id(second), id(third)}) == 3
+    # the pool keeps pool_size connections, so the last one back is closed
+    with pytest.raises(sqlite3.ProgrammingError):
+        first.execute('select 1')
+    # and hands out the most recently returned, warmest connection first
+    with storage.connect() as conn:
+        assert conn is second
+    with storage.connect() as conn:
+        assert conn is second
+        with storage.connect() as other:
+            assert other is third
+    storage.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        second.execute('select 1')
+
+
+def test_connections_use_wal(tmp_path):
+    storage = SQLiteDB(str(tmp_path / 'mockprock.sqlite'), logger)
+    with storage.connect() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert conn.execute('PRAGMA temp_store').fetchone()[0] == 2
+    storage.close()
+
+
+def use_storage(storage):
+    """
+    Returns what each call of a session against the storage engine returned, leaving out generated ids
+    """
+    results = []
+    exam = {'external_id': 'exam-1', 'course_id': 'course-v1:a+b+c', 'exam_name': 'exam', 'is_practice_exam': False,
+            'rules': {'allow_notes': True}}
+    results.append(storage.save_exam(exam))
+    results.append(storage.save_exam(dict(exam, exam_name='renamed')))
+    results.append(storage.save_exams([dict(exam, external_id='exam-%d' % number) for number in range(2, 5)]))
+    results.append(storage.get_exam('exam-1'))
+    results.append(storage.get_exam('unknown'))
+    results.append(list(storage.get_exams('course-v1:a+b+c', limit=2)))
+    results.append(list(storage.get_exams('course-v1:a+b+c', limit=2, after='exam-2')))
+    results.append(list(storage.get_exams('course-v1:unknown')))
+    results.append([storage.course_exists('course-v1:a+b+c'), storage.course_exists('course-v1:unknown')])
+
+    attempt_id = new_attempt(storage, 'exam-1')
+    attempt = storage.get_attempt('exam-1', attempt_id)
+    results.append(attempt.pop('id') == attempt_id)
+    results.append(attempt)
+    results.append(storage.get_attempt('exam-2', attempt_id))
+    results.append(storage.patch_attempt('exam-2', attempt_id, 'started'))
+    patched = storage.patch_attempt('exam-1', attempt_id, 'started')
+    results.append((patched['status'], patched['previous_status']))
+    results.append(storage.get_attempt_stats()['statuses'])
+
+    callback_id = storage.enqueue_callback('ready', 'http://lms/ready', {'status': 'ready'})
+    storage.enqueue_callback('review', 'http://lms/review', {'status': 'passed'}, delay=60)
+    claimed = storage.claim_callbacks(10, lease=60, owner='node-a:1')
+    results.append([dict(row, id=row['id'] == callback_id) for row in claimed])
+    results.append(storage.claim_callbacks(10, lease=60, owner='node-b:1'))
+    results.append(storage.renew_callback(callback_id, 60, 'node-b:1'))
+    results.append(storage.retry_callback(callback_id, 0, 'LMS error', owner='node-a:1'))
+    results.append([row['attempts'] for row in storage.claim_callbacks(10, lease=60, owner='node-b:1')])
+    results.append(storage.complete_callback(callback_id, owner='node-a:1'))
+    results.append(storage.complete_callback(callback_id, owner='node-b:1'))
+
+    storage.set_desktop_status('session', 'running')
+    storage.set_desktop_status('session', 'uploading')
+    results.append(sorted(storage.get_desktop_session('session').items())[1:])
+    results.append(storage.get_desktop_session('unknown'))
+    return results
+
+
+def test_engines_behave_alike(tmp_path):
+    memory = MemoryDB(logger)
+    sqlite = SQLiteDB(str(tmp_path / 'mockprock.sqlite'), logger)
+    for storage in (memory, sqlite):
+        storage.setup()
+    try:
+        assert use_storage(memory) == use_storage(sqlite)
+    finally:
+        memory.close()
+        sqlite.close()
+
+
+def test_exam_pages_start_after_the_cursor(db):  # pylint: disable=redefined-outer-name
+    for number in range(5):
+        db.save_exam({'external_id': 'exam-%d' % number, 'course_id': 'course-v1:a+b+c', 'exam_name': 'exam',
+                      'is_practice_exam': False})
+    new_exam(db, course_id='course-v1:x+y+z')
+
+    def page(after, limit=2):
+        return [exam['id'] for exam in db.get_exams('course-v1:a+b+c', limit=limit, after=after)]
+    assert page(None) == ['exam-0', 'exam-1']
+    assert page('exam-1') == ['exam-2', 'exam-3']
+    assert page('exam-3') == ['exam-4']
+    assert page('exam-4') == []
+    # the cursor needn't be an exam that still exists
+    assert page('exam-2a', limit=None) == ['exam-3', 'exam-4']
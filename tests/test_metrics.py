@@ -0,0 +1,87 @@
+"""
+Tests for the Prometheus metrics
+"""
+from mockprock.metrics import Counter, Gauge, Histogram, Registry, instrument_db
+
+
+def test_label_values_are_escaped():
+    counter = Counter('requests_total', 'Requests')
+    counter.inc(route='/a"b\\c\nd', method='GET')
+    counter.inc(2, method='GET', route='/a"b\\c\nd')
+    assert counter.render() == [
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{method="GET",route="/a\\"b\\\\c\\nd"} 3.0',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, route='/')
+    assert histogram.render()[2:] == [
+        'latency_seconds_bucket{route="/",le="0.1"} 2.0',
+        'latency_seconds_bucket{route="/",le="1"} 3.0',
+        'latency_seconds_bucket{route="/",le="+Inf"} 4.0',
+        'latency_seconds_count{route="/"} 4.0',
+        'latency_seconds_sum{route="/"} 3.65',
+    ]
+
+
+def test_registry_renders_every_metric():
+    registry = Registry()
+    registry.register(Gauge('in_flight', 'In flight')).inc()
+    registry.register(Gauge('pending', 'Pending', func=lambda: {(('kind', 'ready'),): 2}))
+    registry.register(Gauge('empty', 'Not collected', func=lambda: None))
+    assert registry.render() == '\n'.join([
+        '# HELP in_flight In flight',
+        '# TYPE in_flight gauge',
+        'in_flight 1.0',
+        '# HELP pending Pending',
+        '# TYPE pending gauge',
+        'pending{kind="ready"} 2.0',
+        '# HELP empty Not collected',
+        '# TYPE empty gauge',
+    ]) + '\n'
+
+
+class Storage:
+    def __init__(self):
+        self.read = 0
+
+    def get_value(self):
+        return 1
+
+    def get_values(self):
+        for value in range(3):
+            self.read += 1
+            yield value
+
+    def close(self):
+        pass
+
+
+def observed(histogram):
+    return {dict(labels)['method']: count for suffix, labels, count in histogram.samples() if suffix == '_count'}
+
+
+def test_generators_are_timed_until_exhausted():
+    histogram = Histogram('db_seconds', 'Storage latency')
+    storage = Storage()
+    instrument_db(storage, histogram)
+    assert storage.get_value() == 1
+    values = storage.get_values()
+    assert observed(histogram) == {'get_value': 1}
+    assert next(values) == 0
+    assert observed(histogram) == {'get_value': 1}
+    assert list(values) == [1, 2]
+    assert observed(histogram) == {'get_value': 1, 'get_values': 1}
+
+    # abandoned generators are timed once closed
+    values = storage.get_values()
+    next(values)
+    values.close()
+    assert observed(histogram) == {'get_value': 1, 'get_values': 2}
+    assert storage.read == 4
+    storage.close()
+    assert 'close' not in observed(histogram)
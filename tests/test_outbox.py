@@ -0,0 +1,111 @@
+"""
+Tests for delivering callbacks from the database outbox
+"""
+from collections import Counter
+from concurrent.futures import Future
+import logging
+import threading
+import time
+
+from mockprock.db import SQLiteDB
+from mockprock.outbox import OutboxWorker
+
+logger = logging.getLogger(__name__)
+
+
+class SlowLMS:
+    """
+    Accepts callbacks after `seconds`, counting how often each url was sent
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.sent = Counter()
+        self._lock = threading.Lock()
+
+    def send(self, kind, url, payload):  # pylint: disable=unused-argument
+        time.sleep(self.seconds)
+        with self._lock:
+            self.sent[url] += 1
+        future = Future()
+        future.set_result({'status': 'ok'})
+        return future
+
+
+def wait_for_empty_outbox(db, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with db.connect() as conn:
+            if not conn.execute('select count(*) from outbox').fetchone()[0]:
+                return True
+        time.sleep(0.05)
+    return False
+
+
+def test_batch_outliving_lease_is_sent_once(tmp_path):
+    # one worker claims the whole batch, but sending it takes longer than the lease,
+    # so the other worker claims the rest of the batch once the claim's lease runs out
+    dbpath = str(tmp_path / 'outbox.sqlite')
+    db = SQLiteDB(dbpath, logger)
+    db.setup()
+    urls = ['http://lms/callback/%d' % number for number in range(6)]
+    for url in urls:
+        db.enqueue_callback('review', url, {'status': 'passed'})
+
+    lms = SlowLMS(0.3)
+    workers = [
+        OutboxWorker(SQLiteDB(dbpath, logger), lms.send, logger, interval=0.05, lease=1, node_id=node_id)
+        for node_id in ('node-a', 'node-b')
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        assert wait_for_empty_outbox(db, timeout=10)
+    finally:
+        for worker in workers:
+            worker.shutdown()
+    assert lms.sent == Counter({url: 1 for url in urls})
+
+
+def test_claims_no_more_than_can_be_sent(tmp_path):
+    db = SQLiteDB(str(tmp_path / 'outbox.sqlite'), logger)
+    db.setup()
+    for number in range(5):
+        db.enqueue_callback('ready', 'http://lms/callback/%d' % number, {'status': 'ready'})
+    pending = []
+
+    def send(kind, url, payload):  # pylint: disable=unused-argument
+        future = Future()
+        pending.append(future)
+        return future
+
+    worker = OutboxWorker(db, send, logger, max_in_flight=2)
+    worker.owner = 'node-a:1'
+    assert worker.drain() == 2
+    assert worker.drain() == 0
+    pending[0].set_result({'status': 'ok'})
+    assert worker.in_flight == 1
+    assert worker.drain() == 1
+
+
+def test_responses_are_recorded_off_the_client_thread(tmp_path):
+    # with async callbacks, sends finish on the callback client's event loop
+    db = SQLiteDB(str(tmp_path / 'outbox.sqlite'), logger)
+    db.setup()
+    db.enqueue_callback('ready', 'http://lms/callback/1', {'status': 'ready'})
+    threads = []
+    complete_callback = db.complete_callback
+
+    def recording_complete(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return complete_callback(*args, **kwargs)
+    db.complete_callback = recording_complete
+    response = Future()
+    worker = OutboxWorker(db, lambda kind, url, payload: response, logger)
+    worker.owner = 'node-a:1'
+    assert worker.drain() == 1
+    loop = threading.Thread(target=response.set_result, args=({'status': 'ok'},))
+    loop.start()
+    loop.join()
+    assert wait_for_empty_outbox(db, timeout=5)
+    worker.shutdown()
+    assert threads and threads[0] is not loop
@@ -0,0 +1,65 @@
+"""
+Tests for profiling and collapsing profiles into flamegraph stacks
+"""
+import os
+import time
+from types import SimpleNamespace
+
+from mockprock.profiling import MAX_STACK_DEPTH, Profiler, collapse_stacks
+
+
+def layered_stats(layers, width):
+    """
+    Returns pstats-like data where every function calls every function in the next layer,
+    so there are width ** layers paths through the call graph
+    """
+    def func(layer, number):
+        return ('module.py', layer * width + number, 'f%d_%d' % (layer, number))
+
+    stats = {}
+    for layer in range(layers):
+        for number in range(width):
+            callers = {}
+            if layer:
+                callers = {func(layer - 1, caller): (1, 1, 0.001, 0.002) for caller in range(width)}
+            stats[func(layer, number)] = (width, width, 0.001 * width, 0.002 * width, callers)
+    return SimpleNamespace(stats=stats)
+
+
+def weights(lines):
+    return sum(int(line.rsplit(' ', 1)[1]) for line in lines)
+
+
+def test_collapsing_wide_and_deep_call_graphs_is_fast():
+    stats = layered_stats(layers=100, width=30)
+    start = time.monotonic()
+    lines = collapse_stacks(stats)
+    assert time.monotonic() - start < 5
+    # all the self time is drawn, once per caller
+    assert len(lines) == 30 + 99 * 30 * 30
+    assert weights(lines) == 100 * 30 * 30 * 1000
+    assert max(line.count(';') for line in lines) == MAX_STACK_DEPTH
+
+
+def fib(number):
+    return number if number < 2 else fib(number - 1) + fib(number - 2)
+
+
+def outer():
+    return fib(15) + sum(range(1000))
+
+
+def test_dump_writes_profiles(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    for _ in range(3):
+        profiler.run('GET /api/v1/exam/<exam_id>/', outer)
+    paths = profiler.dump()
+    assert sorted(os.path.basename(path) for path in paths) == [
+        'GET_api_v1_exam_exam_id.%d.collapsed' % os.getpid(),
+        'GET_api_v1_exam_exam_id.%d.prof' % os.getpid(),
+    ]
+    with open(paths[1]) as collapsed:
+        lines = collapsed.read().split('\n')
+    fib_lines = [line for line in lines if line.rsplit(' ', 1)[0].split(';')[-1].startswith('fib (')]
+    assert fib_lines
+    assert all('outer (test_profiling.py' in line for line in fib_lines)
@@ -0,0 +1,97 @@
+"""
+Tests for replaying captures against a running server
+"""
+import importlib
+import threading
+import time
+
+import pytest
+from werkzeug.serving import make_server
+
+from mockprock.bench import Timings
+from mockprock.db import MemoryDB
+from mockprock.replay import Replayer, drift_report
+
+EXAM = {'course_id': 'course-v1:a+b+c', 'exam_name': 'exam', 'is_practice_exam': False, 'rules': {}}
+ATTEMPT_PATH = '/api/v1/exam/recorded-exam/attempt/recorded-attempt/'
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    module = importlib.import_module('mockprock.server')
+    monkeypatch.setattr(module.app, 'db', MemoryDB(module.app.logger))
+    monkeypatch.setitem(module.app.config, 'DUMP_REQUESTS', False)
+    return module
+
+
+@pytest.fixture
+def server_url(server):  # pylint: disable=redefined-outer-name
+    http_server = make_server('127.0.0.1', 0, server.app, threaded=True)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % http_server.server_port
+    http_server.shutdown()
+    thread.join()
+
+
+def request_record(method, route, path, body=None, status=200, ids=()):
+    return {'type': 'request', 't': 0, 'method': method, 'route': route, 'path': path, 'query': {},
+            'body': body, 'status': status, 'ms': 1, 'ids': list(ids)}
+
+
+def test_replayed_ids_are_mapped(server, server_url, monkeypatch):  # pylint: disable=redefined-outer-name
+    save_exam = server.app.db.save_exam
+
+    def slow_save_exam(*args, **kwargs):
+        # the attempt's requests must wait for the exam, though they're all sent at once
+        time.sleep(0.2)
+        return save_exam(*args, **kwargs)
+    monkeypatch.setattr(server.app.db, 'save_exam', slow_save_exam)
+    attempt = {'status': 'created', 'user_id': 1, 'full_name': 'Student', 'email': 'student@example.com',
+               'lms_host': 'http://recorded-lms'}
+    records = [
+        request_record('POST', '/oauth2/access_token', '/oauth2/access_token'),
+        request_record('POST', '/api/v1/exam/', '/api/v1/exam/', body=EXAM, ids=['recorded-exam']),
+        request_record('POST', '/api/v1/exam/<exam_id>/attempt/', '/api/v1/exam/recorded-exam/attempt/',
+                       body=attempt, ids=['recorded-attempt']),
+        request_record('GET', '/api/v1/exam/<exam_id>/attempt/<attempt_id>/', ATTEMPT_PATH),
+        request_record('PATCH', '/api/v1/exam/<exam_id>/attempt/<attempt_id>/', ATTEMPT_PATH,
+                       body={'status': 'started'}),
+        # an attempt created before the capture started, so the replay doesn't know it
+        request_record('PATCH', '/api/v1/exam/<exam_id>/attempt/<attempt_id>/', '/api/v1/exam/old/attempt/old/',
+                       body={'status': 'started'}),
+    ]
+    timings = Timings()
+    replayer = Replayer(server_url, 'c', 'csecret', 'http://replay-lms', timings)
+    replayer.run(records, speedup=1, concurrency=len(records))
+
+    assert sorted(replayer.ids) == ['recorded-attempt', 'recorded-exam']
+    exam_id, attempt_id = replayer.ids['recorded-exam'], replayer.ids['recorded-attempt']
+    assert 'recorded' not in exam_id + attempt_id
+    attempt = server.app.db.get_attempt(exam_id, attempt_id)
+    assert (attempt['status'], attempt['lms_host']) == ('started', 'http://replay-lms')
+    assert replayer.mismatches == 1
+    summary = timings.summary(1)
+    assert summary['PATCH /api/v1/exam/<exam_id>/attempt/<attempt_id>/']['errors'] == 1
+    assert sum(row['errors'] for row in summary.values()) == 1
+
+
+def test_drift_report():
+    baseline = {
+        'GET /a': {'count': 10, 'errors': 0, 'p50': 10.0, 'p95': 20.0},
+        'GET /gone': {'count': 10, 'errors': 0, 'p50': 10.0, 'p95': 20.0},
+    }
+    summary = {
+        'GET /a': {'count': 10, 'errors': 1, 'p50': 15.0, 'p95': 18.0},
+        'GET /new': {'count': 5, 'errors': 0, 'p50': 1000.0, 'p95': 2000.0},
+    }
+    lines, worst = drift_report(baseline, summary)
+    assert worst == 50
+    assert [line.split()[:2] for line in lines[1:]] == [['GET', '/a'], ['GET', '/gone'], ['GET', '/new']]
+    assert lines[1].split()[2:] == ['10', '1', '10.0', '15.0', '+50%', '20.0', '18.0', '-10%']
+    assert lines[3].split()[2:] == ['5', '0', '-', '1000.0', '-', '-', '2000.0', '-']
+
+    lines, worst = drift_report({}, summary)
+    assert worst is None
+    assert len(lines) == 3
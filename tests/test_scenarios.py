@@ -0,0 +1,82 @@
+"""
+Tests for callback traffic scenarios
+"""
+import json
+
+import pytest
+
+from mockprock.proctoring import DEFAULT_REVIEW_COMMENTS
+from mockprock.scenarios import Scenario, load_scenario
+
+SCENARIO = {
+    'seed': 42,
+    'ready_delay': {'distribution': 'uniform', 'min': 1, 'max': 5},
+    'review_delay': {'distribution': 'lognormal', 'median': 600, 'sigma': 0.75},
+    'outcomes': {'passed': 0.5, 'suspicious': 0.3, 'error': 0.2},
+    'comments': {
+        'count': {'distribution': 'uniform', 'min': 0, 'max': 5},
+        'length': {'distribution': 'normal', 'mean': 100, 'stddev': 50},
+    },
+}
+
+
+def write_scenario(tmp_path, spec, name='scenario.json'):
+    path = tmp_path / name
+    path.write_text(json.dumps(spec) if isinstance(spec, dict) else spec)
+    return str(path)
+
+
+def test_seeded_scenario_repeats(tmp_path):
+    path = write_scenario(tmp_path, SCENARIO)
+    first, second = Scenario.load(path), Scenario.load(path)
+    reviews = [first.review() for _ in range(20)]
+    # the nth review is the same however many ready callbacks came before it
+    ready_delays = [second.ready_delay() for _ in range(5)]
+    assert [second.review() for _ in range(20)] == reviews
+    assert [first.ready_delay() for _ in range(5)] == ready_delays
+
+    assert all(1 <= delay <= 5 for delay in ready_delays)
+    assert {status for _, status, _ in reviews} <= {'passed', 'suspicious', 'error'}
+    assert len({status for _, status, _ in reviews}) > 1
+    assert any(comments for _, _, comments in reviews)
+    assert all(len(comment['comment']) < 400 for _, _, comments in reviews for comment in comments)
+
+    other = Scenario.load(write_scenario(tmp_path, dict(SCENARIO, seed=43), name='other.json'))
+    assert [other.review() for _ in range(20)] != reviews
+
+
+def test_defaults_match_fixed_behavior():
+    scenario = Scenario()
+    assert scenario.ready_delay() == 2
+    assert scenario.review() == (10, 'passed', DEFAULT_REVIEW_COMMENTS)
+
+
+def test_time_scale_divides_delays(tmp_path):
+    path = write_scenario(tmp_path, dict(SCENARIO, time_scale=10))
+    unscaled = Scenario.load(write_scenario(tmp_path, SCENARIO, name='unscaled.json'))
+    scaled = Scenario.load(path)
+    assert scaled.ready_delay() == pytest.approx(unscaled.ready_delay() / 10)
+    assert scaled.review()[0] == pytest.approx(unscaled.review()[0] / 10)
+
+    # the command line overrides the file
+    overridden = load_scenario(path, time_scale=100)
+    assert overridden.review()[0] == pytest.approx(Scenario.load(path).review()[0] / 10)
+    assert load_scenario(time_scale=4).review()[0] == 2.5
+    with pytest.raises(ValueError):
+        load_scenario(time_scale=0)
+
+
+@pytest.mark.parametrize('spec', [
+    {'ready_delay': {'distribution': 'poisson', 'mean': 1}},
+    {'review_delay': {'distribution': 'uniform', 'min': 1}},
+    {'outcomes': {'passed': 1, 'error': -1}},
+    {'outcomes': {'passed': 0}},
+    {'time_scale': 0},
+    {'speed': 10},
+    '[1, 2]',
+    '{"seed": ',
+])
+def test_invalid_scenarios_are_rejected(tmp_path, spec):
+    path = write_scenario(tmp_path, spec)
+    with pytest.raises(ValueError):
+        Scenario.load(path)
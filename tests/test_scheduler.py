@@ -0,0 +1,71 @@
+"""
+Tests for scheduling delayed callbacks
+"""
+import logging
+import threading
+import time
+
+import pytest
+
+from mockprock.scheduler import CallbackScheduler, SchedulerFull
+
+logger = logging.getLogger(__name__)
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_callbacks_run_when_due():
+    scheduler = CallbackScheduler(logger, workers=1)
+    ran = []
+    try:
+        for delay, name in ((0.2, 'last'), (0.1, 'second'), (0, 'first'), (0.1, 'third')):
+            scheduler.schedule(delay, ran.append, name)
+        # a failing callback doesn't stop its worker
+        scheduler.schedule(0.15, lambda: 1 / 0)
+        assert wait_for(lambda: scheduler.pending == 0, timeout=5)
+        assert ran == ['first', 'second', 'third', 'last']
+    finally:
+        scheduler.shutdown()
+
+
+def test_pending_callbacks_are_limited():
+    scheduler = CallbackScheduler(logger, workers=1, max_pending=2)
+    release = threading.Event()
+    try:
+        scheduler.schedule(0, release.wait, 5)
+        scheduler.schedule(60, print)
+        with pytest.raises(SchedulerFull):
+            scheduler.schedule(0, print)
+        release.set()
+        assert wait_for(lambda: scheduler.pending == 1, timeout=5)
+        scheduler.schedule(60, print)
+    finally:
+        scheduler.shutdown()
+
+
+def test_shutdown_drops_callbacks_not_yet_due():
+    scheduler = CallbackScheduler(logger, workers=2)
+    ran = []
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        time.sleep(0.1)
+        ran.append('slow')
+    scheduler.schedule(0, slow)
+    scheduler.schedule(60, ran.append, 'later')
+    assert started.wait(5)
+    scheduler.shutdown()
+    # callbacks already running finish
+    assert ran == ['slow']
+    assert scheduler.pending == 0
+    assert not any(thread.is_alive() for thread in scheduler._threads)  # pylint: disable=protected-access
+    with pytest.raises(SchedulerFull):
+        scheduler.schedule(0, ran.append, 'after shutdown')
@@ -0,0 +1,277 @@
+"""
+Tests for the Flask server's API
+"""
+from concurrent.futures import Future
+import importlib
+import threading
+import time
+from types import SimpleNamespace
+
+import jwt
+import pytest
+
+from mockprock.cache import LRUCache
+from mockprock.db import MemoryDB
+from mockprock.outbox import OutboxWorker
+from mockprock.proctoring import DASHBOARD_PAGE_SIZE, ready_callback_request
+
+EXAM = {'course_id': 'course-v1:a+b+c', 'exam_name': 'exam', 'is_practice_exam': False, 'rules': {}}
+# how the dashboard shows the id of an exam named exam-...
+EXAM_ID_HTML = b'&#39;id&#39;: &#39;exam-'
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # importing the server opens mockprock.sqlite in the working directory
+    monkeypatch.chdir(tmp_path)
+    module = importlib.import_module('mockprock.server')
+    monkeypatch.setattr(module.app, 'db', MemoryDB(module.app.logger))
+    module.app.config['DUMP_REQUESTS'] = False
+    return module
+
+
+@pytest.fixture
+def client(server):  # pylint: disable=redefined-outer-name
+    client = server.app.test_client()
+    data = {'grant_type': 'client_credentials', 'client_id': 'c', 'client_secret': 'csecret', 'token_type': 'jwt'}
+    token = client.post('/oauth2/access_token', data=data).json['access_token']
+    client.environ_base['HTTP_AUTHORIZATION'] = 'JWT %s' % token
+    return client
+
+
+def new_attempt(exam_id):
+    return {
+        'exam_id': exam_id,
+        'status': 'created',
+        'user_id': 1,
+        'full_name': 'Student',
+        'email': 'student@example.com',
+        'lms_host': 'http://lms',
+    }
+
+
+def test_bulk_items_must_be_objects(client, server):  # pylint: disable=redefined-outer-name
+    assert client.post('/api/v1/exams/', json=[5]).status_code == 400
+    exam_id = client.post('/api/v1/exams/', json=[EXAM]).json['ids'][0]
+    assert client.post('/api/v1/attempts/', json=[new_attempt(exam_id), 5]).status_code == 400
+    response = client.post('/api/v1/attempts/', data='{}\n[1]\n', content_type='application/x-ndjson')
+    assert response.status_code == 400
+    assert server.app.db.get_attempt_stats()['statuses'] == {}
+    assert client.post('/api/v1/attempts/', json=[new_attempt(exam_id)]).status_code == 200
+
+
+def test_dashboard_pages(client):  # pylint: disable=redefined-outer-name
+    exams = [dict(EXAM, exam_name='exam %d' % number) for number in range(DASHBOARD_PAGE_SIZE + 1)]
+    exam_ids = client.post('/api/v1/exams/', json=exams).json['ids']
+    token = jwt.encode({'course_id': EXAM['course_id'], 'iss': 'c', 'exam': [exam_ids[0]]}, 'csecret',
+                       algorithm='HS256')
+    response = client.get('/api/v1/instructor/c/', query_string={'jwt': token})
+    assert response.status_code == 200
+    assert b'after=' in response.data
+    # only the exam listed in the token shows its rules
+    assert response.data.count(b'rules') == 1
+
+    token = jwt.encode({'course_id': 'course-v1:unknown', 'iss': 'c'}, 'csecret', algorithm='HS256')
+    assert client.get('/api/v1/instructor/c/', query_string={'jwt': token}).status_code == 403
+
+
+def test_desktop_sessions(client):  # pylint: disable=redefined-outer-name
+    assert client.post('/desktop/start?attempt=1').json == {'status': 'running'}
+    response = client.post('/desktop/stop?attempt=1')
+    assert response.json == {'status': 'uploading'}
+    assert response.headers['Access-Control-Allow-Origin'] == '*'
+    assert client.get('/desktop/ping?attempt=1').json == {'status': 'uploading'}
+    assert client.get('/desktop/ping?attempt=2').json == {'status': None}
+
+
+def test_event_stream_polls_storage(client, server, monkeypatch):  # pylint: disable=redefined-outer-name
+    # with --workers or --cluster, other processes change the attempt without telling this one
+    monkeypatch.setitem(server.app.config, 'EVENT_POLL_SECONDS', 0.01)
+    exam_id = client.post('/api/v1/exams/', json=[EXAM]).json['ids'][0]
+    attempt_id = client.post('/api/v1/attempts/', json=[new_attempt(exam_id)]).json['ids'][0]
+    response = client.get('/api/v1/exam/%s/attempt/%s/events/' % (exam_id, attempt_id))
+    events = response.iter_encoded()
+    assert b'"created"' in next(events)
+    for status in ('started', 'submitted', 'reviewed'):
+        server.app.db.transition_attempt(attempt_id, status)
+        assert b'"%s"' % status.encode() in next(chunk for chunk in events if not chunk.startswith(b':'))
+    assert list(events) == []
+    response.close()
+
+
+def test_event_streams_are_limited(client, server, monkeypatch):  # pylint: disable=redefined-outer-name
+    monkeypatch.setitem(server.app.config, 'MAX_EVENT_STREAMS', 1)
+    exam_id = client.post('/api/v1/exams/', json=[EXAM]).json['ids'][0]
+    attempt_id = client.post('/api/v1/attempts/', json=[new_attempt(exam_id)]).json['ids'][0]
+    url = '/api/v1/exam/%s/attempt/%s/events/' % (exam_id, attempt_id)
+    assert client.get('/api/v1/exam/%s/attempt/unknown/events/' % exam_id).status_code == 404
+    response = client.get(url)
+    assert response.status_code == 200
+    assert client.get(url).status_code == 503
+    response.close()
+    response = client.get(url)
+    assert response.status_code == 200
+    response.close()
+
+
+def test_download_of_unknown_attempt(client, server, monkeypatch):  # pylint: disable=redefined-outer-name
+    monkeypatch.setattr(server.app, 'outbox', OutboxWorker(server.app.db, server.post_callback, server.app.logger))
+    assert client.get('/download?exam=1&attempt=2').status_code == 200
+    assert client.get('/download').status_code == 200
+    assert not server.app.db.claim_callbacks(10, lease=60)
+
+    exam_id = client.post('/api/v1/exams/', json=[EXAM]).json['ids'][0]
+    attempt_id = client.post('/api/v1/attempts/', json=[new_attempt(exam_id)]).json['ids'][0]
+    monkeypatch.setattr(server.app.scenario, 'ready_delay', lambda: 0)
+    assert client.get('/download?exam=%s&attempt=%s' % (exam_id, attempt_id)).status_code == 200
+    assert len(server.app.db.claim_callbacks(10, lease=60)) == 1
+
+
+def test_async_callback_status_saved_off_loop(client, server, monkeypatch):  # pylint: disable=redefined-outer-name
+    exam_id = client.post('/api/v1/exams/', json=[EXAM]).json['ids'][0]
+    attempt_id = client.post('/api/v1/attempts/', json=[new_attempt(exam_id)]).json['ids'][0]
+    transition_attempt = server.app.db.transition_attempt
+    threads = []
+
+    def recording_transition(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return transition_attempt(*args, **kwargs)
+    monkeypatch.setattr(server.app.db, 'transition_attempt', recording_transition)
+    response = Future()
+    monkeypatch.setattr(server.app, 'async_client', SimpleNamespace(post=lambda url, payload: response))
+
+    attempt = server.app.db.get_attempt(exam_id, attempt_id)
+    server.post_callback('ready', *ready_callback_request(attempt_id, attempt))
+    # the LMS responds on the client's event loop thread
+    loop = threading.Thread(target=response.set_result, args=({'status': 'ok'},))
+    loop.start()
+    loop.join()
+    deadline = time.monotonic() + 5
+    while not threads and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert threads and threads[0] is not loop
+    assert server.app.db.get_attempt(exam_id, attempt_id)['status'] == 'ready'
+
+
+def test_unread_event_streams_unsubscribe(client, server):  # pylint: disable=redefined-outer-name
+    exam_id = client.post('/api/v1/exams/', json=[EXAM]).json['ids'][0]
+    attempt_id = client.post('/api/v1/attempts/', json=[new_attempt(exam_id)]).json['ids'][0]
+    url = '/api/v1/exam/%s/attempt/%s/events/' % (exam_id, attempt_id)
+    for _ in range(5):
+        # the WSGI server closes the response without reading it
+        response = client.head(url)
+        assert response.status_code == 200
+        response.close()
+    response = client.get(url)
+    assert b'"created"' in next(response.iter_encoded())
+    response.close()
+    assert server.app.status_events.stats()['watchers'] == 0
+    assert server.app.event_streams == 0
+
+
+def test_dashboard_stats_only_on_first_page(client, server, monkeypatch):  # pylint: disable=redefined-outer-name
+    exams = [dict(EXAM, exam_name='exam %d' % number) for number in range(DASHBOARD_PAGE_SIZE + 1)]
+    exam_ids = client.post('/api/v1/exams/', json=exams).json['ids']
+    get_attempt_stats = server.app.db.get_attempt_stats
+    courses = []
+
+    def counting_stats(course_id=None):
+        courses.append(course_id)
+        return get_attempt_stats(course_id)
+    monkeypatch.setattr(server.app.db, 'get_attempt_stats', counting_stats)
+    token = jwt.encode({'course_id': EXAM['course_id'], 'iss': 'c'}, 'csecret', algorithm='HS256')
+    response = client.get('/api/v1/instructor/c/', query_string={'jwt': token})
+    assert b'<h2>Attempts</h2>' in response.data
+    response = client.get('/api/v1/instructor/c/', query_string={'jwt': token, 'after': sorted(exam_ids)[0]})
+    assert response.status_code == 200
+    assert b'<h2>Attempts</h2>' not in response.data
+    assert courses == [EXAM['course_id']]
+
+
+@pytest.mark.parametrize('authorization', ['', 'JWT', 'JWT not-a-token', 'JWT a b', 'Bearer'])
+def test_bad_authorization_is_forbidden(client, authorization):  # pylint: disable=redefined-outer-name
+    assert client.get('/api/v1/config/', headers={'Authorization': authorization}).status_code == 403
+
+
+def test_tokens_are_cached_until_they_expire(client, server, monkeypatch):  # pylint: disable=redefined-outer-name
+    monkeypatch.setattr(server.app, 'jwt_cache', LRUCache())
+    assert client.get('/api/v1/config/').status_code == 200
+    assert client.get('/api/v1/config/').status_code == 200
+    assert server.app.jwt_cache.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+    # an hour later, the token is decoded again
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 3601)
+    client.get('/api/v1/config/')
+    assert server.app.jwt_cache.stats() == {'hits': 1, 'misses': 2, 'size': 0}
+
+
+def dashboard_page(client, after=None):
+    token = jwt.encode({'course_id': EXAM['course_id'], 'iss': 'c'}, 'csecret', algorithm='HS256')
+    query = {'jwt': token}
+    if after:
+        query['after'] = after
+    response = client.get('/api/v1/instructor/c/', query_string=query)
+    assert response.status_code == 200
+    return response.data
+
+
+def test_dashboard_page_boundary(client):  # pylint: disable=redefined-outer-name
+    exams = [dict(EXAM, external_id='exam-%03d' % number) for number in range(DASHBOARD_PAGE_SIZE)]
+    client.post('/api/v1/exams/', json=exams)
+    # a full page, with nothing after it
+    page = dashboard_page(client)
+    assert page.count(EXAM_ID_HTML) == DASHBOARD_PAGE_SIZE
+    assert b'after=' not in page
+
+    client.post('/api/v1/exams/', json=[dict(EXAM, external_id='exam-%03d' % DASHBOARD_PAGE_SIZE)])
+    page = dashboard_page(client)
+    assert page.count(EXAM_ID_HTML) == DASHBOARD_PAGE_SIZE
+    assert b'after=exam-%03d' % (DASHBOARD_PAGE_SIZE - 1) in page
+    page = dashboard_page(client, after='exam-%03d' % (DASHBOARD_PAGE_SIZE - 1))
+    assert page.count(EXAM_ID_HTML) == 1
+    assert EXAM_ID_HTML + b'%03d' % DASHBOARD_PAGE_SIZE in page
+    assert b'after=' not in page
+
+
+def test_dashboard_of_course_without_exams(client):  # pylint: disable=redefined-outer-name
+    client.post('/api/v1/exams/', json=[dict(EXAM, course_id='course-v1:x+y+z')])
+    token = jwt.encode({'course_id': EXAM['course_id'], 'iss': 'c'}, 'csecret', algorithm='HS256')
+    assert client.get('/api/v1/instructor/c/', query_string={'jwt': token}).status_code == 403
+
+
+def test_patch_of_unknown_attempt(client, server):  # pylint: disable=redefined-outer-name
+    exam_id = client.post('/api/v1/exams/', json=[EXAM]).json['ids'][0]
+    attempt_id = client.post('/api/v1/attempts/', json=[new_attempt(exam_id)]).json['ids'][0]
+    published = server.app.status_events.stats()['published']
+    for path in ('/api/v1/exam/%s/attempt/unknown/' % exam_id, '/api/v1/exam/unknown/attempt/%s/' % attempt_id):
+        assert client.patch(path, json={'status': 'submitted'}).status_code == 404
+        assert client.patch(path, json={}).status_code == 404
+    assert server.app.status_events.stats()['published'] == published
+    assert server.app.db.get_attempt(exam_id, attempt_id)['status'] == 'created'
+
+
+def test_config_is_cached_per_host(client, server, monkeypatch):  # pylint: disable=redefined-outer-name
+    monkeypatch.setattr(server.app, 'config_cache', LRUCache())
+    for _ in range(2):
+        for host in ('a.example.com', 'b.example.com:8000'):
+            config = client.get('/api/v1/config/', base_url='http://%s' % host).json
+            assert config['download_url'] == 'http://%s/download' % host
+    assert server.app.config_cache.stats() == {'hits': 2, 'misses': 2, 'size': 2}
+
+
+def test_saving_an_exam_invalidates_it(client, server, monkeypatch):  # pylint: disable=redefined-outer-name
+    monkeypatch.setattr(server.app, 'exam_cache', LRUCache())
+    exam_id = client.post('/api/v1/exam/', json=EXAM).json['id']
+    assert client.get('/api/v1/exam/%s/' % exam_id).json['name'] == 'exam'
+    assert client.get('/api/v1/exam/%s/' % exam_id).json['name'] == 'exam'
+    assert server.app.exam_cache.hits == 1
+
+    client.post('/api/v1/exam/%s/' % exam_id, json=dict(EXAM, exam_name='renamed'))
+    assert client.get('/api/v1/exam/%s/' % exam_id).json['name'] == 'renamed'
+    client.post('/api/v1/exams/', json=[dict(EXAM, external_id=exam_id, exam_name='renamed again')])
+    assert client.get('/api/v1/exam/%s/' % exam_id).json['name'] == 'renamed again'
+    # unknown exams aren't cached, so they're found once created
+    assert client.get('/api/v1/exam/later/').json == {}
+    client.post('/api/v1/exams/', json=[dict(EXAM, external_id='later')])
+    assert client.get('/api/v1/exam/later/').json['name'] == 'exam'